@@ -0,0 +1,68 @@
+import os
+import re
+import heapq
+from functools import lru_cache
+from collections import Counter
+import nltk
+from nltk.stem.porter import PorterStemmer
+from nltk.corpus import stopwords
+
+try:
+    stopwords.words('english')
+except LookupError:
+    nltk.download('stopwords')
+
+# The tokenization of every index and of the queries. The index notebooks in
+# `Create indxes on GCP/` and index_builder.py import it from here, so the
+# terms written to the indexes and the terms looked up stay the same.
+english_stopwords = frozenset(stopwords.words('english'))
+corpus_stopwords = ['category', 'references', 'also', 'links', 'extenal', 'see', 'thumb', 'became', 'may', 'considered', 'known', 'meaning', 'mean', 'occur', 'describe']
+RE_WORD = re.compile(r"""[\#\@\w](['\-]?\w){1,24}""", re.UNICODE)
+all_stopwords = english_stopwords.union(corpus_stopwords)
+stemmer = PorterStemmer()
+
+# Tokens whose stem each Analyzer keeps.
+STEM_CACHE_SIZE = int(os.environ.get('STEM_CACHE_SIZE', 200_000))
+# Most frequent index terms stemmed by Analyzer.warm.
+STEM_WARM_TERMS = int(os.environ.get('STEM_WARM_TERMS', 10_000))
+
+
+class Analyzer:
+    """ Turns text into index terms: the lower-cased RE_WORD tokens that are
+        not stopwords, Porter stemmed. Stems are memoized in a bounded LRU
+        cache, so the tokens seen again (most of them, in queries as in the
+        corpus) are not stemmed again, and warm() fills it ahead of time.
+    """
+    def __init__(self, stop=all_stopwords, cache_size=STEM_CACHE_SIZE):
+        self.stop = stop
+        self.stem = lru_cache(maxsize=cache_size)(stemmer.stem)
+
+    def tokens(self, text):
+        """ Returns the terms of `text`, in order. """
+        stem, stop = self.stem, self.stop
+        return [stem(token.group()) for token in RE_WORD.finditer(text.lower())
+                if token.group() not in stop]
+
+    def query(self, text):
+        """ Returns the terms of a query, each mapped to its share of the query's
+            terms (its tf divided by the query length).
+        """
+        tokens = self.tokens(text)
+        return {term: count / len(tokens) for term, count in Counter(tokens).items()}
+
+    def warm(self, df, n=STEM_WARM_TERMS):
+        """ Stems the `n` terms with the highest df. The cache is keyed by the
+            words of the text while index terms are stems, so this only helps
+            query words that are their own stem ('war', 'film', but not
+            'happy', whose stem 'happi' no query uses); `n` is kept to the head
+            of the vocabulary, where most of those words are, and the rest of
+            the cache is left to the words queries do use.
+        """
+        for term in heapq.nlargest(min(n, self.stem.cache_parameters()['maxsize']), df, key=df.__getitem__):
+            self.stem(term)
+
+    def cache_info(self):
+        return self.stem.cache_info()
+
+    def clear(self):
+        self.stem.cache_clear()
@@ -0,0 +1,283 @@
+import os
+import sys
+import json
+import time
+import random
+import pickle
+import resource
+import argparse
+import platform
+import threading
+from pathlib import Path
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Stages of the /search pipeline (see search_frontend.rankQuery), in the order
+# they run. Stages it times besides these are reported after them.
+STAGES = ('tokenize', 'fetch', 'anchor', 'title', 'bm25', 'titles', 'total')
+
+
+def make_vocabulary(size, rng):
+    """ Returns `size` made-up words that are neither stopwords nor changed by
+        stemming, so they reach the indexes exactly as they are queried.
+    """
+    from analyzer import all_stopwords, stemmer
+    consonants, vowels = 'bcdfghjklmnprtvz', 'aiou'
+    words = set()
+    while len(words) < size:
+        n = rng.randint(2, 4)
+        word = ''.join(rng.choice(consonants) + rng.choice(vowels) for _ in range(n)) + rng.choice('bdgkmnprt')
+        if word not in all_stopwords and stemmer.stem(word) == word:
+            words.add(word)
+    return sorted(words)
+
+
+def zipf_weights(n, s=1.1):
+    weights = 1 / np.arange(1, n + 1) ** s
+    return weights / weights.sum()
+
+
+def build_corpus(out_dir, n_docs=20000, vocabulary=5000, seed=0, impact_prefix=0):
+    """ Builds a synthetic corpus with Zipf distributed terms into `out_dir`,
+        laid out like the bucket: the body, anchor text and title indexes, page
+        views, PageRank and the column store the search engine reads. With
+        `impact_prefix`, the longer body and anchor lists get impact-ordered
+        prefixes of that many documents.
+    Returns:
+    --------
+      dict describing the corpus, and the vocabulary sorted by frequency.
+    """
+    from index_builder import token2bucket_id
+    from inverted_index_gcp import InvertedIndex
+    from columnar_store import ColumnStore, COLUMNS_DIR
+    from retrieval import BM25_K1, BM25_B
+
+    rng = random.Random(seed)
+    words = make_vocabulary(vocabulary, rng)
+    rng.shuffle(words)
+    np_rng = np.random.default_rng(seed)
+    weights = zipf_weights(len(words))
+    doc_ids = np.sort(np_rng.choice(np.arange(1, n_docs * 20), n_docs, replace=False)).tolist()
+
+    def sample(n):
+        return [words[i] for i in np_rng.choice(len(words), n, p=weights)]
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    def write_postings(index, base_dir):
+        """ Writes the posting lists of an InvertedIndex into its buckets under
+            `out_dir`/`base_dir`, with the posting files named relative to `out_dir`.
+        """
+        posting_dir = out_dir / base_dir
+        posting_dir.mkdir(parents=True, exist_ok=True)
+        buckets = defaultdict(list)
+        for w, pl in sorted(index._posting_list.items()):
+            buckets[token2bucket_id(w)].append((w, sorted(pl)))
+        for bucket_id, list_w_pl in buckets.items():
+            InvertedIndex.write_a_posting_list((bucket_id, list_w_pl), posting_dir)
+            locs_path = posting_dir / f'{bucket_id}_posting_locs.pickle'
+            with open(locs_path, 'rb') as f:
+                posting_locs = {w: [(os.path.relpath(f_name, out_dir), offset) for f_name, offset in locs]
+                                for w, locs in pickle.load(f).items()}
+            with open(locs_path, 'wb') as f:
+                pickle.dump(posting_locs, f)
+            for w, locs in posting_locs.items():
+                index.posting_locs[w].extend(locs)
+
+    body = InvertedIndex()
+    lengths = np.clip(np_rng.lognormal(5, 1, n_docs).astype(int), 5, 5000)
+    for doc_id, length in zip(doc_ids, lengths):
+        body.add_doc(doc_id, sample(int(length)))
+    write_postings(body, 'bucketBody')
+    body.nf = dict(zip(doc_ids, lengths.tolist()))
+    body.nf['avg'] = float(lengths.mean())
+    body.write_index(str(out_dir / 'bucketBody'), 'indexBody')
+
+    # Anchor postings are (source doc, destination doc) pairs.
+    anchor = InvertedIndex()
+    for doc_id in doc_ids:
+        for _ in range(np_rng.poisson(3)):
+            dest = rng.choice(doc_ids)
+            for w in set(sample(rng.randint(1, 4))):
+                anchor._posting_list[w].append((doc_id, dest))
+    for w, pl in anchor._posting_list.items():
+        anchor.df[w] = len(pl)
+    write_postings(anchor, 'bucketAnchorText')
+    if impact_prefix:
+        anchor.write_impact_prefixes(str(out_dir), impact_prefix)
+    anchor.write_index(str(out_dir / 'bucketAnchorText'), 'indexAnchorText')
+
+    titles = InvertedIndex()
+    title = InvertedIndex()
+    title_nf = {}
+    for doc_id in doc_ids:
+        tokens = sample(rng.randint(1, 5))
+        titles.tf[doc_id] = ' '.join(tokens).title()
+        title.add_doc(doc_id, tokens)
+        title_nf[doc_id] = len(tokens)
+    title.tf = {w: sorted(pl) for w, pl in title._posting_list.items()}
+    title.nf = title_nf
+    (out_dir / 'bucketTitle').mkdir(exist_ok=True)
+    title.write_index(str(out_dir / 'bucketTitle'), 'indexTitle')
+    titles.write_index(str(out_dir / 'bucketTitle'), 'dictIdTitle')
+
+    views = Counter(dict(zip(doc_ids, np_rng.pareto(1.2, n_docs).astype(int).tolist())))
+    pageranks = dict(zip(doc_ids, np_rng.pareto(1.5, n_docs).tolist()))
+    (out_dir / 'page_views').mkdir(exist_ok=True)
+    with open(out_dir / 'page_views/pageviews.pkl', 'wb') as f:
+        pickle.dump(views, f)
+    (out_dir / 'page_ranks').mkdir(exist_ok=True)
+    with open(out_dir / 'page_ranks/pageRanks.pickle', 'wb') as f:
+        pickle.dump(pageranks, f)
+
+    (out_dir / COLUMNS_DIR).mkdir(parents=True, exist_ok=True)
+    store = ColumnStore.build(body, title, titles, views, pageranks, base_dir=str(out_dir))
+    store.write(out_dir / COLUMNS_DIR)
+    body.compute_upper_bounds(str(out_dir), store.body_nf.lookup, store.meta['avg'], BM25_K1, BM25_B)
+    if impact_prefix:
+        body.write_impact_prefixes(str(out_dir), impact_prefix, None, store.body_nf.lookup, store.meta['avg'],
+                                   BM25_K1, BM25_B)
+    body.nf = {}
+    body.write_index(str(out_dir / COLUMNS_DIR), 'indexBody')
+    info = {'docs': n_docs, 'vocabulary': len(words), 'seed': seed, 'impact_prefix': impact_prefix,
+            'body_postings': int(sum(body.df.values())), 'anchor_postings': int(sum(anchor.df.values()))}
+    return info, words
+
+
+def make_queries(words, n, seed=0):
+    """ Returns `n` queries of 1 to 4 terms drawn with the corpus' Zipf weights. """
+    rng = np.random.default_rng(seed + 1)
+    weights = zipf_weights(len(words))
+    return [' '.join(words[i] for i in rng.choice(len(words), rng.integers(1, 5), p=weights)) for _ in range(n)]
+
+
+def run_query(sf, query, timings):
+    """ Runs a query through search_frontend.rankQuery, the /search pipeline
+        without Flask and the result cache, appending the wall time of each
+        stage of its RequestTimer (in seconds) to `timings`.
+    """
+    from metrics import RequestTimer
+    timer = RequestTimer()
+    with timer.stage('tokenize'):
+        query_dict = sf.orderedQuery(sf.query_handler(query))
+    res = sf.rankQuery(query_dict, timer)
+    for stage, seconds in timer.stages.items():
+        timings[stage].append(seconds)
+    timings['total'].append(timer.elapsed())
+    return res
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return {'count': 0}
+    ms = np.asarray(values) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {'count': len(ms), 'mean_ms': float(ms.mean()), 'p50_ms': float(p50),
+            'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(ms.max())}
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def benchmark(index_dir, queries, concurrency=8, repeat=1, warmup=True):
+    """ Replays `queries` against the index in `index_dir`: once sequentially
+        for per-stage latencies, then `repeat` times on `concurrency` threads
+        for throughput. search_frontend reads its configuration when it is
+        imported, so this must run in a process that has not imported it yet.
+    """
+    os.environ.update(BUCKET_NAME='', INDEX_BASE_DIR=str(index_dir), INDEX_WARMUP='sync')
+    os.environ.setdefault('RESULT_CACHE_MB', '0')
+    start = time.perf_counter()
+    import search_frontend as sf
+    load_seconds = time.perf_counter() - start
+
+    if warmup:
+        for query in queries:
+            run_query(sf, query, defaultdict(list))
+
+    timings = defaultdict(list)
+    for query in queries:
+        run_query(sf, query, timings)
+
+    lock = threading.Lock()
+    concurrent_timings = defaultdict(list)
+
+    def task(query):
+        local = defaultdict(list)
+        run_query(sf, query, local)
+        with lock:
+            for stage, values in local.items():
+                concurrent_timings[stage].extend(values)
+
+    replay = queries * repeat
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(task, replay))
+    seconds = time.perf_counter() - start
+
+    return {
+        'load_seconds': load_seconds,
+        'stages': {stage: percentiles(timings[stage])
+                   for stage in STAGES + tuple(sorted(set(timings) - set(STAGES)))},
+        'throughput': {'concurrency': concurrency, 'queries': len(replay), 'seconds': seconds,
+                       'qps': len(replay) / seconds if seconds > 0 else None,
+                       'latency': percentiles(concurrent_timings['total'])},
+        'caches': {'posting': sf.posting_cache.stats(), 'result': sf.result_cache.stats()},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the /search pipeline offline.')
+    parser.add_argument('--index-dir', help='an existing index laid out like the bucket; '
+                                            'by default a synthetic corpus is built into --corpus-dir')
+    parser.add_argument('--corpus-dir', default='bench_corpus')
+    parser.add_argument('--docs', type=int, default=20000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--impact-prefix', type=int, default=0,
+                        help='build impact-ordered prefixes of this many documents for the long lists')
+    parser.add_argument('--queries', help='query log, one query per line')
+    parser.add_argument('--n-queries', type=int, default=500, help='synthetic queries when there is no log')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the queries in the throughput run')
+    parser.add_argument('--no-warmup', action='store_true', help='measure with cold posting caches')
+    parser.add_argument('--out', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    corpus, words = None, None
+    index_dir = args.index_dir
+    if index_dir is None:
+        corpus, words = build_corpus(args.corpus_dir, args.docs, args.vocabulary, args.seed, args.impact_prefix)
+        index_dir = args.corpus_dir
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+    elif words is not None:
+        queries = make_queries(words, args.n_queries, args.seed)
+    else:
+        parser.error('--index-dir needs a --queries log')
+
+    results = {
+        'config': {'index_dir': str(index_dir), 'queries': len(queries), 'concurrency': args.concurrency,
+                   'repeat': args.repeat, 'warmup': not args.no_warmup,
+                   'env': {k: v for k, v in os.environ.items()
+                           if k in ('POSTING_CACHE_MB', 'RESULT_CACHE_MB', 'FETCH_WORKERS', 'FULL_BODY_BM25',
+                                    'IMPACT_PREFIXES')}},
+        'corpus': corpus,
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+    }
+    results.update(benchmark(index_dir, queries, args.concurrency, args.repeat, not args.no_warmup))
+    text = json.dumps(results, indent=1)
+    if args.out:
+        Path(args.out).write_text(text)
+    print(text)
+
+
+if __name__ == '__main__':
+    main()
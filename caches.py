@@ -0,0 +1,108 @@
+import sys
+import threading
+from time import monotonic
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """ Thread-safe least-recently-used cache bounded by the total size of its
+        values in bytes, as measured by `sizeof`. Keeps hit, miss and eviction
+        counters.
+    """
+    def __init__(self, max_bytes, sizeof=sys.getsizeof):
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()     # key -> (size, ..., value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lookup(self, key):
+        """ Returns the entry of `key` or None. Called with the lock held. """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[0]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[-1]
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        # a value that does not fit would only flush everything else.
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = self._entry(size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _entry(self, size, value):
+        return (size, value)
+
+    def get_or_load(self, key, load):
+        """ Returns the cached value of `key`, or calls `load()` and caches it. """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = load()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+
+class TTLCache(LRUCache):
+    """ LRUCache whose entries also expire `ttl` seconds after they were put. """
+    def __init__(self, max_bytes, ttl, sizeof=sys.getsizeof):
+        super().__init__(max_bytes, sizeof)
+        self.ttl = ttl
+        self.expirations = 0
+
+    def _entry(self, size, value):
+        return (size, monotonic() + self.ttl, value)
+
+    def _lookup(self, key):
+        entry = super()._lookup(key)
+        if entry is not None and entry[1] < monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        return entry
+
+    def stats(self):
+        stats = super().stats()
+        stats['expirations'] = self.expirations
+        return stats
+
+
+def sizeof_results(res):
+    """ Approximate size of a list of (wiki_id, title) results in bytes. """
+    return sys.getsizeof(res) + sum(sys.getsizeof(item) + sum(sys.getsizeof(x) for x in item)
+                                    for item in res)
@@ -0,0 +1,492 @@
+import io
+import json
+import pickle
+import argparse
+from pathlib import Path
+from contextlib import closing
+import numpy as np
+import bisect
+from inverted_index_gcp import InvertedIndex, MultiFileReader, get_bucket, _open
+from retrieval import BM25_K1, BM25_B
+
+# Where the column files live in the bucket.
+COLUMNS_DIR = 'columns'
+# Files that make up a column store (the body index pickle next to them is not one).
+COLUMN_SUFFIXES = ('.npy', '.bin', '.json')
+
+# meta['N'] counts the documents plus one: it has always been len(nf), and nf
+# holds an 'avg' entry besides the documents. BM25 idf is computed with it, so
+# every N the search engine ranks with (a shard's, the coordinator's) is
+# counted the same way.
+N_EXTRA = 1
+
+# Source pickles the columns are built from (paths inside the bucket).
+BODY_INDEX_PATH = 'bucketBody/indexBody.pkl'
+# The body lengths column index_builder.py writes instead of the nf dict.
+BODY_NF_PATH = 'bucketBody/nf'
+TITLE_INDEX_PATH = 'bucketTitle/indexTitle.pkl'
+TITLES_PATH = 'bucketTitle/dictIdTitle.pkl'
+VIEWS_PATH = 'page_views/pageviews.pkl'
+PAGERANKS_PATH = 'page_ranks/pageRanks.pickle'
+
+
+def _doc_items(mapping):
+    """ Returns the (doc_id, value) pairs of a doc_id keyed dict sorted by doc_id,
+        skipping non-integer keys such as nf["avg"].
+    """
+    return sorted((k, v) for k, v in mapping.items() if isinstance(k, (int, np.integer)))
+
+
+class NumberColumn:
+    """ A doc_id -> number map stored as a sorted doc-id array and an aligned
+        value array. Lookups are binary searches over the ids, and `lookup`
+        resolves a whole array of doc ids at once.
+    """
+    def __init__(self, ids, values, default=0):
+        self.ids = ids
+        self.values = values
+        self.default = default
+
+    @classmethod
+    def build(cls, mapping, dtype, default=0):
+        items = _doc_items(mapping)
+        ids = np.fromiter((k for k, _ in items), dtype=np.int64, count=len(items))
+        values = np.fromiter((v for _, v in items), dtype=dtype, count=len(items))
+        return cls(ids, values, default)
+
+    def write(self, base_dir, name):
+        np.save(Path(base_dir) / f'{name}.ids.npy', self.ids)
+        np.save(Path(base_dir) / f'{name}.values.npy', self.values)
+
+    @classmethod
+    def open(cls, base_dir, name, default=0):
+        """ Maps the column files of `name` under `base_dir` read-only. """
+        ids = np.load(Path(base_dir) / f'{name}.ids.npy', mmap_mode='r')
+        values = np.load(Path(base_dir) / f'{name}.values.npy', mmap_mode='r')
+        return cls(ids, values, default)
+
+    def _find(self, doc_id):
+        i = int(np.searchsorted(self.ids, doc_id))
+        if i < len(self.ids) and self.ids[i] == doc_id:
+            return i
+        return -1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) >= 0
+
+    def __getitem__(self, doc_id):
+        i = self._find(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return self.values[i].item()
+
+    def get(self, doc_id, default=None):
+        i = self._find(doc_id)
+        return (self.default if default is None else default) if i < 0 else self.values[i].item()
+
+    def lookup(self, doc_ids, default=None):
+        """ Returns the values of an array of doc ids, `default` for unknown ids. """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        out = np.full(len(doc_ids), self.default if default is None else default, dtype=self.values.dtype)
+        if len(self.ids) == 0:
+            return out
+        pos = np.minimum(np.searchsorted(self.ids, doc_ids), len(self.ids) - 1)
+        found = self.ids[pos] == doc_ids
+        out[found] = self.values[pos[found]]
+        return out
+
+    def restrict(self, lo, hi):
+        """ Returns the column of the doc ids in [lo, hi). """
+        start, end = np.searchsorted(self.ids, [lo, hi])
+        return NumberColumn(np.array(self.ids[start:end]), np.array(self.values[start:end]), self.default)
+
+
+class DenseColumn:
+    """ A doc_id -> number map stored as one value array indexed by doc_id
+        (minus `offset`, the first doc id it covers), so a lookup is a single
+        array index (or a fancy index for a whole array of doc ids) instead of
+        a binary search. Doc ids without a value hold `default`, as do ids
+        outside the array.
+    """
+    def __init__(self, values, default=0, offset=0):
+        self.values = values
+        self.default = default
+        self.offset = offset
+
+    @classmethod
+    def build(cls, mapping, dtype, default=0):
+        items = _doc_items(mapping)
+        values = np.full(items[-1][0] + 1 if items else 0, default, dtype=dtype)
+        values[[k for k, _ in items]] = [v for _, v in items]
+        return cls(values, default)
+
+    def write(self, base_dir, name):
+        np.save(Path(base_dir) / f'{name}.dense.npy', self.values)
+        if self.offset:
+            with open(Path(base_dir) / f'{name}.dense.json', 'w') as f:
+                json.dump({'offset': int(self.offset)}, f)
+
+    @classmethod
+    def open(cls, base_dir, name, default=0):
+        """ Maps the column file of `name` under `base_dir` read-only. """
+        offset = 0
+        path = Path(base_dir) / f'{name}.dense.json'
+        if path.exists():
+            with open(path) as f:
+                offset = json.load(f)['offset']
+        return cls(np.load(Path(base_dir) / f'{name}.dense.npy', mmap_mode='r'), default, offset)
+
+    @staticmethod
+    def exists(base_dir, name):
+        return (Path(base_dir) / f'{name}.dense.npy').exists()
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, doc_id, default=None):
+        i = doc_id - self.offset
+        if 0 <= i < len(self.values):
+            return self.values[i].item()
+        return self.default if default is None else default
+
+    def lookup(self, doc_ids, default=None):
+        """ Returns the values of an array of doc ids, `default` for ids outside the array. """
+        i = np.asarray(doc_ids, dtype=np.int64) - self.offset
+        default = self.default if default is None else default
+        inside = (i >= 0) & (i < len(self.values))
+        if inside.all():
+            return np.asarray(self.values[i])
+        out = np.full(len(i), default, dtype=self.values.dtype)
+        out[inside] = self.values[i[inside]]
+        return out
+
+    def restrict(self, lo, hi):
+        """ Returns the column of the doc ids in [lo, hi). """
+        lo = max(lo, self.offset)
+        hi = max(lo, min(hi, self.offset + len(self.values)))
+        return DenseColumn(np.array(self.values[lo - self.offset:hi - self.offset]), self.default, lo)
+
+
+class StringColumn:
+    """ A doc_id -> str map stored as a sorted doc-id array, an offsets array
+        and one utf-8 blob holding all strings back to back. String i is
+        blob[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, ids, offsets, blob):
+        self.ids = ids
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def build(cls, mapping):
+        items = _doc_items(mapping)
+        encoded = [str(v).encode('utf-8') for _, v in items]
+        ids = np.fromiter((k for k, _ in items), dtype=np.int64, count=len(items))
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(ids, offsets, b''.join(encoded))
+
+    def write(self, base_dir, name):
+        np.save(Path(base_dir) / f'{name}.ids.npy', self.ids)
+        np.save(Path(base_dir) / f'{name}.offsets.npy', self.offsets)
+        with open(Path(base_dir) / f'{name}.blob.bin', 'wb') as f:
+            f.write(bytes(self.blob))
+
+    @classmethod
+    def open(cls, base_dir, name):
+        ids = np.load(Path(base_dir) / f'{name}.ids.npy', mmap_mode='r')
+        offsets = np.load(Path(base_dir) / f'{name}.offsets.npy', mmap_mode='r')
+        path = Path(base_dir) / f'{name}.blob.bin'
+        # np.memmap refuses empty files.
+        blob = np.memmap(path, dtype=np.uint8, mode='r') if path.stat().st_size > 0 else b''
+        return cls(ids, offsets, blob)
+
+    def _find(self, doc_id):
+        i = int(np.searchsorted(self.ids, doc_id))
+        if i < len(self.ids) and self.ids[i] == doc_id:
+            return i
+        return -1
+
+    def _string(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, doc_id):
+        return self._find(doc_id) >= 0
+
+    def __getitem__(self, doc_id):
+        i = self._find(doc_id)
+        if i < 0:
+            raise KeyError(doc_id)
+        return self._string(i)
+
+    def get(self, doc_id, default=None):
+        i = self._find(doc_id)
+        return default if i < 0 else self._string(i)
+
+    def restrict(self, lo, hi):
+        """ Returns the column of the doc ids in [lo, hi). """
+        start, end = np.searchsorted(self.ids, [lo, hi])
+        offsets = np.array(self.offsets[start:end + 1])
+        return StringColumn(np.array(self.ids[start:end]), offsets - offsets[0],
+                            bytes(self.blob[offsets[0]:offsets[-1]]))
+
+    def lookup(self, doc_ids, default=''):
+        """ Returns the strings of an array of doc ids as a list, `default` for
+            unknown ids, with one binary search over the whole array.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            return [default] * len(doc_ids)
+        pos = np.minimum(np.searchsorted(self.ids, doc_ids), len(self.ids) - 1)
+        found = (self.ids[pos] == doc_ids).tolist()
+        return [self._string(i) if ok else default for i, ok in zip(pos.tolist(), found)]
+
+
+class TermTable:
+    """ A sorted list of terms stored as an offsets array over one utf-8 blob.
+        Term i is blob[offsets[i]:offsets[i + 1]], and a term's position is
+        found by binary search.
+    """
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def build(cls, terms):
+        encoded = [t.encode('utf-8') for t in sorted(terms)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(offsets, b''.join(encoded))
+
+    def write(self, base_dir, name):
+        np.save(Path(base_dir) / f'{name}.offsets.npy', self.offsets)
+        with open(Path(base_dir) / f'{name}.blob.bin', 'wb') as f:
+            f.write(bytes(self.blob))
+
+    @classmethod
+    def open(cls, base_dir, name):
+        offsets = np.load(Path(base_dir) / f'{name}.offsets.npy', mmap_mode='r')
+        path = Path(base_dir) / f'{name}.blob.bin'
+        blob = np.memmap(path, dtype=np.uint8, mode='r') if path.stat().st_size > 0 else b''
+        return cls(offsets, blob)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def index(self, term):
+        """ Returns the position of `term`, or -1 if it is not in the table. """
+        i = bisect.bisect_left(self, term)
+        return i if i < len(self) and self[i] == term else -1
+
+
+class TitlePostings:
+    """ The title index in CSR form: the postings of the i-th term of `terms`
+        are doc_ids[offsets[i]:offsets[i + 1]], sorted by doc_id, and `prior`
+        holds 1 + views + pagerank of each of those docs alongside.
+    """
+    def __init__(self, terms, offsets, doc_ids, prior):
+        self.terms = terms
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.prior = prior
+
+    @classmethod
+    def build(cls, title_tf, views, pagerank):
+        """ Builds the arrays from the title index `tf` dict (term -> list of
+            (doc_id, tf)) and the views and pagerank columns.
+        """
+        terms = TermTable.build(title_tf.keys())
+        lists = [title_tf[terms[i]] for i in range(len(terms))]
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum([len(pl) for pl in lists], out=offsets[1:])
+        doc_ids = np.fromiter((doc_id for pl in lists for doc_id, _ in pl), dtype=np.int64, count=offsets[-1])
+        prior = 1 + views.lookup(doc_ids, 0) + pagerank.lookup(doc_ids, 0)
+        return cls(terms, offsets, doc_ids, prior)
+
+    @classmethod
+    def read(cls, index_title, views, pagerank, base_dir='.', bucket_name=None):
+        """ Builds the arrays from a title index that keeps its lists in
+            posting files (see index_builder.py), read one list at a time.
+        """
+        terms = TermTable.build(index_title.posting_locs.keys())
+        with closing(MultiFileReader(base_dir, bucket_name)) as reader:
+            lists = [index_title._read_postings(reader, terms[i]).doc_ids for i in range(len(terms))]
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum([len(ids) for ids in lists], out=offsets[1:])
+        doc_ids = np.concatenate(lists).astype(np.int64) if lists else np.empty(0, dtype=np.int64)
+        prior = 1 + views.lookup(doc_ids, 0) + pagerank.lookup(doc_ids, 0)
+        return cls(terms, offsets, doc_ids, prior)
+
+    def write(self, base_dir, name):
+        self.terms.write(base_dir, f'{name}.terms')
+        np.save(Path(base_dir) / f'{name}.offsets.npy', self.offsets)
+        np.save(Path(base_dir) / f'{name}.doc_ids.npy', self.doc_ids)
+        np.save(Path(base_dir) / f'{name}.prior.npy', self.prior)
+
+    @classmethod
+    def open(cls, base_dir, name):
+        return cls(TermTable.open(base_dir, f'{name}.terms'),
+                   np.load(Path(base_dir) / f'{name}.offsets.npy', mmap_mode='r'),
+                   np.load(Path(base_dir) / f'{name}.doc_ids.npy', mmap_mode='r'),
+                   np.load(Path(base_dir) / f'{name}.prior.npy', mmap_mode='r'))
+
+    def restrict(self, lo, hi):
+        """ Returns the postings of the doc ids in [lo, hi), over the same terms. """
+        keep = (self.doc_ids >= lo) & (self.doc_ids < hi)
+        kept = np.concatenate(([0], np.cumsum(keep)))
+        return TitlePostings(self.terms, kept[self.offsets], np.array(self.doc_ids[keep]), np.array(self.prior[keep]))
+
+    def postings(self, term):
+        """ Returns the (doc_ids, prior) array slices of `term` (empty if unknown). """
+        i = self.terms.index(term)
+        if i < 0:
+            return self.doc_ids[:0], self.prior[:0]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.doc_ids[start:end], self.prior[start:end]
+
+
+class ColumnStore:
+    """ The doc_id keyed globals of the search engine as column files:
+        body_nf (body length), views (page views), pagerank and titles, the
+        title index postings (title_postings), plus a small meta.json with
+        corpus statistics.
+    """
+    def __init__(self, body_nf, views, pagerank, titles, title_postings, meta):
+        self.body_nf = body_nf
+        self.views = views
+        self.pagerank = pagerank
+        self.titles = titles
+        self.title_postings = title_postings
+        self.meta = meta
+
+    @classmethod
+    def build(cls, index_body, index_title, titles, views, pageranks, body_nf=None,
+              base_dir='.', bucket_name=None):
+        """ Builds the columns from the objects stored in the existing pickles.
+        Parameters:
+        -----------
+          index_body: InvertedIndex of the body, only its `nf` is used.
+          index_title: InvertedIndex of the titles, only its `tf` is used, or
+                       its posting files if it has no `tf`.
+          titles: dict (or InvertedIndex with a `tf` dict) mapping doc_id to title.
+          views: dict mapping doc_id to page views.
+          pageranks: dict mapping doc_id to PageRank.
+          body_nf: NumberColumn of the body lengths, for a body index whose
+                   `nf` only holds 'avg' (see index_builder.py).
+          base_dir, bucket_name: where the title posting files are read from.
+        """
+        titles = getattr(titles, 'tf', titles)
+        if body_nf is None:
+            body_nf = NumberColumn.build(index_body.nf, np.uint32)
+        meta = {'N': len(body_nf.ids) + N_EXTRA, 'avg': index_body.nf['avg']}
+        # Page views and PageRank are looked up for arbitrary lists of doc ids
+        # (see /get_pageview and /get_pagerank), so they are dense columns.
+        views_dtype = np.uint32 if max(views.values(), default=0) < 2**32 else np.int64
+        views = DenseColumn.build(views, views_dtype)
+        pagerank = DenseColumn.build(pageranks, np.float64)
+        if index_title.tf:
+            title_postings = TitlePostings.build(index_title.tf, views, pagerank)
+        else:
+            title_postings = TitlePostings.read(index_title, views, pagerank, base_dir, bucket_name)
+        return cls(NumberColumn(body_nf.ids, body_nf.values.astype(np.uint32)),
+                   views,
+                   pagerank,
+                   StringColumn.build(titles),
+                   title_postings,
+                   meta)
+
+    def write(self, base_dir):
+        base_dir = Path(base_dir)
+        base_dir.mkdir(parents=True, exist_ok=True)
+        self.body_nf.write(base_dir, 'body_nf')
+        self.views.write(base_dir, 'views')
+        self.pagerank.write(base_dir, 'pagerank')
+        self.titles.write(base_dir, 'titles')
+        self.title_postings.write(base_dir, 'title_postings')
+        with open(base_dir / 'meta.json', 'w') as f:
+            json.dump(self.meta, f)
+
+    @classmethod
+    def open(cls, base_dir):
+        base_dir = Path(base_dir)
+        with open(base_dir / 'meta.json') as f:
+            meta = json.load(f)
+        # Stores written before the dense columns keep views and PageRank sparse.
+        number_column = DenseColumn if DenseColumn.exists(base_dir, 'views') else NumberColumn
+        return cls(NumberColumn.open(base_dir, 'body_nf'),
+                   number_column.open(base_dir, 'views'),
+                   number_column.open(base_dir, 'pagerank'),
+                   StringColumn.open(base_dir, 'titles'),
+                   TitlePostings.open(base_dir, 'title_postings'),
+                   meta)
+
+
+def _load_pickle(path, bucket, source_dir='.'):
+    if bucket is None:
+        path = str(Path(source_dir) / path)
+    with _open(path, 'rb', bucket) as f:
+        return pickle.load(f)
+
+
+def _load_number_column(path, bucket, source_dir='.'):
+    """ Returns the NumberColumn written at `path`, or None if there is none. """
+    arrays = []
+    for part in ('ids', 'values'):
+        f_name = f'{path}.{part}.npy'
+        if bucket is None:
+            if not (Path(source_dir) / f_name).exists():
+                return None
+            arrays.append(np.load(Path(source_dir) / f_name))
+        else:
+            blob = bucket.get_blob(f_name)
+            if blob is None:
+                return None
+            arrays.append(np.load(io.BytesIO(blob.download_as_bytes())))
+    return NumberColumn(*arrays)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the column store from the index pickles.')
+    parser.add_argument('--bucket', default='irproject-414719bucket',
+                        help='bucket holding the index pickles; empty to read them from --source-dir')
+    parser.add_argument('--source-dir', default='.', help='local directory laid out like the bucket')
+    parser.add_argument('--out', default=COLUMNS_DIR, help='local output directory')
+    parser.add_argument('--upload', action='store_true', help=f'copy the result to {COLUMNS_DIR}/ in the bucket')
+    args = parser.parse_args()
+
+    bucket = get_bucket(args.bucket) if args.bucket else None
+    if args.upload and bucket is None:
+        parser.error('--upload needs --bucket')
+    index_body = _load_pickle(BODY_INDEX_PATH, bucket, args.source_dir)
+    store = ColumnStore.build(index_body,
+                              _load_pickle(TITLE_INDEX_PATH, bucket, args.source_dir),
+                              _load_pickle(TITLES_PATH, bucket, args.source_dir),
+                              _load_pickle(VIEWS_PATH, bucket, args.source_dir),
+                              _load_pickle(PAGERANKS_PATH, bucket, args.source_dir),
+                              _load_number_column(BODY_NF_PATH, bucket, args.source_dir),
+                              '.' if bucket else args.source_dir, args.bucket or None)
+    store.write(args.out)
+
+    # The body index without nf, which now lives in the body_nf column, and
+    # with the per-term BM25 upper bounds used for pruning.
+    index_body.compute_upper_bounds('.' if bucket else args.source_dir, store.body_nf.lookup,
+                                    store.meta['avg'], BM25_K1, BM25_B, args.bucket or None)
+    index_body.nf = {}
+    index_body.write_index(args.out, 'indexBody')
+
+    if args.upload:
+        for path in Path(args.out).iterdir():
+            bucket.blob(f'{COLUMNS_DIR}/{path.name}').upload_from_filename(str(path))
+
+
+if __name__ == '__main__':
+    main()
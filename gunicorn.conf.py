@@ -0,0 +1,41 @@
+# Production serving: gunicorn -c gunicorn.conf.py search_frontend:app
+#
+# The master process imports search_frontend once and loads every index before
+# forking the workers (preload_app with INDEX_WARMUP=sync). The workers share
+# the index pages: the column store and the posting files are memory mapped,
+# and the unpickled dictionaries stay shared copy-on-write, since gc.freeze()
+# keeps the garbage collector from writing to them.
+import gc
+import os
+import multiprocessing
+
+os.environ.setdefault('INDEX_WARMUP', 'sync')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+preload_app = True
+
+# One worker per core. Each worker serves `threads` requests at a time, so a
+# request waiting on a posting read does not hold up the others. Caches and
+# metrics are per worker: POSTING_CACHE_MB and RESULT_CACHE_MB are taken once
+# per worker, and /metrics reports the worker that answered it.
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('WORKER_THREADS', 4))
+
+# With gthread workers `timeout` is a heartbeat: a worker is restarted (forked
+# again from the master) only if it stops responding to the master for that
+# long, and a slow request on one of its threads never trips it. Requests are
+# bounded by the app itself instead, which answers 503 once a request has run
+# for REQUEST_TIMEOUT seconds (see search_frontend.request_timeout).
+timeout = int(os.environ.get('WORKER_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+
+accesslog = os.environ.get('ACCESS_LOG', '-')
+
+
+def when_ready(server):
+    # Everything allocated so far (the loaded indexes) is moved out of the
+    # collector's reach, so collections in the workers never touch its pages.
+    gc.collect()
+    gc.freeze()
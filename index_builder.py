@@ -0,0 +1,342 @@
+import os
+import glob
+import heapq
+import pickle
+import shutil
+import hashlib
+import argparse
+import tempfile
+from pathlib import Path
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from analyzer import Analyzer
+from inverted_index_gcp import InvertedIndex, PostingList, POSTING_FORMAT
+from columnar_store import NumberColumn
+from retrieval import bm25_tf_weight, BM25_K1, BM25_B
+
+NUM_BUCKETS = 124
+
+
+def _hash(s):
+    return hashlib.blake2b(bytes(s, encoding='utf8'), digest_size=5).hexdigest()
+
+
+def token2bucket_id(token):
+    return int(_hash(token), 16) % NUM_BUCKETS
+
+
+# What each index is built from, where it goes, and which posting lists it keeps.
+KINDS = {
+    'body': {'column': 'text', 'base_dir': 'bucketBody', 'name': 'indexBody', 'min_df': 20},
+    'anchor': {'column': 'anchor_text', 'base_dir': 'bucketAnchorText', 'name': 'indexAnchorText', 'min_df': 20},
+    'title': {'column': 'title', 'base_dir': 'bucketTitle', 'name': 'indexTitle', 'min_df': 0},
+}
+
+# Postings held in memory before they are spilled to a sorted run on disk.
+SPILL_POSTINGS = 20_000_000
+
+# The (doc_id, length) records of the body documents, appended to a file as
+# batches are tokenized.
+LENGTH_DTYPE = np.dtype([('doc_id', '<i8'), ('length', '<i4')])
+
+# The tokenization shared with the search engine (see analyzer.py), one stem
+# cache per worker process.
+analyzer = Analyzer()
+
+
+def tokenize(text):
+    """ Returns the stems of the non-stopword tokens of `text`. """
+    return analyzer.tokens(text)
+
+
+def word_count(text, id):
+    """ Returns the (stem, (id, tf)) postings of a document and its length. """
+    stems = tokenize(text)
+    return [(w, (id, count)) for w, count in Counter(stems).items()], len(stems)
+
+
+def anchor_count(ListOfAnchors, id):
+    """ Returns the distinct (stem, (id, destId)) postings of a page's anchors. """
+    pairs = set()
+    for anchor in ListOfAnchors:
+        destId, text = (anchor['id'], anchor['text']) if isinstance(anchor, dict) else anchor
+        pairs.update((w, (id, destId)) for w in tokenize(text))
+    return list(pairs)
+
+
+def tokenize_batch(kind, values, ids):
+    """ Tokenizes one batch of documents in a worker process.
+    Returns:
+    --------
+      (postings, lengths): postings maps each stem to its (doc_id, tf) list in
+      the batch, lengths is a LENGTH_DTYPE array of the documents that have
+      any postings (empty for anchors).
+    """
+    postings = defaultdict(list)
+    lengths = []
+    for value, id in zip(values, ids):
+        if value is None:
+            continue
+        if kind == 'anchor':
+            pl = anchor_count(value, id)
+        else:
+            pl, length = word_count(value, id)
+            if pl:
+                lengths.append((id, length))
+        for w, posting in pl:
+            postings[w].append(posting)
+    return dict(postings), np.array(lengths, dtype=LENGTH_DTYPE)
+
+
+def read_batches(paths, column, batch_size):
+    """ Streams (values, ids) batches of `column` out of parquet files. """
+    import pyarrow.parquet as pq
+    for path in paths:
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=[column, 'id']):
+            yield batch.column(0).to_pylist(), batch.column(1).to_pylist()
+
+
+class RunWriter:
+    """ Collects postings in memory and spills them, once there are more than
+        `max_postings`, to a sorted run per bucket under `run_dir`:
+        `run_dir/{run}/{bucket_id}.pkl`, a stream of pickled (term, postings)
+        records in term order, where postings is an (n, 2) array of (doc_id,
+        tf) rows.
+    """
+    def __init__(self, run_dir, max_postings=SPILL_POSTINGS):
+        self._run_dir = Path(run_dir)
+        self._max_postings = max_postings
+        self._postings = defaultdict(list)
+        self._n_postings = 0
+        self.n_runs = 0
+
+    def add(self, postings):
+        for w, pl in postings.items():
+            self._postings[w].extend(pl)
+            self._n_postings += len(pl)
+        if self._n_postings > self._max_postings:
+            self.spill()
+
+    def spill(self):
+        if not self._postings:
+            return
+        run = self._run_dir / str(self.n_runs)
+        run.mkdir(parents=True)
+        buckets = defaultdict(list)
+        for w in sorted(self._postings):
+            buckets[token2bucket_id(w)].append(w)
+        for bucket_id, terms in buckets.items():
+            with open(run / f'{bucket_id}.pkl', 'wb') as f:
+                for w in terms:
+                    pickle.dump((w, np.array(self._postings[w], dtype=np.int64)), f, pickle.HIGHEST_PROTOCOL)
+        self._postings.clear()
+        self._n_postings = 0
+        self.n_runs += 1
+
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _sorted_postings(parts):
+    """ Returns the PostingList of the (doc_id, tf) rows of `parts`, sorted by
+        doc_id then tf.
+    """
+    rows = np.concatenate(parts)
+    order = np.lexsort((rows[:, 1], rows[:, 0]))
+    return PostingList(rows[order, 0], rows[order, 1])
+
+
+def merge_runs(paths, min_df=0):
+    """ K-way merges sorted runs into (term, PostingList) pairs in term order,
+        keeping only the terms whose posting list is longer than `min_df`.
+    """
+    merged = heapq.merge(*[read_run(path) for path in paths], key=lambda record: record[0])
+    term, parts, n = None, [], 0
+    for w, postings in merged:
+        if w != term:
+            if term is not None and n > min_df:
+                yield term, _sorted_postings(parts)
+            term, parts, n = w, [], 0
+        parts.append(postings)
+        n += len(postings)
+    if term is not None and n > min_df:
+        yield term, _sorted_postings(parts)
+
+
+def write_lengths(path, out_dir):
+    """ Sorts the LENGTH_DTYPE records of the file `path` by doc_id into the
+        NumberColumn `nf` under `out_dir` (the last length of a doc_id seen
+        twice wins).
+    Returns:
+    --------
+      (number of documents, average length).
+    """
+    records = np.fromfile(path, dtype=LENGTH_DTYPE) if os.path.getsize(path) else np.empty(0, LENGTH_DTYPE)
+    order = np.argsort(records['doc_id'], kind='stable')
+    ids, lengths = records['doc_id'][order], records['length'][order]
+    del records, order
+    last = np.append(ids[1:] != ids[:-1], True)
+    ids, lengths = ids[last], lengths[last]
+    NumberColumn(ids, lengths.astype(np.int32)).write(out_dir, 'nf')
+    return len(ids), int(lengths.sum()) / len(ids) if len(ids) else 0
+
+
+def merge_bucket(bucket_id, paths, out_dir, base_dir, min_df, version, lengths_dir=None, avg_length=None):
+    """ Merges the runs of one bucket into its posting files under
+        `out_dir`/`base_dir`, with the posting files named relative to
+        `out_dir`.
+    Returns:
+    --------
+      (df, max_scores, posting_locs) of the bucket's terms. max_scores holds
+      the BM25 upper bounds (see InvertedIndex.compute_upper_bounds) when
+      `lengths_dir` has the document lengths (averaging `avg_length`),
+      otherwise it is empty.
+    """
+    df, max_scores = {}, {}
+    lengths = None if lengths_dir is None else NumberColumn.open(lengths_dir, 'nf')
+
+    def postings():
+        for w, pl in merge_runs(paths, min_df):
+            df[w] = len(pl)
+            if lengths is not None:
+                B = 1 - BM25_B + BM25_B * (lengths.lookup(pl.doc_ids, 0) / avg_length)
+                max_scores[w] = float(np.max(bm25_tf_weight(pl.tfs.astype(np.float64), B, BM25_K1), initial=0.0))
+            yield w, pl
+
+    posting_dir = Path(out_dir) / base_dir
+    InvertedIndex.write_a_posting_list((bucket_id, postings()), posting_dir, version=version)
+    locs_path = posting_dir / f'{bucket_id}_posting_locs.pickle'
+    with open(locs_path, 'rb') as f:
+        posting_locs = {w: [(os.path.relpath(f_name, out_dir), offset) for f_name, offset in locs]
+                        for w, locs in pickle.load(f).items()}
+    with open(locs_path, 'wb') as f:
+        pickle.dump(posting_locs, f)
+    return df, max_scores, posting_locs
+
+
+def build(kind, paths, out_dir, workers=os.cpu_count(), batch_size=1000,
+          spill_postings=SPILL_POSTINGS, version=POSTING_FORMAT, min_df=None, tmp_dir=None,
+          impact_prefix=0, impact_min_df=None):
+    """ Builds the `kind` index ('body', 'anchor' or 'title') of the parquet
+        files `paths` under `out_dir`, in the layout the notebooks write to the
+        bucket, except that every index keeps its lists in posting files and
+        the body lengths go to the `nf` column next to the body index instead
+        of its `nf` dict. Memory use is bounded by `spill_postings` postings
+        plus the longest posting list as arrays, and 20 bytes per body
+        document while the lengths are sorted. With `impact_prefix`, the body
+        and anchor lists longer than `impact_min_df` postings also get an
+        impact-ordered prefix of that many documents (see
+        InvertedIndex.write_impact_prefixes).
+    """
+    spec = KINDS[kind]
+    min_df = spec['min_df'] if min_df is None else min_df
+    out_dir = Path(out_dir).resolve()
+    (out_dir / spec['base_dir']).mkdir(parents=True, exist_ok=True)
+    run_dir = Path(tempfile.mkdtemp(prefix=f'{kind}-runs-', dir=tmp_dir)).resolve()
+    try:
+        # Tokenize with a bounded number of batches in flight, so reading the
+        # parquet files never runs ahead of the workers.
+        runs = RunWriter(run_dir, spill_postings)
+        lengths_path = run_dir / 'lengths.bin'
+        with ProcessPoolExecutor(workers) as pool, open(lengths_path, 'wb') as lengths_file:
+            pending = deque()
+            for values, ids in read_batches(paths, spec['column'], batch_size):
+                pending.append(pool.submit(tokenize_batch, kind, values, ids))
+                if len(pending) >= 2 * workers:
+                    postings, lengths = pending.popleft().result()
+                    runs.add(postings)
+                    if kind == 'body':
+                        lengths_file.write(lengths.tobytes())
+            while pending:
+                postings, lengths = pending.popleft().result()
+                runs.add(postings)
+                if kind == 'body':
+                    lengths_file.write(lengths.tobytes())
+        runs.spill()
+
+        bucket_runs = defaultdict(list)
+        for run in range(runs.n_runs):
+            for path in (run_dir / str(run)).iterdir():
+                bucket_runs[int(path.stem)].append(path)
+
+        inverted = InvertedIndex()
+        lengths_dir, avg_length = None, None
+        if kind == 'body':
+            # Document lengths for BM25, shared with the merge workers and
+            # kept next to the body index as a column file.
+            lengths_dir = out_dir / spec['base_dir']
+            n_docs, avg_length = write_lengths(lengths_path, lengths_dir)
+            inverted.max_scores = {}
+            inverted.max_scores_params = (BM25_K1, BM25_B)
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(merge_bucket, bucket_id, bucket_paths, str(out_dir), spec['base_dir'],
+                                   min_df, version, lengths_dir, avg_length)
+                       for bucket_id, bucket_paths in bucket_runs.items()]
+            for future in futures:
+                df, max_scores, posting_locs = future.result()
+                inverted.df.update(df)
+                if kind == 'body':
+                    inverted.max_scores.update(max_scores)
+                for w, locs in posting_locs.items():
+                    inverted.posting_locs[w].extend(locs)
+        if impact_prefix and kind == 'body':
+            inverted.write_impact_prefixes(str(out_dir), impact_prefix, impact_min_df,
+                                           NumberColumn.open(lengths_dir, 'nf').lookup, avg_length,
+                                           BM25_K1, BM25_B)
+        elif impact_prefix and kind == 'anchor':
+            inverted.write_impact_prefixes(str(out_dir), impact_prefix, impact_min_df)
+        if kind == 'body':
+            # Only the average, the lengths themselves are in the nf column.
+            inverted.nf = {'avg': avg_length}
+        inverted.write_index(str(out_dir / spec['base_dir']), spec['name'])
+        return inverted
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def build_titles(paths, out_dir, batch_size=1000):
+    """ Writes the doc_id -> title map (dictIdTitle.pkl) of the parquet files. """
+    titles = InvertedIndex()
+    for values, ids in read_batches(paths, 'title', batch_size):
+        titles.tf.update(zip(ids, values))
+    base_dir = Path(out_dir) / KINDS['title']['base_dir']
+    base_dir.mkdir(parents=True, exist_ok=True)
+    titles.write_index(str(base_dir), 'dictIdTitle')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build an index from the preprocessed parquet files on one machine.')
+    parser.add_argument('kind', choices=sorted(KINDS))
+    parser.add_argument('parquet', nargs='+', help='parquet files or glob patterns')
+    parser.add_argument('--out', default='.', help='output directory (laid out like the bucket)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=1000, help='documents per tokenization task')
+    parser.add_argument('--spill-postings', type=int, default=SPILL_POSTINGS,
+                        help='postings held in memory before spilling a run to disk')
+    parser.add_argument('--min-df', type=int, help='drop posting lists of at most this many postings')
+    parser.add_argument('--format', type=int, default=POSTING_FORMAT, help='posting file format version')
+    parser.add_argument('--tmp-dir', help='where sorted runs are spilled')
+    parser.add_argument('--impact-prefix', type=int, default=0,
+                        help='documents in the impact-ordered prefix of each long body or anchor list (0: none)')
+    parser.add_argument('--impact-min-df', type=int,
+                        help='lists of more postings than this get a prefix (default: --impact-prefix)')
+    args = parser.parse_args()
+
+    paths = sorted(p for pattern in args.parquet for p in glob.glob(pattern))
+    if not paths:
+        parser.error('no parquet files found')
+    build(args.kind, paths, args.out, args.workers, args.batch_size, args.spill_postings,
+          args.format, args.min_df, args.tmp_dir, args.impact_prefix, args.impact_min_df)
+    if args.kind == 'title':
+        build_titles(paths, args.out, args.batch_size)
+
+
+if __name__ == '__main__':
+    main()
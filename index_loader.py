@@ -0,0 +1,194 @@
+import os
+import pickle
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from inverted_index_gcp import get_bucket
+
+# Local directory that index blobs are cached in between restarts.
+INDEX_CACHE_DIR = os.environ.get('INDEX_CACHE_DIR', 'index_cache')
+
+
+def load_pickle(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class LazyIndex:
+    """ Stand-in for an index that is deserialized on first use. Attribute and
+        item access are forwarded to the loaded object, so code written against
+        the index itself keeps working.
+    """
+    def __init__(self, name, load):
+        self._name = name
+        self._load = load
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        """ Returns the index, loading it first if nobody has yet. """
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._value = self._load()
+                    self._loaded = True
+        return self._value
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+    def __contains__(self, key):
+        return key in self.get()
+
+    def __len__(self):
+        return len(self.get())
+
+    def __repr__(self):
+        return f'LazyIndex({self._name!r}, loaded={self._loaded})'
+
+
+class IndexLoader:
+    """ Loads the global indexes of the search engine. Blobs are downloaded into
+        a local cache directory next to a `.generation` file holding the blob
+        generation, so a restart only downloads blobs that changed. Each index
+        is deserialized lazily on first use, or all at once by warm_up(). The
+        blobs of a directory are downloaded in parallel by a pool of
+        `max_workers` threads, separate from the one warm_up() loads indexes
+        with, so loading an index never waits on downloads queued behind it.
+        With bucket_name=None, paths are read from `base_dir` directly.
+    """
+    def __init__(self, bucket_name, cache_dir=INDEX_CACHE_DIR, base_dir='.', max_workers=8):
+        self._bucket_name = bucket_name
+        self._bucket = None
+        self._cache_dir = Path(cache_dir)
+        self._base_dir = Path(base_dir)
+        self._max_workers = max_workers
+        self._indexes = {}
+        self._fetch_pool = None
+        self._path_locks = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._error = None
+
+    def _get_bucket(self):
+        with self._lock:
+            if self._bucket is None:
+                self._bucket = get_bucket(self._bucket_name)
+            return self._bucket
+
+    def _get_fetch_pool(self):
+        with self._lock:
+            if self._fetch_pool is None:
+                self._fetch_pool = ThreadPoolExecutor(self._max_workers, thread_name_prefix='index-fetch')
+            return self._fetch_pool
+
+    def _path_lock(self, path):
+        with self._lock:
+            return self._path_locks.setdefault(path, threading.Lock())
+
+    def _fetch_blob(self, blob):
+        """ Returns the cached copy of `blob`, downloading it if the cached
+            generation is missing or stale.
+        """
+        path = self._cache_dir / blob.name
+        generation_path = path.with_name(f'{path.name}.generation')
+        with self._path_lock(blob.name):
+            if path.exists() and generation_path.exists() \
+                    and generation_path.read_text() == str(blob.generation):
+                return path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+            blob.download_to_filename(str(tmp))
+            os.replace(tmp, path)
+            generation_path.write_text(str(blob.generation))
+        return path
+
+    def fetch(self, path):
+        """ Returns a local path holding the current contents of blob `path`. """
+        if self._bucket_name is None:
+            return self._base_dir / path
+        blob = self._get_bucket().get_blob(path)
+        if blob is None:
+            raise FileNotFoundError(f'gs://{self._bucket_name}/{path}')
+        return self._fetch_blob(blob)
+
+    def fetch_dir(self, prefix, suffixes=None):
+        """ Fetches every blob under `prefix` (ending with one of `suffixes`, if
+            given) in parallel and returns the local directory that mirrors
+            `prefix`.
+        """
+        if self._bucket_name is None:
+            return self._base_dir / prefix
+        blobs = self._get_bucket().client.list_blobs(self._bucket_name, prefix=f'{prefix}/')
+        pool = self._get_fetch_pool()
+        futures = [pool.submit(self._fetch_blob, blob) for blob in blobs
+                   if suffixes is None or blob.name.endswith(tuple(suffixes))]
+        fetched = {future.result() for future in futures}
+        local_dir = self._cache_dir / prefix
+        self._drop_stale(local_dir, fetched, suffixes)
+        return local_dir
+
+    def _drop_stale(self, local_dir, fetched, suffixes=None):
+        """ Deletes the cached files under `local_dir` (ending with one of
+            `suffixes`, if given) that are not in `fetched`, i.e. whose blob is
+            gone from the bucket, along with their `.generation` files.
+        """
+        for generation_path in local_dir.rglob('*.generation'):
+            path = generation_path.with_suffix('')
+            if path in fetched or (suffixes is not None and not path.name.endswith(tuple(suffixes))):
+                continue
+            with self._path_lock(path.relative_to(self._cache_dir).as_posix()):
+                path.unlink(missing_ok=True)
+                generation_path.unlink(missing_ok=True)
+
+    def register(self, path, load=load_pickle):
+        """ Registers the blob at `path`, deserialized by `load(local_path)`. """
+        index = LazyIndex(path, lambda: load(self.fetch(path)))
+        self._indexes[path] = index
+        return index
+
+    def register_dir(self, prefix, load, suffixes=None):
+        """ Registers every blob under `prefix`, opened by `load(local_dir)`. """
+        index = LazyIndex(prefix, lambda: load(self.fetch_dir(prefix, suffixes)))
+        self._indexes[prefix] = index
+        return index
+
+    def warm_up(self, background=True, after=None):
+        """ Fetches and deserializes every registered index concurrently, then
+            calls `after()` (if given) and marks the loader ready.
+        """
+        if background:
+            threading.Thread(target=self.warm_up, args=(False, after),
+                             name='index-warm-up', daemon=True).start()
+            return
+        try:
+            with ThreadPoolExecutor(self._max_workers) as pool:
+                futures = [pool.submit(index.get) for index in self._indexes.values()]
+                for future in as_completed(futures):
+                    future.result()
+            if after is not None:
+                after()
+            self._ready.set()
+        except Exception as e:
+            self._error = e
+            raise
+
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout=None):
+        return self._ready.wait(timeout)
+
+    def status(self):
+        """ Returns a JSON-friendly summary of what has been loaded so far. """
+        return {'ready': self.ready(),
+                'error': None if self._error is None else repr(self._error),
+                'indexes': {name: index.loaded for name, index in self._indexes.items()}}
@@ -9,6 +9,9 @@ from operator import itemgetter
 from time import time
 from pathlib import Path
 import pickle
+import mmap
+import threading
+import numpy as np
 from google.cloud import storage
 from collections import defaultdict
 from contextlib import closing
@@ -25,16 +28,35 @@ def _open(path, mode, bucket=None):
 # Let's start with a small block size of 30 bytes just to test things out. 
 BLOCK_SIZE = 1999998
 
+# Posting file formats. Version 1 files are raw fixed-size postings with no
+# header. Version 2 files start with FORMAT_V2_MAGIC and hold compressed posting
+# lists (see encode_posting_list). A version 1 file can not start with the magic
+# bytes, since they would decode to a doc_id above 1.2 billion.
+POSTING_FORMAT_V1 = 1
+POSTING_FORMAT_V2 = 2
+FORMAT_V2_MAGIC = b'IRPL\x00\x00\x00\x02'
+# Format written by default.
+POSTING_FORMAT = POSTING_FORMAT_V2
+
 class MultiFileWriter:
-    """ Sequential binary writer to multiple files of up to BLOCK_SIZE each. """
-    def __init__(self, base_dir, name, bucket_name=None):
+    """ Sequential binary writer to multiple files of up to BLOCK_SIZE each.
+        Files of `version` 2 start with FORMAT_V2_MAGIC.
+    """
+    def __init__(self, base_dir, name, bucket_name=None, version=POSTING_FORMAT_V1):
         self._base_dir = Path(base_dir)
         self._name = name
+        self._version = version
         self._bucket = None if bucket_name is None else get_bucket(bucket_name)
         self._file_gen = (_open(str(self._base_dir / f'{name}_{i:03}.bin'), 
                                 'wb', self._bucket) 
                           for i in itertools.count())
-        self._f = next(self._file_gen)
+        self._f = self._next_file()
+
+    def _next_file(self):
+        f = next(self._file_gen)
+        if self._version == POSTING_FORMAT_V2:
+            f.write(FORMAT_V2_MAGIC)
+        return f
            
     def write(self, b):
         locs = []
@@ -44,8 +66,9 @@ class MultiFileWriter:
             # if the current file is full, close and open a new one.
             if remaining == 0:  
                 self._f.close()
-                self._f = next(self._file_gen)
-                pos, remaining = 0, BLOCK_SIZE
+                self._f = self._next_file()
+                pos = self._f.tell()
+                remaining = BLOCK_SIZE - pos
             self._f.write(b[:remaining])
             name = self._f.name if hasattr(self._f, 'name') else self._f._blob.name
             locs.append((name, pos))
@@ -55,20 +78,38 @@ class MultiFileWriter:
     def close(self):
         self._f.close()
 
+def file_version(head):
+    """ Returns the posting format of a file starting with the bytes `head`. """
+    return POSTING_FORMAT_V2 if head == FORMAT_V2_MAGIC else POSTING_FORMAT_V1
+
 class MultiFileReader:
     """ Sequential binary reader of multiple files of up to BLOCK_SIZE each. """
     def __init__(self, base_dir, bucket_name=None):
         self._base_dir = Path(base_dir)
         self._bucket = None if bucket_name is None else get_bucket(bucket_name)
         self._open_files = {}
+        self._versions = {}
+
+    def _file(self, f_name):
+        f_name = str(self._base_dir / f_name)
+        if f_name not in self._open_files:
+            self._open_files[f_name] = _open(f_name, 'rb', self._bucket)
+        return self._open_files[f_name]
+
+    def version(self, f_name):
+        """ Returns the posting format of file `f_name`, read from its header. """
+        if f_name not in self._versions:
+            f = self._file(f_name)
+            f.seek(0)
+            self._versions[f_name] = file_version(f.read(len(FORMAT_V2_MAGIC)))
+        return self._versions[f_name]
 
     def read(self, locs, n_bytes):
         b = []
         for f_name, offset in locs:
-            f_name = str(self._base_dir / f_name)
-            if f_name not in self._open_files:
-                self._open_files[f_name] = _open(f_name, 'rb', self._bucket)
-            f = self._open_files[f_name]
+            if n_bytes <= 0:
+                break
+            f = self._file(f_name)
             f.seek(offset)
             n_read = min(n_bytes, BLOCK_SIZE - offset)
             b.append(f.read(n_read))
@@ -81,12 +122,305 @@ class MultiFileReader:
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
-        return False 
+        return False
+
+# Local directory that posting files are mirrored into before being mmap-ed.
+LOCAL_POSTINGS_DIR = os.environ.get('LOCAL_POSTINGS_DIR', 'postings_cache')
+
+class MmapMultiFileReader:
+    """ Binary reader of multiple files of up to BLOCK_SIZE each, that mirrors
+        the files from the bucket onto local disk and serves reads as slices of
+        a memory map. Files are opened on first use and stay open until close(),
+        so repeated reads of the same posting list never leave the process.
+    """
+    def __init__(self, base_dir, bucket_name=None, local_dir=None):
+        self._base_dir = Path(base_dir)
+        self._bucket = None if bucket_name is None else get_bucket(bucket_name)
+        # files that are already local are mapped where they are.
+        if local_dir is None:
+            local_dir = self._base_dir if bucket_name is None else LOCAL_POSTINGS_DIR
+        self._local_dir = Path(local_dir)
+        self._maps = {}
+        self._file_locks = {}
+        self._lock = threading.Lock()
+
+    def _local_path(self, f_name):
+        if self._bucket is None:
+            return self._local_dir / f_name
+        return self._local_dir / self._base_dir / f_name
+
+    def _file_lock(self, f_name):
+        with self._lock:
+            return self._file_locks.setdefault(f_name, threading.Lock())
+
+    def _mirror(self, f_name, path):
+        """ Makes `path` hold the current bucket copy of posting file `f_name`.
+            The blob generation is kept next to it in a `.generation` file, like
+            index_loader.IndexLoader does, so a file rebuilt under the same name
+            is downloaded again. The file is written under a temporary name and
+            renamed, so a crash never leaves a truncated file behind.
+        """
+        blob = self._bucket.get_blob(str(self._base_dir / f_name))
+        if blob is None:
+            raise FileNotFoundError(f'gs://{self._bucket.name}/{self._base_dir / f_name}')
+        generation_path = path.with_name(f'{path.name}.generation')
+        if path.exists() and generation_path.exists() \
+                and generation_path.read_text() == str(blob.generation):
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        blob.download_to_filename(str(tmp))
+        os.replace(tmp, path)
+        generation_path.write_text(str(blob.generation))
+
+    def _map(self, f_name):
+        m = self._maps.get(f_name)
+        if m is not None:
+            return m
+        # one lock per file, so a download only holds up the reads of its file.
+        with self._file_lock(f_name):
+            m = self._maps.get(f_name)
+            if m is None:
+                path = self._local_path(f_name)
+                if self._bucket is not None:
+                    self._mirror(f_name, path)
+                with open(path, 'rb') as f:
+                    # mmap refuses empty files, a plain bytes object does the job.
+                    if os.fstat(f.fileno()).st_size == 0:
+                        m = b''
+                    else:
+                        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                with self._lock:
+                    self._maps[f_name] = m
+        return m
+
+    def mirror(self, f_names):
+        """ Fetches (if needed) and maps the given files ahead of the first query. """
+        for f_name in set(f_names):
+            self._map(f_name)
+
+    def version(self, f_name):
+        """ Returns the posting format of file `f_name`, read from its header. """
+        return file_version(self._map(f_name)[:len(FORMAT_V2_MAGIC)])
+
+    def read(self, locs, n_bytes):
+        b = []
+        for f_name, offset in locs:
+            if n_bytes <= 0:
+                break
+            m = self._map(f_name)
+            n_read = min(n_bytes, BLOCK_SIZE - offset)
+            b.append(m[offset:offset + n_read])
+            n_bytes -= n_read
+        return b[0] if len(b) == 1 else b''.join(b)
+
+    def close(self):
+        with self._lock:
+            for m in self._maps.values():
+                if isinstance(m, mmap.mmap):
+                    m.close()
+            self._maps = {}
+
+# One reader per (base_dir, bucket) that lives as long as the process does.
+_reader_pool = {}
+_reader_pool_lock = threading.Lock()
+
+def get_posting_reader(base_dir, bucket_name=None):
+    """ Returns the shared MmapMultiFileReader for posting files under `base_dir`. """
+    key = (str(base_dir), bucket_name)
+    reader = _reader_pool.get(key)
+    if reader is None:
+        with _reader_pool_lock:
+            reader = _reader_pool.setdefault(key, MmapMultiFileReader(base_dir, bucket_name))
+    return reader
+
+def release_posting_reader(base_dir, bucket_name=None):
+    """ Drops the pooled reader of `base_dir`. Its files are unmapped once the
+        reads still holding it are done.
+    """
+    with _reader_pool_lock:
+        _reader_pool.pop((str(base_dir), bucket_name), None)
+
+def close_posting_readers():
+    """ Unmaps every pooled posting file. """
+    with _reader_pool_lock:
+        for reader in _reader_pool.values():
+            reader.close()
+        _reader_pool.clear()
 
 TUPLE_SIZE = 6       # We're going to pack the doc_id and tf values in this 
                      # many bytes.
 TF_MASK = 2 ** 16 - 1 # Masking the 16 low bits of an integer
 
+# The on-disk layout of a single posting: (doc_id << 16 | tf) packed big-endian
+# into TUPLE_SIZE bytes is exactly a 4 byte doc_id followed by a 2 byte tf.
+POSTING_DTYPE = np.dtype([('doc_id', '>u4'), ('tf', '>u2')])
+
+
+class PostingList:
+    """ A decoded posting list held as two parallel NumPy arrays, `doc_ids` and
+        `tfs`, in the order they were written (sorted by doc_id).
+    """
+    __slots__ = ('doc_ids', 'tfs')
+
+    def __init__(self, doc_ids, tfs):
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint32))
+
+    @classmethod
+    def from_bytes(cls, b, n):
+        """ Decodes `n` postings of TUPLE_SIZE bytes each from the buffer `b` in
+            a single pass.
+        """
+        records = np.frombuffer(b, dtype=POSTING_DTYPE, count=n)
+        return cls(records['doc_id'].astype(np.int64), records['tf'].astype(np.uint32))
+
+    @property
+    def nbytes(self):
+        return self.doc_ids.nbytes + self.tfs.nbytes
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return zip(self.doc_ids.tolist(), self.tfs.tolist())
+
+    def to_list(self):
+        """ Returns the posting list in its list of (doc_id, tf) tuples form. """
+        return list(self)
+
+    @classmethod
+    def from_v2(cls, b, doc_ids=None):
+        """ Decodes a version 2 posting list (see encode_posting_list). If
+            `doc_ids` is given, the skip table is used to decode only the blocks
+            that may hold one of them.
+        """
+        n, n_blocks = (int(x) for x in np.frombuffer(b, dtype='>u4', count=2, offset=4))
+        skips = np.frombuffer(b, dtype='>u4', count=2 * n_blocks, offset=V2_HEADER_SIZE)
+        first_docs, starts = skips[0::2].astype(np.int64), skips[1::2].astype(np.int64)
+        data_start = V2_HEADER_SIZE + 8 * n_blocks
+        ends = np.append(starts[1:], len(b) - data_start)
+        sizes = np.full(n_blocks, SKIP_INTERVAL, dtype=np.int64)
+        if n_blocks > 0:
+            sizes[-1] = n - SKIP_INTERVAL * (n_blocks - 1)
+
+        blocks = np.arange(n_blocks)
+        if doc_ids is not None:
+            blocks = np.unique(np.searchsorted(first_docs, doc_ids, side='right') - 1)
+            blocks = blocks[blocks >= 0]
+        if len(blocks) == 0:
+            return cls.empty()
+
+        data = np.frombuffer(b, dtype=np.uint8, offset=data_start)
+        if len(blocks) < n_blocks:
+            data = np.concatenate([data[starts[i]:ends[i]] for i in blocks])
+        values = decode_varints(data)
+        first_docs, sizes = first_docs[blocks], sizes[blocks]
+
+        # Each block holds its size - 1 doc gaps followed by its tfs.
+        block_of = np.repeat(np.arange(len(blocks)), sizes)
+        block_start = np.cumsum(sizes) - sizes                  # first posting of each block
+        value_start = np.cumsum(2 * sizes - 1) - (2 * sizes - 1)  # first value of each block
+        j = np.arange(len(block_of)) - block_start[block_of]    # position inside the block
+        tfs = values[value_start[block_of] + sizes[block_of] - 1 + j]
+        gaps = np.zeros(len(block_of), dtype=np.int64)
+        inner = j > 0
+        gaps[inner] = values[value_start[block_of[inner]] + j[inner] - 1]
+        cum = np.cumsum(gaps)
+        doc_ids = first_docs[block_of] + cum - cum[block_start[block_of]]
+        return cls(doc_ids, tfs.astype(np.uint32))
+
+
+def encode_varints(values):
+    """ Encodes non-negative integers as LEB128 variable-byte integers: 7 bits
+        per byte, low bits first, the high bit set on all but the last byte.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= np.uint64(1 << shift)
+    starts = np.cumsum(lengths) - lengths
+    out = np.zeros(int(lengths.sum()), dtype=np.uint8)
+    for j in range(int(lengths.max(initial=0))):
+        has = lengths > j
+        more = (lengths[has] - 1 > j).astype(np.uint8) << 7
+        out[starts[has] + j] = ((values[has] >> np.uint64(7 * j)) & np.uint64(0x7f)).astype(np.uint8) | more
+    return out.tobytes()
+
+
+def decode_varints(data):
+    """ Decodes a buffer of variable-byte integers (see encode_varints) in one
+        vectorized pass.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    last = data < 0x80                                     # last byte of each value
+    value_of = np.cumsum(last) - last                      # value index of each byte
+    ends = np.flatnonzero(last)
+    starts = np.append(0, ends[:-1] + 1)
+    shift = (np.arange(len(data)) - starts[value_of]) * 7
+    parts = (data & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    return np.add.reduceat(parts, starts).astype(np.int64)
+
+
+# A version 2 posting list is
+#   header: total byte length, number of postings, number of blocks (u32 each)
+#   skip table: per block, its first doc_id and the offset of its data (u32 each)
+#   data: per block of SKIP_INTERVAL postings, the doc_id gaps after the first
+#         posting followed by all the tfs, as variable-byte integers.
+# Doc ids are sorted within a posting list, so gaps are small, and tfs are no
+# longer capped at 16 bits.
+V2_HEADER_SIZE = 12
+SKIP_INTERVAL = 128
+
+
+def encode_posting_list(pl, version=POSTING_FORMAT):
+    """ Encodes a list of (doc_id, tf) tuples, or a PostingList, sorted by
+        doc_id into bytes.
+    """
+    if isinstance(pl, PostingList):
+        doc_ids, tfs = pl.doc_ids.astype(np.int64), pl.tfs.astype(np.int64)
+    else:
+        doc_ids = np.fromiter((doc_id for doc_id, _ in pl), dtype=np.int64, count=len(pl))
+        tfs = np.fromiter((tf for _, tf in pl), dtype=np.int64, count=len(pl))
+    if version == POSTING_FORMAT_V1:
+        records = np.empty(len(pl), dtype=POSTING_DTYPE)
+        records['doc_id'] = doc_ids
+        records['tf'] = tfs & TF_MASK
+        return records.tobytes()
+    blocks, skips = [], []
+    offset = 0
+    for i in range(0, len(pl), SKIP_INTERVAL):
+        block_docs = doc_ids[i:i + SKIP_INTERVAL]
+        block = encode_varints(np.concatenate([np.diff(block_docs), tfs[i:i + SKIP_INTERVAL]]))
+        skips.extend((int(block_docs[0]), offset))
+        blocks.append(block)
+        offset += len(block)
+    n_bytes = V2_HEADER_SIZE + 8 * len(blocks) + offset
+    header = np.array([n_bytes, len(pl), len(blocks)] + skips, dtype='>u4').tobytes()
+    return header + b''.join(blocks)
+
+
+# Impact-ordered posting prefixes (see InvertedIndex.write_impact_prefixes) are
+# written next to the posting files, as a 4-byte record count followed by
+# fixed (doc_id, value) records in impact order.
+IMPACT_DTYPE = np.dtype([('doc_id', '>u4'), ('value', '>u4')])
+
+
+def encode_impact_prefix(doc_ids, values):
+    """ Encodes the (doc_id, value) records of an impact-ordered prefix, in the
+        order given, into bytes.
+    """
+    records = np.empty(len(doc_ids), dtype=IMPACT_DTYPE)
+    records['doc_id'] = doc_ids
+    records['value'] = values
+    return len(records).to_bytes(4, 'big') + records.tobytes()
+
 
 class InvertedIndex:  
     def __init__(self, docs={}):
@@ -145,46 +479,148 @@ class InvertedIndex:
             from the object's state dictionary. 
         """
         state = self.__dict__.copy()
-        del state['_posting_list']
+        state.pop('_posting_list', None)
         return state
 
+    def compute_upper_bounds(self, base_dir, doc_lengths, avg_length, k1, b, bucket_name=None):
+        """ Stores in `max_scores` the highest BM25 tf weight 
+            (k1 + 1) * tf / (k1 * (1 - b + b * len / avg_length) + tf) of every
+            term over its posting list. Multiplied by the term's idf and query
+            weight, it bounds what the term can add to any document's score.
+        Parameters:
+        -----------
+          doc_lengths: function mapping an array of doc ids to their lengths.
+          avg_length: average document length.
+          k1, b: the BM25 parameters the bounds hold for (kept in
+                 `max_scores_params`).
+        """
+        self.max_scores = {}
+        self.max_scores_params = (k1, b)
+        with closing(MultiFileReader(base_dir, bucket_name)) as reader:
+            for w, locs in self.posting_locs.items():
+                post = self._read_postings(reader, w)
+                B = 1 - b + b * (doc_lengths(post.doc_ids) / avg_length)
+                tfs = post.tfs.astype(np.float64)
+                self.max_scores[w] = float(np.max(((k1 + 1) * tfs) / (k1 * B + tfs), initial=0.0))
+
+    def write_impact_prefixes(self, base_dir, size, min_df=None, doc_lengths=None, avg_length=None,
+                              k1=None, b=None, bucket_name=None):
+        """ Writes an impact-ordered prefix of every posting list longer than
+            `min_df` postings (by default `size`) into `impact_NNN.bin` files
+            next to the posting files: the `size` documents of the list with
+            the highest impact, by descending impact then doc_id. With
+            `doc_lengths`, the impact of a posting is its BM25 tf weight (see
+            compute_upper_bounds) and the value stored is its tf. Without, the
+            impact and the value are the document's number of postings in the
+            list, which anchor text lists repeat a document for.
+            Sets `impact_locs`, `impact_floors` (per term, the highest impact
+            left out of its prefix, 0 if none was) and `impact_params` (the
+            (k1, b, avg_length) that BM25 impacts hold for, None for counts).
+        Parameters:
+        -----------
+          doc_lengths: function mapping an array of doc ids to their lengths, optional.
+          avg_length: average document length.
+          k1, b: the BM25 parameters.
+        """
+        min_df = size if min_df is None else min_df
+        self.impact_locs, self.impact_floors = {}, {}
+        self.impact_params = None if doc_lengths is None else (k1, b, avg_length)
+        terms = sorted(w for w in self.posting_locs if self.df[w] > min_df)
+        if not terms:
+            return
+        # The prefixes go into the directory of the posting files.
+        posting_dir = Path(self.posting_locs[terms[0]][0][0]).parent
+        with closing(MultiFileReader(base_dir, bucket_name)) as reader, \
+             closing(MultiFileWriter(Path(base_dir) / posting_dir, 'impact', bucket_name)) as writer:
+            for w in terms:
+                post = self._read_postings(reader, w)
+                if doc_lengths is None:
+                    doc_ids, values = np.unique(post.doc_ids, return_counts=True)
+                    impacts = values
+                else:
+                    doc_ids, values = post.doc_ids, post.tfs
+                    B = 1 - b + b * (doc_lengths(doc_ids) / avg_length)
+                    tfs = values.astype(np.float64)
+                    impacts = ((k1 + 1) * tfs) / (k1 * B + tfs)
+                order = np.lexsort((doc_ids, -impacts))
+                self.impact_floors[w] = impacts[order[size]].item() if len(order) > size else 0
+                locs = writer.write(encode_impact_prefix(doc_ids[order[:size]], values[order[:size]]))
+                # File names relative to base_dir, like those of posting_locs.
+                self.impact_locs[w] = locs if bucket_name is not None else \
+                    [(os.path.relpath(f_name, base_dir), offset) for f_name, offset in locs]
+
+    def read_impact_prefix(self, base_dir, w, bucket_name=None, stats=None):
+        """ Reads the impact-ordered prefix of `w` (see write_impact_prefixes)
+            through the mmap reader pool, as a PostingList whose tfs are the
+            stored values, in impact order. If given, stats['bytes'] is
+            increased by the bytes read.
+        """
+        locs = getattr(self, 'impact_locs', {}).get(w)
+        if locs is None:
+            return PostingList.empty()
+        reader = get_posting_reader(base_dir, bucket_name)
+        n = int.from_bytes(reader.read(locs, 4), 'big')
+        n_bytes = 4 + n * IMPACT_DTYPE.itemsize
+        records = np.frombuffer(reader.read(locs, n_bytes), dtype=IMPACT_DTYPE, count=n, offset=4)
+        if stats is not None:
+            stats['bytes'] = stats.get('bytes', 0) + n_bytes
+        return PostingList(records['doc_id'].astype(np.int64), records['value'].astype(np.int64))
+
     def posting_lists_iter(self, base_dir, bucket_name=None):
         """ A generator that reads one posting list from disk and yields 
             a (word:str, [(doc_id:int, tf:int), ...]) tuple.
         """
         with closing(MultiFileReader(base_dir, bucket_name)) as reader:
-            for w, locs in self.posting_locs.items():
-                b = reader.read(locs, self.df[w] * TUPLE_SIZE)
-                posting_list = []
-                for i in range(self.df[w]):
-                    doc_id = int.from_bytes(b[i*TUPLE_SIZE:i*TUPLE_SIZE+4], 'big')
-                    tf = int.from_bytes(b[i*TUPLE_SIZE+4:(i+1)*TUPLE_SIZE], 'big')
-                    posting_list.append((doc_id, tf))
-                yield w, posting_list
+            for w in self.posting_locs:
+                yield w, self._read_postings(reader, w).to_list()
 
     def read_a_posting_list(self, base_dir, w, bucket_name=None):
-        posting_list = []
+        """ Returns the posting list of `w` as a list of (doc_id, tf) tuples. """
+        return self.read_a_posting_array(base_dir, w, bucket_name).to_list()
+
+    def read_a_posting_array(self, base_dir, w, bucket_name=None, doc_ids=None, stats=None):
+        """ Reads the posting list of `w` through the process-wide mmap reader
+            pool, so only the first read of each posting file reaches the bucket,
+            and returns it as a PostingList of NumPy arrays. For version 2
+            postings, passing `doc_ids` decodes only the blocks that may hold
+            them. If given, stats['bytes'] is increased by the bytes read.
+        """
         if not w in self.posting_locs:
-            return posting_list
-        with closing(MultiFileReader(base_dir, bucket_name)) as reader:
-            locs = self.posting_locs[w]
-            b = reader.read(locs, self.df[w] * TUPLE_SIZE)
-            for i in range(self.df[w]):
-                doc_id = int.from_bytes(b[i*TUPLE_SIZE:i*TUPLE_SIZE+4], 'big')
-                tf = int.from_bytes(b[i*TUPLE_SIZE+4:(i+1)*TUPLE_SIZE], 'big')
-                posting_list.append((doc_id, tf))
-        return posting_list
+            return PostingList.empty()
+        return self._read_postings(get_posting_reader(base_dir, bucket_name), w, doc_ids, stats)
+
+    def _read_postings(self, reader, w, doc_ids=None, stats=None):
+        """ Reads and decodes the posting list of `w` in whichever format its
+            file was written in.
+        """
+        locs = self.posting_locs[w]
+        if reader.version(locs[0][0]) == POSTING_FORMAT_V1:
+            n_bytes = self.df[w] * TUPLE_SIZE
+            post = PostingList.from_bytes(reader.read(locs, n_bytes), self.df[w])
+        else:
+            n_bytes = int.from_bytes(reader.read(locs, 4), 'big')
+            post = PostingList.from_v2(reader.read(locs, n_bytes), doc_ids)
+        if stats is not None:
+            stats['bytes'] = stats.get('bytes', 0) + n_bytes
+        return post
+
+    def mirror_postings(self, base_dir, bucket_name=None):
+        """ Copies every posting file of the index to local disk and maps it, so
+            that no query has to wait for a bucket download.
+        """
+        all_locs = itertools.chain(self.posting_locs.values(), getattr(self, 'impact_locs', {}).values())
+        files = (f_name for locs in all_locs for f_name, _ in locs)
+        get_posting_reader(base_dir, bucket_name).mirror(files)
 
     @staticmethod
-    def write_a_posting_list(b_w_pl, base_dir, bucket_name=None):
+    def write_a_posting_list(b_w_pl, base_dir, bucket_name=None, version=POSTING_FORMAT):
         posting_locs = defaultdict(list)
         bucket_id, list_w_pl = b_w_pl
         
-        with closing(MultiFileWriter(base_dir, bucket_id, bucket_name)) as writer:
+        with closing(MultiFileWriter(base_dir, bucket_id, bucket_name, version)) as writer:
             for w, pl in list_w_pl: 
                 # convert to bytes
-                b = b''.join([(doc_id << 16 | (tf & TF_MASK)).to_bytes(TUPLE_SIZE, 'big')
-                              for doc_id, tf in pl])
+                b = encode_posting_list(pl, version)
                 # write to file(s)
                 locs = writer.write(b)
                 # save file locations to index
@@ -202,3 +638,23 @@ class InvertedIndex:
         bucket = None if bucket_name is None else get_bucket(bucket_name)
         with _open(path, 'rb', bucket) as f:
             return pickle.load(f)
+
+
+class ImpactPrefixes:
+    """ The impact-ordered prefixes of an InvertedIndex (see
+        write_impact_prefixes), read like its posting lists: `df` holds the
+        terms that have one.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    @property
+    def df(self):
+        return getattr(self.index, 'impact_locs', {})
+
+    def floor(self, w):
+        """ The highest impact of a posting of `w` left out of its prefix. """
+        return self.index.impact_floors[w]
+
+    def read_a_posting_array(self, base_dir, w, bucket_name=None, stats=None):
+        return self.index.read_impact_prefix(base_dir, w, bucket_name, stats)
@@ -0,0 +1,197 @@
+import bisect
+import threading
+from time import perf_counter
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from half a millisecond up to ten seconds.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(x):
+    return '+Inf' if x == float('inf') else repr(float(x))
+
+
+class Histogram:
+    """ A Prometheus histogram: per label values, the count of observations in
+        each bucket, their sum and their count.
+    """
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}     # label values -> [bucket counts, sum]
+        self._lock = threading.Lock()
+
+    def _observe(self, value, labels):
+        """ Records one observation. Called with the lock held. """
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def observe(self, value, *labels):
+        with self._lock:
+            self._observe(value, labels)
+
+    def observe_many(self, observations):
+        """ Records (value, labels) pairs under a single lock acquisition. """
+        with self._lock:
+            for value, labels in observations:
+                self._observe(value, tuple(labels))
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in sorted(self._series.items())]
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % _number(bound)
+                lines.append(f'{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, labels)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labels, labels)} {cumulative}')
+        return lines
+
+
+class CounterMetric:
+    """ A Prometheus counter per label values. """
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items())
+        lines.extend(f'{self.name}{_labels(self.labels, labels)} {_number(value)}' for labels, value in values)
+        return lines
+
+
+class CacheMetrics:
+    """ Exposes the stats() of the caches (see caches.py) as counters and gauges. """
+    COUNTERS = ('hits', 'misses', 'evictions', 'expirations')
+    GAUGES = ('entries', 'bytes', 'max_bytes')
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.caches = {}
+
+    def render(self):
+        stats = {name: cache.stats() for name, cache in self.caches.items()}
+        lines = []
+        for kind, keys in (('counter', self.COUNTERS), ('gauge', self.GAUGES)):
+            for key in keys:
+                name = f'{self.prefix}_{key}_total' if kind == 'counter' else f'{self.prefix}_{key}'
+                values = [(cache, s[key]) for cache, s in sorted(stats.items()) if key in s]
+                if values:
+                    lines.append(f'# HELP {name} Cache {key.replace("_", " ")}.')
+                    lines.append(f'# TYPE {name} {kind}')
+                    lines.extend(f'{name}{{cache="{_escape(cache)}"}} {_number(value)}' for cache, value in values)
+        return lines
+
+
+class Metrics:
+    """ The metrics of a process, rendered in the Prometheus text format. """
+    def __init__(self):
+        self._metrics = []
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def counter(self, name, help, labels=()):
+        return self._add(CounterMetric(name, help, labels))
+
+    def caches(self, prefix, **caches):
+        metric = CacheMetrics(prefix)
+        metric.caches.update(caches)
+        return self._add(metric)
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(line for metric in self._metrics for line in metric.render()) + '\n'
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when a request runs past the deadline of its RequestTimer. """
+
+
+class RequestTimer:
+    """ Collects the stage timings and posting reads of a single request. Kept
+        private to the request and published once it is done, so timing a
+        stage costs two clock reads. With a `deadline` (in seconds), a stage
+        that would start after it raises DeadlineExceeded instead.
+    """
+    def __init__(self, deadline=None):
+        self.start = perf_counter()
+        self.deadline = deadline
+        self.stages = {}
+        self.reads = {}         # index name -> [lists, cache hits, postings, bytes]
+        self._lock = threading.Lock()
+
+    def remaining(self):
+        """ Returns the seconds left before the deadline, or None without one. """
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - self.elapsed())
+
+    def check(self):
+        """ Raises DeadlineExceeded if the deadline has passed. """
+        if self.deadline is not None and self.elapsed() > self.deadline:
+            raise DeadlineExceeded(f'request took over {self.deadline} seconds')
+
+    @contextmanager
+    def stage(self, name):
+        self.check()
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + perf_counter() - start
+
+    def read(self, index, hit, postings=0, n_bytes=0):
+        """ Records a posting list read, which may run on a fetcher thread. """
+        with self._lock:
+            reads = self.reads.setdefault(index, [0, 0, 0, 0])
+            reads[0] += 1
+            reads[1] += hit
+            reads[2] += postings
+            reads[3] += n_bytes
+
+    def elapsed(self):
+        return perf_counter() - self.start
+
+    def as_dict(self):
+        """ Returns the breakdown in milliseconds, for ?debug=timing. """
+        return {'total_ms': self.elapsed() * 1000,
+                'stages_ms': {name: seconds * 1000 for name, seconds in self.stages.items()},
+                'reads': {index: {'lists': lists, 'cache_hits': hits, 'postings': postings, 'bytes': n_bytes}
+                          for index, (lists, hits, postings, n_bytes) in self.reads.items()}}
+
+    def server_timing(self):
+        """ Returns the stages as a Server-Timing header value. """
+        stages = [f'{name};dur={seconds * 1000:.3f}' for name, seconds in self.stages.items()]
+        return ', '.join(stages + [f'total;dur={self.elapsed() * 1000:.3f}'])
@@ -0,0 +1,288 @@
+import os
+import threading
+from collections import Counter
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Upper bound on posting list reads in flight per process.
+FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', 16))
+
+
+class PostingFetcher:
+    """ Issues all the posting list reads of a query at once on a bounded
+        thread pool. `read(name, term)` reads one posting list of the index
+        called `name`; fetch() returns a Future per (name, term), so scoring
+        of one index can start as soon as its own lists have arrived.
+    """
+    def __init__(self, read, max_workers=FETCH_WORKERS):
+        self._read = read
+        self._max_workers = max_workers
+        self._pool = None
+        self._lock = threading.Lock()
+        # A forked child has none of the parent's pool threads.
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self._max_workers, thread_name_prefix='posting-fetch')
+            return self._pool
+
+    def fetch(self, keys, *args):
+        """ Starts reading the posting list of every (name, term) in `keys`;
+            `args` are passed on to every read.
+        Returns:
+        --------
+            dict mapping each (name, term) to a Future of its PostingList.
+        """
+        pool = self._get_pool()
+        futures = {}
+        for name, term in keys:
+            if (name, term) not in futures:
+                futures[(name, term)] = pool.submit(self._read, name, term, *args)
+        return futures
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+
+# BM25 parameters shared by every BM25 scorer of the search engine.
+BM25_K1 = 1.2
+BM25_K3 = 2.2
+BM25_B = 0.7
+
+
+def bm25_tf_weight(tfs, B, k1=BM25_K1):
+    """ The BM25 tf component (k1 + 1) * tf / (k1 * B + tf), where B is the
+        length normalization 1 - b + b * len / avg_len.
+    """
+    return ((k1 + 1) * tfs) / (k1 * B + tfs)
+
+
+def top_k_indices(scores, k):
+    """ Returns the indices of the k largest scores, from best to worst, with
+        ties broken by position like Counter.most_common. Only the entries that
+        survive an O(n) partition are sorted.
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if len(scores) > k:
+        threshold = -np.partition(-scores, k - 1)[k - 1]
+        candidates = np.flatnonzero(scores >= threshold)
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+
+
+def _find(sorted_ids, doc_ids):
+    """ Returns a mask of the doc_ids found in sorted_ids, and their positions. """
+    if len(sorted_ids) == 0:
+        return np.zeros(len(doc_ids), dtype=bool), np.zeros(len(doc_ids), dtype=np.int64)
+    pos = np.minimum(np.searchsorted(sorted_ids, doc_ids), len(sorted_ids) - 1)
+    return sorted_ids[pos] == doc_ids, pos
+
+
+def _merge_top_k(docs, scores, new_docs, new_scores, k):
+    docs = np.concatenate([docs, new_docs])
+    scores = np.concatenate([scores, new_scores])
+    top = np.lexsort((docs, -scores))[:k]
+    return docs[top], scores[top]
+
+
+def max_score_top_k(terms, doc_lengths, avg_length, k, k1=BM25_K1, b=BM25_B, sizes=None):
+    """ Exact top-k BM25 over complete posting lists, with MaxScore pruning.
+        Lists are visited from the shortest up. A document is scored in full
+        (against every later list) only the first time it is seen, and only if
+        its tf weight in the current list plus the upper bounds of the later
+        lists can still beat the current k-th best score. Once no unseen
+        document can, the remaining (longest) lists are never scanned.
+    Parameters:
+    -----------
+      terms: list of (PostingList, weight, max_score) per query term, where
+             weight is idf * query term factor and max_score bounds the
+             term's tf weight over its list (see compute_upper_bounds).
+      doc_lengths: function mapping an array of doc ids to their lengths.
+      avg_length: average document length.
+      k: number of documents to return.
+      sizes: the list lengths to visit the lists by, aligned with terms; by
+             default their own. A shard passes the df of the whole corpus, so
+             it sums each document's score in the same order as one index.
+    Returns:
+    --------
+      (doc_ids, scores) arrays of the best k documents by descending score,
+      ties broken by ascending doc_id.
+    """
+    sizes = [len(t[0]) for t in terms] if sizes is None else sizes
+    terms = [t for _, t in sorted(((size, t) for size, t in zip(sizes, terms) if len(t[0]) > 0),
+                                  key=lambda pair: pair[0])]
+    bounds = np.array([weight * max_score for _, weight, max_score in terms])
+    # rest[i]: the most the lists after i can add to a document's score.
+    rest = np.append(np.cumsum(bounds[::-1])[::-1][1:], 0.0)
+
+    top_docs, top_scores = np.empty(0, dtype=np.int64), np.empty(0)
+    theta = -np.inf
+    for i, (post, weight, _) in enumerate(terms):
+        # leave room for rounding between bounds and summed scores.
+        cut = theta - 1e-9 * abs(theta)
+        if len(top_docs) == k and bounds[i] + rest[i] < cut:
+            break
+        docs, tfs = post.doc_ids, post.tfs.astype(np.float64)
+
+        # Cheapest bound first: the tf weight as if the document were empty.
+        keep = weight * bm25_tf_weight(tfs, 1 - b, k1) + rest[i] >= cut
+        docs, tfs = docs[keep], tfs[keep]
+        # Documents in shorter lists were already scored or ruled out.
+        for prev, _, _ in terms[:i]:
+            found, _ = _find(prev.doc_ids, docs)
+            docs, tfs = docs[~found], tfs[~found]
+
+        B = 1 - b + b * (doc_lengths(docs) / avg_length)
+        scores = weight * bm25_tf_weight(tfs, B, k1)
+        keep = scores + rest[i] >= cut
+        docs, B, scores = docs[keep], B[keep], scores[keep]
+
+        for later, later_weight, _ in terms[i + 1:]:
+            found, pos = _find(later.doc_ids, docs)
+            scores[found] += later_weight * bm25_tf_weight(later.tfs[pos[found]].astype(np.float64), B[found], k1)
+
+        top_docs, top_scores = _merge_top_k(top_docs, top_scores, docs, scores, k)
+        if len(top_docs) == k:
+            theta = top_scores[-1]
+    return top_docs, top_scores
+
+
+def impact_top_k(prefixes, k, by_first_term=False):
+    """ Exact top-k by summed impact from impact-ordered posting prefixes (see
+        InvertedIndex.write_impact_prefixes), read only as deep as needed: a
+        document missing from a prefix can still have an impact up to the
+        first one left out of it, so the top-k is settled once k documents
+        with known scores beat everything the prefixes leave out. The first
+        k + 1 postings of each prefix are tried before the whole prefixes,
+        which settles most single term queries.
+    Parameters:
+    -----------
+      prefixes: list per query term of (doc_ids, impacts, floor): distinct doc
+                ids by descending impact and the highest impact of a posting
+                left out (0 when the prefix is the whole list). Each document's
+                impacts are summed in this order.
+      k: number of documents to return.
+      by_first_term: break ties by the first prefix holding a document, then
+                     by doc_id (see rank_candidates), instead of by doc_id.
+    Returns:
+    --------
+      (doc_ids, scores, first_term) arrays of the best k documents from best to
+      worst, or None if the prefixes can not decide them.
+    """
+    depth = k + 1
+    if any(len(doc_ids) > depth for doc_ids, _, _ in prefixes):
+        top = _prefix_top_k([(doc_ids[:depth], impacts[:depth], impacts[depth] if len(impacts) > depth else floor)
+                             for doc_ids, impacts, floor in prefixes], k, by_first_term)
+        if top is not None:
+            return top
+    return _prefix_top_k(prefixes, k, by_first_term)
+
+
+def _prefix_top_k(prefixes, k, by_first_term):
+    """ One round of impact_top_k over prefixes cut to the same depth. """
+    docs, inverse = np.unique(np.concatenate([np.asarray(doc_ids, dtype=np.int64) for doc_ids, _, _ in prefixes]),
+                              return_inverse=True)
+    scores = np.zeros(len(docs), dtype=np.result_type(np.int64, *(impacts.dtype for _, impacts, _ in prefixes)))
+    first = np.full(len(docs), len(prefixes))
+    missing = np.zeros(len(docs))   # the most the prefixes a doc is missing from may add
+    start = 0
+    for t, (doc_ids, impacts, floor) in enumerate(prefixes):
+        held = inverse[start:start + len(doc_ids)]
+        start += len(doc_ids)
+        scores[held] += impacts
+        first[held] = np.minimum(first[held], t)
+        if floor > 0:
+            out = np.ones(len(docs), dtype=bool)
+            out[held] = False
+            missing[out] += floor
+
+    known = np.flatnonzero(missing == 0)
+    keys = (docs[known], first[known], -scores[known]) if by_first_term else (docs[known], -scores[known])
+    top = known[np.lexsort(keys)[:k]]
+    # The best score a document outside the top could have, seen or not.
+    bound = max(sum(floor for _, _, floor in prefixes), float(np.max((scores + missing)[missing > 0], initial=0)))
+    if len(top) < k:
+        if bound > 0:
+            return None
+    # leave room for rounding between bounds and summed scores.
+    elif bound >= scores[top[-1]] - 1e-9 * abs(scores[top[-1]]):
+        return None
+    return docs[top], scores[top], first[top]
+
+
+def _run_starts(sorted_ids):
+    """ Returns the positions where a new doc id starts in a sorted array. """
+    if len(sorted_ids) == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], sorted_ids[1:] != sorted_ids[:-1])))
+
+
+def rank_by_term_count(doc_id_lists):
+    """ Ranks the documents of the posting lists of the distinct query terms by
+        how many of the lists contain them. The counts only take values 1 to
+        len(doc_id_lists), so they are ordered by a stable counting (radix)
+        sort instead of a comparison sort.
+    Parameters:
+    -----------
+      doc_id_lists: list of doc id arrays, one per distinct query term, each
+                    sorted and possibly repeating a doc id.
+    Returns:
+    --------
+      (doc_ids, counts) arrays by descending count, ties by ascending doc_id.
+    """
+    lists = [ids[_run_starts(ids)] for ids in map(np.asarray, doc_id_lists)]
+    if sum(len(ids) for ids in lists) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    # Merging already sorted runs: the stable sort is a timsort here.
+    docs = np.sort(np.concatenate(lists).astype(np.int64), kind='stable')
+    starts = _run_starts(docs)
+    counts = np.diff(np.append(starts, len(docs)))
+    docs = docs[starts]
+    order = np.argsort((len(lists) - counts).astype(np.uint16), kind='stable')
+    return docs[order], counts[order]
+
+
+def rank_candidates(doc_ids, scores, first_term):
+    """ Returns the order of candidate documents by descending score, ties
+        broken by the query term each was first seen in and then by doc id.
+        This is the order Counter.most_common gives documents inserted term by
+        term in posting order, and it does not depend on which other documents
+        are ranked, so top lists of disjoint document sets merge into the same
+        order (see sharding.py).
+    """
+    return np.lexsort((doc_ids, first_term, -scores))
+
+
+def scaled_scores(doc_ids, scores, alpha):
+    """ Returns a Counter mapping each doc to alpha * score / best score, in
+        the given order, for doc_ids and scores ranked from best to worst.
+    """
+    if len(scores) == 0:
+        return Counter()
+    return Counter(dict(zip(doc_ids.tolist(), (alpha * (scores / scores[0])).tolist())))
+
+
+def add_bm25_scores(cand, scores, first_term, n_terms, base, alpha):
+    """ Adds the scaled BM25 scores of the candidates hit by a query term to
+        their filter scores `base` (a Counter), the hit candidates first in
+        rank_candidates order.
+    Parameters:
+    -----------
+      cand: sorted candidate doc ids.
+      scores, first_term: BM25 score of each candidate and the first query
+                          term that hit it (n_terms if none did).
+    """
+    hit = np.flatnonzero(first_term < n_terms)
+    hit = hit[rank_candidates(cand[hit], scores[hit], first_term[hit])]
+    return scaled_scores(cand[hit], scores[hit], alpha) + base
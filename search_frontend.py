@@ -1,48 +1,322 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, g, has_request_context, stream_with_context
 from collections import Counter
 from flask.json.tag import PassDict
 from mpmath import re
-from nltk.corpus import stopwords
 from inverted_index_gcp import *
+from analyzer import Analyzer
+from columnar_store import ColumnStore, COLUMNS_DIR, COLUMN_SUFFIXES
+from index_loader import IndexLoader, INDEX_CACHE_DIR
+from caches import LRUCache, TTLCache, sizeof_results
+from segments import SegmentedIndex
+from metrics import Metrics, RequestTimer, DeadlineExceeded
+from retrieval import PostingFetcher, max_score_top_k, impact_top_k, top_k_indices, rank_by_term_count, scaled_scores, add_bm25_scores, bm25_tf_weight, BM25_K1, BM25_K3, BM25_B
+import os
+import json
 import math
+import numpy as np
 from google.cloud import storage
 from nltk.stem.porter import *
 import pickle
 import string
 import threading
-import nltk
-nltk.download('stopwords')
+import concurrent.futures
 
 #--------------------------------------------- Global variables ---------------------------------------------------
 
-bucket_name = 'irproject-414719bucket'
+# Set BUCKET_NAME= (empty) to serve an index laid out like the bucket from the
+# local directory INDEX_BASE_DIR instead.
+bucket_name = os.environ.get('BUCKET_NAME', 'irproject-414719bucket') or None
+base_dir = '.' if bucket_name is not None else os.environ.get('INDEX_BASE_DIR', '.')
 
-english_stopwords = frozenset(stopwords.words('english'))
-corpus_stopwords = ['category', 'references', 'also', 'links', 'extenal', 'see', 'thumb', 'became', 'may', 'considered', 'known', 'meaning', 'mean', 'occur', 'describe']
-RE_WORD = re.compile(r"""[\#\@\w](['\-]?\w){1,24}""", re.UNICODE)
-all_stopwords = english_stopwords.union(corpus_stopwords)
-stemmer = PorterStemmer()
-
-# This method load pickle file from bucket in GCP
-def loadIndex(path):
-  storage_client = storage.Client()
-  bucket = storage_client.bucket(bucket_name)
-  blob = bucket.blob(path)
-  contents = blob.download_as_bytes()
-  return pickle.loads(contents)
+# Query tokenization, the same as the indexes' (see analyzer.py).
+analyzer = Analyzer()
 
 
 #----------------------------------------------- Global indexes -------------------------------------------------
 
-index_body = loadIndex('bucketBody/indexBody.pkl')                       
-index_title = loadIndex('bucketTitle/indexTitle.pkl')
-index_anchorText = loadIndex('bucketAnchorText/indexAnchorText.pkl')
-index_views = loadIndex('page_views/pageviews.pkl')
-index_pageRanks = loadIndex('page_ranks/pageRanks.pickle')
+# Every index is fetched into INDEX_CACHE_DIR (skipped on restart if the blob did
+# not change) and deserialized on first use. A background warm-up loads them all
+# concurrently; /ready reports when it is done. INDEX_WARMUP is one of
+# 'background' (default), 'sync' (block the import) or 'off' (load lazily).
+loader = IndexLoader(bucket_name, INDEX_CACHE_DIR, base_dir)
+
+# The doc_id keyed globals (body lengths, page views, PageRank, titles) and the
+# title index are read from the memory mapped column store built by columnar_store.py.
+columns = loader.register_dir(COLUMNS_DIR, ColumnStore.open, COLUMN_SUFFIXES)
+
+index_body = loader.register(f'{COLUMNS_DIR}/indexBody.pkl')        # Body index without nf (see columns.body_nf)
+index_anchorText = loader.register('bucketAnchorText/indexAnchorText.pkl')
+
+# With SEGMENTS_DIR set, the documents added, replaced or deleted since the body
+# index was built (see segments.py) are layered over it. Cached postings and
+# results are dropped whenever a new generation of segments is picked up.
+segments_dir = os.environ.get('SEGMENTS_DIR')
+if segments_dir:
+  index_body = SegmentedIndex(segments_dir, index_body,
+                              base_stats=lambda: (columns.meta['N'], columns.meta['avg']),
+                              base_lengths=lambda doc_ids: columns.body_nf.lookup(doc_ids, 0),
+                              on_refresh=lambda: clearCaches())
+
+
+"""
+Looks up the body length of each doc in an array of doc ids (0 if unknown)
+Parameters:
+  doc_ids: (np.ndarray) Doc ids
+Returns:
+  np.ndarray of lengths aligned with doc_ids
+"""
+def lookupDocLengths(doc_ids):
+  if segments_dir:
+    return index_body.doc_lengths(doc_ids)
+  return columns.body_nf.lookup(doc_ids, 0)
+
+
+"""
+Returns the size of the corpus and the average body length
+Returns:
+  (N, avg) tuple
+"""
+def corpusStats():
+  if segments_dir:
+    return index_body.N, index_body.avg_length
+  return columns.meta['N'], columns.meta['avg']
+
+
+"""
+Looks up the title of a doc
+Parameters:
+  doc_id: (int) Doc id
+Returns:
+  The title ('' if unknown)
+"""
+def titleOf(doc_id):
+  if segments_dir:
+    title = index_body.title(doc_id)
+    if title is not None:
+      return title
+  return columns.titles.get(doc_id, '')
+
+
+"""
+Looks up the titles of an array of doc ids
+Parameters:
+  doc_ids: (np.ndarray) Doc ids
+Returns:
+  list of titles aligned with doc_ids ('' if unknown)
+"""
+def titlesOf(doc_ids):
+  if segments_dir:
+    return [titleOf(doc_id) for doc_id in doc_ids.tolist()]
+  return columns.titles.lookup(doc_ids)
+
 
+"""
+Runs once all indexes are loaded. The most frequent body terms are stemmed
+ahead of time (see Analyzer.warm). Posting files are mirrored to local disk on first read and
+served through mmap (see MmapMultiFileReader); with MIRROR_POSTINGS=1 they are
+all copied here, before the engine reports ready.
+"""
+def afterWarmUp():
+  analyzer.warm(index_body.base.df if segments_dir else index_body.df)
+  if os.environ.get('MIRROR_POSTINGS') == '1':
+    index_anchorText.mirror_postings(base_dir, bucket_name)
+    index_body.mirror_postings(base_dir, bucket_name)
+
+warm_up_mode = os.environ.get('INDEX_WARMUP', 'background')
+if warm_up_mode != 'off':
+  loader.warm_up(background=warm_up_mode == 'background', after=afterWarmUp)
+
+
+#----------------------------------------------- Caches -------------------------------------------------
+
+# Decoded posting lists keyed by (index name, term), bounded by their array bytes.
+posting_cache = LRUCache(int(os.environ.get('POSTING_CACHE_MB', 1024)) * 2**20, sizeof=lambda post: post.nbytes)
+# /search results keyed by the normalized query, so term order does not matter.
+result_cache = TTLCache(int(os.environ.get('RESULT_CACHE_MB', 64)) * 2**20,
+                        ttl=float(os.environ.get('RESULT_CACHE_TTL', 300)), sizeof=sizeof_results)
+
+
+"""
+Empties the posting list and result caches
+"""
+def clearCaches():
+  posting_cache.clear()
+  result_cache.clear()
+
+
+# Indexes whose posting lists are read from storage, by the name used in cache keys.
+posting_indexes = {'anchor': index_anchorText, 'body': index_body}
+
+# The impact-ordered prefixes of the longest lists, where the indexes were built
+# with them (see InvertedIndex.write_impact_prefixes), are read in their place
+# and ranked with early termination; the full lists are only read when the
+# prefixes can not settle the top documents. This is tried for the queries with
+# up to IMPACT_MAX_TERMS terms in an index: a document is only known from the
+# prefixes if every prefix it could be missing from holds it, which rarely
+# settles queries of several frequent terms. IMPACT_PREFIXES=0 ignores them.
+# The body prefixes do not hold the documents of segments.
+impact_max_terms = int(os.environ.get('IMPACT_MAX_TERMS', 1))
+if os.environ.get('IMPACT_PREFIXES', '1') == '1':
+  posting_indexes['anchor_impact'] = ImpactPrefixes(index_anchorText)
+  if not segments_dir:
+    posting_indexes['body_impact'] = ImpactPrefixes(index_body)
+
+
+"""
+Reads the posting list of a term through the posting list cache
+Parameters:
+  name: (str) Name of the index in posting_indexes
+  term: (str) The term
+  timer: (RequestTimer) Timer of the request the list is read for, optional
+Returns:
+  PostingList of the term (empty if the term is not in the index)
+"""
+def readPostingList(name, term, timer=None):
+  index = posting_indexes[name]
+  if term not in index.df:
+    return PostingList.empty()
+  # Lists layered over segments are only good for the generation they were read at.
+  key = (name, term, index.generation) if isinstance(index, SegmentedIndex) else (name, term)
+  post = posting_cache.get(key)
+  if post is not None:
+    if timer is not None:
+      timer.read(name, True)
+    return post
+
+  stats = {'bytes': 0}
+  post = index.read_a_posting_array(base_dir, term, bucket_name, stats=stats)
+  posting_cache.put(key, post)
+  postings_read.inc(len(post), name)
+  bytes_read.inc(stats['bytes'], name)
+  if timer is not None:
+    timer.read(name, False, len(post), stats['bytes'])
+  return post
+
+
+"""
+Lists the posting lists of a query that exist, so that no read is issued for a
+term an index does not hold
+Parameters:
+  names: (tuple) Names of indexes in posting_indexes
+  query_dict: (dict) A dictionary of the query
+Returns:
+  list of (name, term)
+"""
+def postingKeys(names, query_dict):
+  return [(name, term) for name in names for term in query_dict if term in posting_indexes[name].df]
+
+
+"""
+Lists the posting lists of a query to read first: the impact-ordered prefix of
+a term where its index has one, otherwise its posting list
+Parameters:
+  names: (tuple) Names of indexes in posting_indexes
+  query_dict: (dict) A dictionary of the query
+Returns:
+  list of (name, term)
+"""
+def prefixKeys(names, query_dict):
+  keys = []
+  for name in names:
+    prefixes = posting_indexes[f'{name}_impact'].df if usePrefixes(name, query_dict) else {}
+    keys.extend((f'{name}_impact', term) if term in prefixes else (name, term)
+                for _, term in postingKeys((name,), query_dict))
+  return keys
+
+
+"""
+Tells whether a query is ranked from the impact-ordered prefixes of an index first
+Parameters:
+  name: (str) Name of the index in posting_indexes
+  query_dict: (dict) A dictionary of the query
+Returns:
+  True if the index has prefixes of some of the query terms, and at most
+  impact_max_terms of the query terms are in the index
+"""
+def usePrefixes(name, query_dict):
+  prefixes = posting_indexes.get(f'{name}_impact')
+  if prefixes is None:
+    return False
+  terms = [term for term in query_dict if term in posting_indexes[name].df]
+  return len(terms) <= impact_max_terms and any(term in prefixes.df for term in terms)
+
+
+"""
+Lists the posting lists /search reads for a query (see rankQuery)
+Parameters:
+  query_dict: (dict) A dictionary of the query
+Returns:
+  list of (name, term)
+"""
+def rankingKeys(query_dict):
+  if full_body_bm25:
+    return prefixKeys(('anchor', 'body'), query_dict)
+  # The BM25 of the candidates is looked up in the full body lists.
+  return prefixKeys(('anchor',), query_dict) + postingKeys(('body',), query_dict)
 
-dictIdTitle = loadIndex('bucketTitle/dictIdTitle.pkl')      # Dictionary of doc id to title
-N = len(index_body.nf)                                      # Size of corpus
+
+# With FULL_BODY_BM25=1, /search ranks the BM25 stage over the whole corpus
+# (topByBM25) instead of only the anchor and title candidates.
+full_body_bm25 = os.environ.get('FULL_BODY_BM25') == '1'
+
+# Reads all the posting lists of a query concurrently.
+fetcher = PostingFetcher(readPostingList)
+
+
+"""
+Returns the posting list of a term, waiting for it if it was prefetched
+Parameters:
+  name: (str) Name of the index in posting_indexes
+  term: (str) The term
+  postings: (dict) Futures from fetcher.fetch, or None
+Returns:
+  PostingList of the term
+"""
+def postingFor(name, term, postings=None):
+  if postings is not None and (name, term) in postings:
+    timer = currentTimer()
+    try:
+      return postings[(name, term)].result(None if timer is None else timer.remaining())
+    except concurrent.futures.TimeoutError:
+      raise DeadlineExceeded(f'request took over {timer.deadline} seconds')
+  return readPostingList(name, term, currentTimer())
+
+
+"""
+Starts reading the posting lists of a query in an index that were not prefetched
+Parameters:
+  name: (str) Name of the index in posting_indexes
+  query_dict: (dict) A dictionary of the query
+  postings: (dict) Futures from fetcher.fetch, or None
+Returns:
+  dict of the futures of postings and of the lists added
+"""
+def fetchMissing(name, query_dict, postings=None):
+  postings = {} if postings is None else postings
+  keys = [key for key in postingKeys((name,), query_dict) if key not in postings]
+  return {**postings, **fetcher.fetch(keys, currentTimer())}
+
+
+#----------------------------------------------- Metrics -------------------------------------------------
+
+# Published by /metrics in the Prometheus text format. Each request times its
+# stages on its own RequestTimer, which is added to the histograms once the
+# request is done (see recordTimer); ?debug=timing also returns it.
+service_metrics = Metrics()
+request_seconds = service_metrics.histogram('search_request_seconds', 'Wall time of a request.', ('endpoint', 'status'))
+stage_seconds = service_metrics.histogram('search_stage_seconds', 'Wall time of each stage of a request.', ('endpoint', 'stage'))
+postings_read = service_metrics.counter('search_postings_read_total', 'Postings read from storage.', ('index',))
+bytes_read = service_metrics.counter('search_posting_bytes_read_total', 'Posting bytes read from storage.', ('index',))
+service_metrics.caches('search_cache', posting=posting_cache, result=result_cache)
+
+
+"""
+Returns the RequestTimer of the current request
+Returns:
+  RequestTimer, or None outside of a request
+"""
+def currentTimer():
+  return g.get('timer') if has_request_context() else None
 
 
 # ---------------------------------------- Initialize the search engine --------------------------------------
@@ -55,6 +329,59 @@ app = MyFlaskApp(__name__)
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = False
 
 
+# Seconds a request may run. Each stage checks the deadline before it starts
+# and waits on posting reads no longer than it leaves, so a request past it is
+# answered with a 503 instead of holding its worker thread (gunicorn's own
+# timeout only restarts a worker that stops responding altogether).
+request_timeout = float(os.environ.get('REQUEST_TIMEOUT', 30))
+
+
+@app.before_request
+def startTimer():
+    g.timer = RequestTimer(request_timeout if request_timeout > 0 else None)
+
+@app.errorhandler(DeadlineExceeded)
+def deadlineExceeded(e):
+    return jsonify({'error': str(e)}), 503
+
+@app.after_request
+def recordTimer(response):
+    ''' Adds the timings of the request to the metrics, and with ?debug=timing
+        returns them in a Server-Timing header and next to the results.
+    '''
+    timer = g.get('timer')
+    if timer is None or request.endpoint == 'metrics':
+      return response
+    endpoint = request.endpoint or 'unknown'
+    request_seconds.observe(timer.elapsed(), endpoint, str(response.status_code))
+    stage_seconds.observe_many((seconds, (endpoint, stage)) for stage, seconds in timer.stages.items())
+    if request.args.get('debug') == 'timing':
+      response.headers['Server-Timing'] = timer.server_timing()
+      if response.is_json and not response.is_streamed:
+        response.set_data(json.dumps({'results': response.get_json(), 'timing': timer.as_dict()}))
+    return response
+
+
+@app.route("/metrics")
+def metrics():
+    ''' Returns the request and stage latency histograms, posting reads and
+        cache statistics of this process in the Prometheus text format.
+    '''
+    return Response(service_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/ready")
+def ready():
+    ''' Readiness probe for the load balancer. Answers 200 once every index is
+        loaded (or right away with INDEX_WARMUP=off) and 503 while warming up.
+    Returns:
+    --------
+        dict with the loading status of each index.
+    '''
+    status = loader.status()
+    return jsonify(status), (200 if status['ready'] or warm_up_mode == 'off' else 503)
+
+
 #--------------------------------------------- Query handler --------------------------------------------------
 
 
@@ -67,79 +394,316 @@ Returns:
 """
 def query_handler(text):
 
-    tokens = [stemmer.stem(token.group()) for token in RE_WORD.finditer(text.lower()) if token.group() not in all_stopwords]
-    sizeOfDoc = len(tokens)
-    word_counts = Counter(tokens)
-    query_dict = {token: count / sizeOfDoc for token, count in word_counts.items()}
-    return query_dict
+    return analyzer.query(text)
 
 
 #--------------------------------------------- calculateBM25 --------------------------------------------------
 
 
+"""
+Returns the corpus statistics BM25 is computed with: the size of the corpus,
+the average body length and the body df
+Returns:
+  (N, avg, df) tuple
+"""
+def bm25Stats():
+  N, avg_doc_len = corpusStats()
+  return N, avg_doc_len, index_body.df
+
+
+"""
+Calculates the BM25 score of each candidate document
+Parameters:
+  query_dict: (dict) A dictionary of the query
+  cand: (np.ndarray) Sorted candidate doc ids
+  postings: (dict) Prefetched posting lists (see fetcher.fetch), optional
+  stats: (tuple) (N, avg, df) to score with instead of bm25Stats(), optional
+Returns:
+  (scores, firstTerm) arrays aligned with cand, where firstTerm is the position
+  in the query of the first term that hit each doc (len(query_dict) if none)
+"""
+def bm25Scores(query_dict, cand, postings=None, stats=None):
+
+  k1 = BM25_K1
+  k3 = BM25_K3
+  b = BM25_B
+
+  N, avg_doc_len, df = stats if stats is not None else bm25Stats()
+  B = 1 - b + b * (lookupDocLengths(cand) / avg_doc_len)
+
+  scores = np.zeros(len(cand))
+  firstTerm = np.full(len(cand), len(query_dict))   # Term that first hit each doc
+
+  for t, (term, value) in enumerate(query_dict.items()):
+    if term not in df:
+      continue
+    F = math.log10((N + 1) / df[term])
+    H = ((k3 + 1) * value) / (k3 + value)
+
+    post = postingFor('body', term, postings)
+
+    pos = np.searchsorted(post.doc_ids, cand)
+    inside = pos < len(post)
+    hit = np.flatnonzero(inside)[post.doc_ids[pos[inside]] == cand[inside]]
+    freq = post.tfs[pos[hit]].astype(np.float64)
+
+    G = ((k1 + 1) * freq) / (k1 * B[hit] + freq)
+    scores[hit] += G * F * H
+    firstTerm[hit] = np.minimum(firstTerm[hit], t)
+
+  return scores, firstTerm
+
+
 """
 Calculates similarity between the query and the documents according to BM25
 Parameters:
   query_dict: (dict) A dictionary of the query
   simDocTop: (Counter) Documents that passed the initial filter (id:score)
   alpha: (float) Weight
+  postings: (dict) Prefetched posting lists (see fetcher.fetch), optional
+Returns:
+  Counter so that key is an id, and value is score after BM25 (id:score)
+"""
+def calculateBM25(query_dict, simDocTop, alpha, postings=None):
+
+  if len(simDocTop) == 0:
+    return Counter()
+
+  # Candidates as a sorted array, so each posting list is joined with them by a
+  # binary search instead of a membership test per posting.
+  cand = np.fromiter(simDocTop.keys(), dtype=np.int64, count=len(simDocTop))
+  cand.sort()
+  scores, firstTerm = bm25Scores(query_dict, cand, postings)
+  return add_bm25_scores(cand, scores, firstTerm, len(query_dict), simDocTop, alpha)
+
+
+#--------------------------------------------- topByBM25 --------------------------------------------------
+
+
+"""
+Finds the best documents of the whole corpus by BM25 over the body index, using
+MaxScore pruning (see max_score_top_k) so long posting lists are mostly skipped
+Parameters:
+  query_dict: (dict) A dictionary of the query
+  alpha: (float) Weight
+  k: (int) Number of documents to return
+  postings: (dict) Prefetched posting lists (see fetcher.fetch), optional
+  stats: (tuple) (N, avg, df) to score with instead of bm25Stats(), optional
 Returns:
   Counter so that key is an id, and value is score after BM25 (id:score)
 """
-def calculateBM25(query_dict, simDocTop, alpha):
+def topByBM25(query_dict, alpha, k, postings=None, stats=None):
 
-  k1 = 1.2
-  k3 = 2.2
-  b = 0.7
-  
-  simDoc = Counter()
-  B_dict = {}
-  idf_values = {term: math.log10((N + 1) / index_body.df[term]) for term in query_dict}
+  docs, scores = bm25TopK(query_dict, k, postings, stats)
+  return scaled_scores(docs, scores, alpha)
 
+
+"""
+Finds the best k documents of the whole corpus by BM25 over the body index
+Parameters:
+  query_dict: (dict) A dictionary of the query
+  k: (int) Number of documents to return
+  postings: (dict) Prefetched posting lists (see fetcher.fetch), optional
+  stats: (tuple) (N, avg, df) to score with instead of bm25Stats(), optional
+Returns:
+  (doc_ids, scores) arrays by descending score, ties by ascending doc id
+"""
+def bm25TopK(query_dict, k, postings=None, stats=None):
+
+  k1 = BM25_K1
+  k3 = BM25_K3
+  b = BM25_B
+  N, avg_doc_len, df = stats if stats is not None else bm25Stats()
+
+  # Upper bounds computed at index time only hold for the same k1 and b.
+  max_scores = getattr(index_body, 'max_scores', {})
+  if getattr(index_body, 'max_scores_params', None) != (k1, b):
+    max_scores = {}
+
+  weights = {}
   for term, value in query_dict.items():
-    F = idf_values[term]
+    if term not in df:
+      continue
+    F = math.log10((N + 1) / df[term])
     H = ((k3 + 1) * value) / (k3 + value)
+    weights[term] = F * H
+
+  top = bodyImpactTopK(weights, k, df, avg_doc_len, postings)
+  if top is not None:
+    return top
+
+  postings = fetchMissing('body', query_dict, postings)
+  terms, sizes = [], []
+  for term, weight in weights.items():
+    sizes.append(df[term])
+    post = postingFor('body', term, postings)
+    if term in max_scores:
+      maxScore = max_scores[term]
+    else:
+      # Without a stored bound, the weight of the highest tf in an empty doc.
+      maxScore = float(bm25_tf_weight(float(post.tfs.max(initial=0)), 1 - b, k1))
+    terms.append((post, weight, maxScore))
 
-    post = index_body.read_a_posting_list('.', term, bucket_name)
-
-    for doc, freq in post:
-      if doc in simDocTop:
-        B_dict[doc] = B_dict.get(doc, 1 - b + b * (index_body.nf[doc] / index_body.nf["avg"]))
-        G = ((k1 + 1) * freq) / (k1 * B_dict[doc] + freq)
+  return max_score_top_k(terms, lookupDocLengths, avg_doc_len, k, k1, b, sizes)
 
-        simDoc[doc] += G * F * H
 
-  maxVal = max(simDoc.values(), default=1)
+"""
+Finds the best k documents by BM25 over the body from the impact-ordered
+prefixes of the query terms (see impact_top_k); the terms without a prefix
+have short lists, which are read in full
+Parameters:
+  weights: (dict) idf * query term factor of each query term in the index
+  k: (int) Number of documents to return
+  df: (dict) Body df of the terms
+  avg_doc_len: (float) Average body length
+  postings: (dict) Prefetched posting lists (see fetcher.fetch), optional
+Returns:
+  (doc_ids, scores) arrays like bm25TopK, or None if the prefixes do not
+  settle them (or the prefixes were built for other BM25 statistics)
+"""
+def bodyImpactTopK(weights, k, df, avg_doc_len, postings=None):
+
+  k1 = BM25_K1
+  b = BM25_B
+  if not usePrefixes('body', weights):
+    return None
+  if getattr(index_body, 'impact_params', None) != (k1, b, avg_doc_len) or min(weights.values()) <= 0:
+    return None
+  prefixes = posting_indexes['body_impact']
+
+  # Scores are summed in the order max_score_top_k visits the lists in.
+  lists = []
+  for term in sorted(weights, key=df.__getitem__):
+    prefix = term in prefixes.df
+    post = postingFor('body_impact' if prefix else 'body', term, postings)
+    B = 1 - b + b * (lookupDocLengths(post.doc_ids) / avg_doc_len)
+    impacts = weights[term] * bm25_tf_weight(post.tfs.astype(np.float64), B, k1)
+    if prefix:
+      lists.append((post.doc_ids, impacts, weights[term] * prefixes.floor(term)))
+    else:
+      order = np.lexsort((post.doc_ids, -impacts))
+      lists.append((post.doc_ids[order], impacts[order], 0))
 
-  return Counter({key: alpha * (value / maxVal) for key, value in simDoc.most_common()}) + simDocTop
+  top = impact_top_k(lists, k)
+  return None if top is None else top[:2]
 
 
 #--------------------------------------------- topByAnchorText --------------------------------------------------
 
 
+"""
+Finds the documents with the most anchor postings of the query terms
+Parameters:
+  query_dict: (dict) A dictionary of the query
+  filterSize: (int) Number of documents to return
+  postings: (dict) Prefetched posting lists (see fetcher.fetch), optional
+Returns:
+  (doc_ids, counts, firstTerm) arrays of the best documents, from best to worst
+"""
+def anchorCandidates(query_dict, filterSize, postings=None):
+
+  top = anchorImpactTopK(query_dict, filterSize, postings)
+  if top is not None:
+    return top
+  postings = fetchMissing('anchor', query_dict, postings)
+  posts = [postingFor('anchor', term, postings).doc_ids for term in query_dict]
+  return firstHitTopK(posts, None, filterSize)
+
+
+"""
+Finds the documents with the most anchor postings of the query terms from the
+impact-ordered prefixes of the terms (see impact_top_k); the terms without a
+prefix have short lists, which are read in full
+Parameters:
+  query_dict: (dict) A dictionary of the query
+  filterSize: (int) Number of documents to return
+  postings: (dict) Prefetched posting lists (see fetcher.fetch), optional
+Returns:
+  (doc_ids, counts, firstTerm) arrays like anchorCandidates, or None if the
+  prefixes do not settle them
+"""
+def anchorImpactTopK(query_dict, filterSize, postings=None):
+
+  if not usePrefixes('anchor', query_dict):
+    return None
+  prefixes = posting_indexes['anchor_impact']
+
+  lists = []
+  for term in query_dict:
+    if term in prefixes.df:
+      post = postingFor('anchor_impact', term, postings)
+      lists.append((post.doc_ids, post.tfs, prefixes.floor(term)))
+    else:
+      docs, counts = np.unique(postingFor('anchor', term, postings).doc_ids, return_counts=True)
+      order = np.lexsort((docs, -counts))
+      lists.append((docs[order], counts[order], 0))
+  return impact_top_k(lists, filterSize, by_first_term=True)
+
+
 """
 Filters 100 documents by their anchor text rating
 Parameters:
   query_dict: (dict) A dictionary of the query
   alpha: (float) Weight
+  postings: (dict) Prefetched posting lists (see fetcher.fetch), optional
 Returns:
   Counter so that key is an id, and value is score after filter (id:score)
 """
-def topByAnchorText(query_dict, alpha, filterSize):
+def topByAnchorText(query_dict, alpha, filterSize, postings=None):
 
-  simDoc = Counter()
-  for term, value in query_dict.items():
-    post = index_anchorText.read_a_posting_list('.', term, bucket_name)
-    for doc, freq in post:
-        simDoc[doc] += 1
+  docs, counts, _ = anchorCandidates(query_dict, filterSize, postings)
+  return scaled_scores(docs, counts, alpha)
+
+
+"""
+Sums the weights of the postings of each document over the query terms, and
+keeps the best documents
+Parameters:
+  posts: (list) Doc id arrays, one per query term, each sorted by doc id
+  weights: (list) Weight arrays aligned with posts, or None to count postings
+  filterSize: (int) Number of documents to return
+Returns:
+  (doc_ids, sums, firstTerm) arrays of the best documents, from best to worst,
+  ties broken by first appearance like Counter.most_common
+"""
+def firstHitTopK(posts, weights, filterSize):
 
-  maxVal = max(simDoc.values(), default=1)
-  return Counter({key: alpha * (value / maxVal) for key, value in simDoc.most_common(filterSize)})
+  if sum(len(doc_ids) for doc_ids in posts) == 0:
+    return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64)
+
+  ends = np.cumsum([len(doc_ids) for doc_ids in posts])
+  docs, first, inverse = np.unique(np.concatenate(posts), return_index=True, return_inverse=True)
+  if weights is None:
+    sums = np.bincount(inverse, minlength=len(docs))
+  else:
+    sums = np.bincount(inverse, weights=np.concatenate(weights), minlength=len(docs))
+  top = np.lexsort((first, -sums))[:filterSize]
+  # The first appearance of a doc is in the first term whose postings hold it.
+  return docs[top], sums[top], np.searchsorted(ends, first[top], side='right')
 
 
 #--------------------------------------------- topViewAndRankByTitle --------------------------------------------------
 
 
+"""
+Finds the documents whose titles have the highest summed prior over the query terms
+Parameters:
+  query_dict: (dict) A dictionary of the query
+  filterSize: (int) Number of documents to return
+Returns:
+  (doc_ids, sums, firstTerm) arrays of the best documents, from best to worst
+"""
+def titleCandidates(query_dict, filterSize):
+
+  # Each term's title postings come with their 1 + views + pagerank prior.
+  posts = [columns.title_postings.postings(term) for term in query_dict]
+  if len(posts) == 1:
+    docs, sums = posts[0]
+    top = top_k_indices(sums, filterSize)
+    return np.asarray(docs[top], dtype=np.int64), np.asarray(sums[top]), np.zeros(len(top), dtype=np.int64)
+  return firstHitTopK([doc_ids for doc_ids, prior in posts], [prior for doc_ids, prior in posts], filterSize)
+
+
 """
 Filters 100 documents by their title rating
 Parameters:
@@ -150,15 +714,184 @@ Returns:
 """
 def topViewAndRankByTitle(query_dict, alpha, filterSize):
 
-  simDoc = Counter()
-  for term, value in query_dict.items():
-    docTf = index_title.tf[term]
-    for doc, weight in docTf:
-      simDoc[doc] +=  1 + index_views[doc] + index_pageRanks[doc]
+  docs, sums, _ = titleCandidates(query_dict, filterSize)
+  return scaled_scores(docs, sums, alpha)
+
+
+"""
+Ranks the documents of a query: the /search pipeline without the result cache
+Parameters:
+  query_dict: (dict) A dictionary of the query
+  timer: (RequestTimer) Timer of the request
+  postings: (dict) Prefetched posting lists (see fetcher.fetch), optional; the
+            anchor and body lists are fetched here when it is None
+Returns:
+  list of up to 100 (wiki_id, title) tuples, from best to worst
+"""
+def rankQuery(query_dict, timer, postings=None):
+  if len(query_dict) == 1:
+    with timer.stage('title'):
+      simDoc = topViewAndRankByTitle(query_dict, 1, 50)
+
+  else:
+    # Read the anchor and body lists of every term at once; each stage only
+    # waits for the lists it scores.
+    if postings is None:
+      with timer.stage('fetch'):
+        postings = fetcher.fetch(rankingKeys(query_dict), timer)
+    with timer.stage('anchor'):
+      simDocByAnchorText = topByAnchorText(query_dict, 0.25, 140, postings)
+    with timer.stage('title'):
+      simDocByTitle = topViewAndRankByTitle(query_dict, 0.15, 110)
+    with timer.stage('bm25'):
+      if full_body_bm25:
+        simDoc = topByBM25(query_dict, 0.6, 100, postings) + simDocByAnchorText + simDocByTitle
+      else:
+        simDoc = calculateBM25(query_dict, simDocByAnchorText + simDocByTitle, 0.6, postings)
+
+  with timer.stage('titles'):
+    return [(str(item[0]), titleOf(item[0])) for item in simDoc.most_common(100)]
+
+
+"""
+Puts the terms of a query in a fixed (sorted) order. The anchor and title scores
+break ties by the first matching query term, so /search ranks a query this way
+to give every permutation of its terms the same, cacheable, result
+Parameters:
+  query_dict: (dict) A dictionary of the query
+Returns:
+  dict of the same terms and weights, sorted by term
+"""
+def orderedQuery(query_dict):
+  return dict(sorted(query_dict.items()))
+
+
+"""
+Normalizes a query dictionary into its result cache key, so term order does not matter
+Parameters:
+  query_dict: (dict) A dictionary of the query
+Returns:
+  tuple of (term, weight) pairs
+"""
+def queryKey(query_dict):
+  return tuple(sorted(query_dict.items()))
+
+
+# /search_batch scores its queries in chunks of BATCH_CHUNK_SIZE. The posting
+# lists of a chunk are read once, shared by all its queries and released when
+# the chunk is done, which bounds the memory of a large batch; later chunks find
+# the lists they share with earlier ones in the posting list cache.
+batch_chunk_size = int(os.environ.get('BATCH_CHUNK_SIZE', 1000))
+batch_max_queries = int(os.environ.get('BATCH_MAX_QUERIES', 100000))
 
 
-  maxVal = max(simDoc.values(), default=1)
-  return Counter({key: alpha * (value / maxVal) for key, value in simDoc.most_common(filterSize)})
+"""
+Ranks a batch of queries, reading the posting lists of their distinct terms once
+Parameters:
+  queries: (list) Queries (str)
+  timer: (RequestTimer) Timer of the request, optional
+Returns:
+  Generator of the results of each query (see rankQuery), in order
+"""
+def searchBatch(queries, timer=None):
+  timer = timer if timer is not None else RequestTimer()
+  for start in range(0, len(queries), batch_chunk_size):
+    chunk = queries[start:start + batch_chunk_size]
+    with timer.stage('tokenize'):
+      query_dicts = [orderedQuery(query_handler(query)) for query in chunk]
+
+    # Cached and repeated queries are answered without reading anything; the
+    # rest are ranked against one shared read of each distinct (index, term).
+    ranked, pending = {}, []
+    for query_dict in query_dicts:
+      terms = queryKey(query_dict)
+      if terms in ranked:
+        continue
+      ranked[terms] = result_cache.get(terms)
+      if ranked[terms] is None and len(query_dict) > 1:
+        pending.append(query_dict)
+
+    keys = sorted({key for query_dict in pending for key in rankingKeys(query_dict)})
+    with timer.stage('fetch'):
+      postings = fetcher.fetch(keys, timer)
+
+    for query_dict in query_dicts:
+      terms = queryKey(query_dict)
+      if ranked[terms] is None:
+        ranked[terms] = rankQuery(query_dict, timer, postings)
+        result_cache.put(terms, ranked[terms])
+      yield ranked[terms]
+
+
+# /search_title and /search_anchor return every matching document. The result
+# is streamed as one JSON array, RESULTS_BLOCK_SIZE rows at a time, so titles
+# are only looked up for the rows being sent. With ?limit=N a single page is
+# returned instead, and the X-Next-Cursor header holds the ?cursor= of the next.
+results_block_size = int(os.environ.get('RESULTS_BLOCK_SIZE', 1000))
+
+
+"""
+Streams ranked doc ids and their titles as a JSON array
+Parameters:
+  doc_ids: (np.ndarray) Doc ids, from best to worst
+Returns:
+  Generator of the chunks of the JSON text
+"""
+def streamResults(doc_ids):
+  yield '['
+  for start in range(0, len(doc_ids), results_block_size):
+    block = doc_ids[start:start + results_block_size]
+    rows = json.dumps(list(zip(map(str, block.tolist()), titlesOf(block))), separators=(',', ':'))[1:-1]
+    yield rows if start == 0 else ',' + rows
+  yield ']'
+
+
+"""
+Finds where the page of a cursor starts. A cursor is the "count.doc_id" of the
+last row of the previous page, so pages stay in place as long as the ranking does
+Parameters:
+  doc_ids: (np.ndarray) Doc ids, by descending count then ascending doc id
+  counts: (np.ndarray) Number of distinct query terms of each doc
+  cursor: (str) The cursor, or None for the first page
+Returns:
+  Position of the first row of the page (raises ValueError for a bad cursor)
+"""
+def cursorPosition(doc_ids, counts, cursor):
+  if not cursor:
+    return 0
+  count, doc_id = map(int, cursor.split('.'))
+  return int(np.count_nonzero(counts > count) + np.count_nonzero((counts == count) & (doc_ids <= doc_id)))
+
+
+"""
+Responds with all the ranked documents, streamed, or with the page of ?limit= and ?cursor=
+Parameters:
+  doc_ids: (np.ndarray) Doc ids, by descending count then ascending doc id
+  counts: (np.ndarray) Number of distinct query terms of each doc
+  timer: (RequestTimer) Timer of the request
+Returns:
+  Response
+"""
+def rankedResponse(doc_ids, counts, timer):
+  if request.args.get('limit') is None and request.args.get('cursor') is None:
+    return Response(stream_with_context(streamResults(doc_ids)), mimetype='application/json')
+  try:
+    limit = int(request.args.get('limit', results_block_size))
+    start = cursorPosition(doc_ids, counts, request.args.get('cursor'))
+    if limit <= 0:
+      raise ValueError(limit)
+  except ValueError:
+    return jsonify({'error': 'limit must be a positive integer and cursor one from X-Next-Cursor'}), 400
+
+  page = doc_ids[start:start + limit]
+  with timer.stage('titles'):
+    res = list(zip(map(str, page.tolist()), titlesOf(page)))
+  with timer.stage('jsonify'):
+    response = jsonify(res)
+  if start + limit < len(doc_ids):
+    last = start + limit - 1
+    response.headers['X-Next-Cursor'] = f'{counts[last]}.{doc_ids[last]}'
+  return response
 
 
 @app.route("/search")
@@ -185,20 +918,58 @@ def search():
       return jsonify(res)
     # BEGIN SOLUTION
     
-    query_dict = query_handler(query)
-
-    if len(query_dict) == 1:
-      simDoc = topViewAndRankByTitle(query_dict, 1, 50)
-
-    else:
-      simDocByAnchorText = topByAnchorText(query_dict, 0.25, 140)
-      simDocByTitle = topViewAndRankByTitle(query_dict, 0.15, 110)
-      simDoc = calculateBM25(query_dict, simDocByAnchorText + simDocByTitle, 0.6)
-
-    res = [(str(item[0]), dictIdTitle.tf[item[0]]) for item in simDoc.most_common(100)]
+    timer = g.timer
+    with timer.stage('tokenize'):
+      query_dict = orderedQuery(query_handler(query))
+    key = queryKey(query_dict)
+    res = result_cache.get(key)
+    if res is None:
+      res = rankQuery(query_dict, timer)
+      result_cache.put(key, res)
     
     # END SOLUTION
-    return jsonify(res)
+    with timer.stage('jsonify'):
+      return jsonify(res)
+
+@app.route("/search_batch", methods=['POST'])
+def search_batch():
+    ''' Returns the /search results of many queries at once. The posting lists
+        of the distinct terms of the batch are read once and shared by every
+        query that uses them (see searchBatch).
+
+        Test this by issuing a POST request to a URL like:
+          http://YOUR_SERVER_DOMAIN/search_batch
+        with a json payload of the list of queries. In python do:
+          import requests
+          requests.post('http://YOUR_SERVER_DOMAIN/search_batch', json=['hello world', 'python'])
+        Add ?stream=1 (or send Accept: application/x-ndjson) to receive one
+        line of JSON per query, {"query": ..., "results": [...]}, as soon as
+        it is ranked.
+    Returns:
+    --------
+        list with the results of each query, in order, where each element is
+        a list of up to 100 tuples (wiki_id, title).
+    '''
+    queries = request.get_json(silent=True)
+    if isinstance(queries, dict):
+      queries = queries.get('queries')
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+      return jsonify({'error': 'expected a JSON list of queries'}), 400
+    if len(queries) > batch_max_queries:
+      return jsonify({'error': f'at most {batch_max_queries} queries per batch'}), 413
+
+    timer = g.timer
+    if request.args.get('stream') == '1' or request.accept_mimetypes.best == 'application/x-ndjson':
+      # The request metrics only cover the time to the first line, and a
+      # stream that has started is not cut off by the deadline.
+      timer.deadline = None
+      lines = (json.dumps({'query': query, 'results': res}) + '\n'
+               for query, res in zip(queries, searchBatch(queries, timer)))
+      return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+    res = list(searchBatch(queries, timer))
+    with timer.stage('jsonify'):
+      return jsonify(res)
 
 @app.route("/search_body")
 def search_body():
@@ -222,8 +993,20 @@ def search_body():
       return jsonify(res)
     # BEGIN SOLUTION
 
+    # BM25 over the (stemmed) body index of the whole corpus.
+    timer = g.timer
+    with timer.stage('tokenize'):
+      query_dict = query_handler(query)
+    with timer.stage('fetch'):
+      postings = fetcher.fetch(prefixKeys(('body',), query_dict), timer)
+    with timer.stage('bm25'):
+      simDoc = topByBM25(query_dict, 1, 100, postings)
+    with timer.stage('titles'):
+      res = [(str(doc), titleOf(doc)) for doc in simDoc]
+
     # END SOLUTION
-    return jsonify(res)
+    with timer.stage('jsonify'):
+      return jsonify(res)
 
 @app.route("/search_title")
 def search_title():
@@ -252,8 +1035,15 @@ def search_title():
       return jsonify(res)
     # BEGIN SOLUTION
 
+    # The title index holds stemmed terms, so the query is stemmed like /search.
+    timer = g.timer
+    with timer.stage('tokenize'):
+      query_dict = query_handler(query)
+    with timer.stage('title'):
+      docs, counts = rank_by_term_count([columns.title_postings.postings(term)[0] for term in query_dict])
+    return rankedResponse(docs, counts, timer)
+
     # END SOLUTION
-    return jsonify(res)
 
 @app.route("/search_anchor")
 def search_anchor():
@@ -281,9 +1071,56 @@ def search_anchor():
     if len(query) == 0:
       return jsonify(res)
     # BEGIN SOLUTION
-    
+
+    # Like /search, the docs of the anchor postings are ranked; the anchor text
+    # index holds stemmed terms.
+    timer = g.timer
+    with timer.stage('tokenize'):
+      query_dict = query_handler(query)
+    with timer.stage('fetch'):
+      postings = fetcher.fetch(postingKeys(('anchor',), query_dict), timer)
+    with timer.stage('anchor'):
+      docs, counts = rank_by_term_count([postingFor('anchor', term, postings).doc_ids for term in query_dict])
+    return rankedResponse(docs, counts, timer)
+
     # END SOLUTION
-    return jsonify(res)
+
+"""
+Reads the wiki ids of a /get_pagerank or /get_pageview request: a JSON list of
+ids, or with Content-Type application/octet-stream packed little-endian uint32s
+Returns:
+  np.ndarray of doc ids (raises ValueError for a malformed payload)
+"""
+def requestIds():
+  if request.mimetype == 'application/octet-stream':
+    data = request.get_data()
+    if len(data) % 4 != 0:
+      raise ValueError('the payload is not a whole number of uint32s')
+    return np.frombuffer(data, dtype='<u4').astype(np.int64)
+  wiki_ids = request.get_json()
+  if not isinstance(wiki_ids, list):
+    raise ValueError('expected a JSON list of ids')
+  # Ids are looked up exactly: 1.7, "1", true or [1] are not ids.
+  if not all(type(wiki_id) is int for wiki_id in wiki_ids):
+    raise ValueError('expected a JSON list of integer ids')
+  return np.array(wiki_ids, dtype=np.int64)
+
+
+"""
+Responds with one value per requested id: a JSON list, or when the client
+accepts application/octet-stream the packed little-endian array, its dtype
+in the X-Dtype header
+Parameters:
+  values: (np.ndarray) The values
+Returns:
+  Response
+"""
+def valuesResponse(values):
+  if request.accept_mimetypes.best == 'application/octet-stream':
+    values = values.astype(values.dtype.newbyteorder('<'), copy=False)
+    return Response(values.tobytes(), mimetype='application/octet-stream', headers={'X-Dtype': values.dtype.str})
+  return jsonify(values.tolist())
+
 
 @app.route("/get_pagerank", methods=['POST'])
 def get_pagerank():
@@ -296,19 +1133,28 @@ def get_pagerank():
           requests.post('http://YOUR_SERVER_DOMAIN/get_pagerank', json=[1,5,8])
         As before YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        Large id lists can be posted as packed little-endian uint32s with
+        Content-Type: application/octet-stream, and with Accept:
+        application/octet-stream the scores are returned packed as well.
     Returns:
     --------
         list of floats:
           list of PageRank scores that correrspond to the provided article IDs.
     '''
     res = []
-    wiki_ids = request.get_json()
+    try:
+      wiki_ids = requestIds()
+    except (ValueError, TypeError, OverflowError) as e:
+      return jsonify({'error': str(e)}), 400
     if len(wiki_ids) == 0:
       return jsonify(res)
     # BEGIN SOLUTION
 
+    # One fancy index into the dense column; unknown ids get 0.
+    res = columns.pagerank.lookup(wiki_ids, 0)
+
     # END SOLUTION
-    return jsonify(res)
+    return valuesResponse(res)
 
 @app.route("/get_pageview", methods=['POST'])
 def get_pageview():
@@ -322,6 +1168,9 @@ def get_pageview():
           requests.post('http://YOUR_SERVER_DOMAIN/get_pageview', json=[1,5,8])
         As before YOUR_SERVER_DOMAIN is something like XXXX-XX-XX-XX-XX.ngrok.io
         if you're using ngrok on Colab or your external IP on GCP.
+        Large id lists can be posted as packed little-endian uint32s with
+        Content-Type: application/octet-stream, and with Accept:
+        application/octet-stream the counts are returned packed as well.
     Returns:
     --------
         list of ints:
@@ -329,15 +1178,114 @@ def get_pageview():
           provided list article IDs.
     '''
     res = []
-    wiki_ids = request.get_json()
+    try:
+      wiki_ids = requestIds()
+    except (ValueError, TypeError, OverflowError) as e:
+      return jsonify({'error': str(e)}), 400
     if len(wiki_ids) == 0:
       return jsonify(res)
     # BEGIN SOLUTION
 
+    # One fancy index into the dense column; unknown ids get 0.
+    res = columns.views.lookup(wiki_ids, 0)
+
     # END SOLUTION
-    return jsonify(res)
+    return valuesResponse(res)
+
+
+
+#----------------------------------------------- Shard endpoints -------------------------------------------------
+
+# Served by each shard of an index split into doc id ranges (see sharding.py).
+# The coordinator sends the query terms in order, as [term, weight] pairs, and
+# the corpus statistics of all shards together to compute BM25 with.
+
+
+"""
+Reads the query and the global BM25 statistics of a shard request
+Returns:
+  (payload, query_dict, stats) where stats is an (N, avg, df) tuple, or None
+  when the request has no statistics
+"""
+def shardRequest():
+  payload = request.get_json()
+  query_dict = {term: weight for term, weight in payload['query']}
+  stats = (payload['N'], payload['avg'], payload['df']) if 'N' in payload else None
+  return payload, query_dict, stats
+
+
+"""
+Lists doc ids, scores and first query terms as JSON ready lists
+"""
+def shardTopList(docs, scores, firstTerm):
+  return [docs.tolist(), scores.tolist(), firstTerm.tolist()]
+
+
+@app.route("/shard/candidates", methods=['POST'])
+def shard_candidates():
+    ''' Returns the best `anchor` documents of this shard by anchor text and the
+        best `title` documents by title, with their titles, and the shard's
+        statistics: N, average body length and the body df of the query terms.
+    '''
+    payload, query_dict, _ = shardRequest()
+    timer = g.timer
+    anchor_k, title_k = payload.get('anchor', 0), payload.get('title', 0)
+    empty = (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64))
+    with timer.stage('fetch'):
+      postings = fetcher.fetch(prefixKeys(('anchor',), query_dict) if anchor_k else [], timer)
+    if payload.get('bm25'):
+      # The body lists are read while the coordinator merges the candidates,
+      # so the /shard/bm25 request that follows finds them in the cache.
+      fetcher.fetch(postingKeys(('body',), query_dict))
+    with timer.stage('anchor'):
+      anchor = anchorCandidates(query_dict, anchor_k, postings) if anchor_k else empty
+    with timer.stage('title'):
+      title = titleCandidates(query_dict, title_k) if title_k else empty
+    with timer.stage('titles'):
+      docs = np.union1d(anchor[0], title[0])
+      titles = dict(zip(map(str, docs.tolist()), titlesOf(docs)))
+    N, avg_doc_len = corpusStats()
+    return jsonify({'N': int(N), 'avg': float(avg_doc_len),
+                    'df': {term: int(index_body.df.get(term, 0)) for term in query_dict},
+                    'anchor': shardTopList(*anchor), 'title': shardTopList(*title), 'titles': titles})
+
+
+@app.route("/shard/bm25", methods=['POST'])
+def shard_bm25():
+    ''' Returns the BM25 scores, computed with the global statistics, of the
+        candidate `docs` that this shard holds and a query term hits.
+    '''
+    payload, query_dict, stats = shardRequest()
+    timer = g.timer
+    cand = np.asarray(payload['docs'], dtype=np.int64)
+    with timer.stage('fetch'):
+      postings = fetcher.fetch(postingKeys(('body',), query_dict), timer)
+    with timer.stage('bm25'):
+      scores, firstTerm = bm25Scores(query_dict, cand, postings, stats)
+      hit = np.flatnonzero(firstTerm < len(query_dict))
+    return jsonify(shardTopList(cand[hit], scores[hit], firstTerm[hit]))
+
+
+@app.route("/shard/top_bm25", methods=['POST'])
+def shard_top_bm25():
+    ''' Returns this shard's best `k` documents by BM25 over the body, computed
+        with the global statistics (or the shard's own without them), with
+        their titles.
+    '''
+    payload, query_dict, stats = shardRequest()
+    timer = g.timer
+    with timer.stage('fetch'):
+      postings = fetcher.fetch(prefixKeys(('body',), query_dict), timer)
+    with timer.stage('bm25'):
+      docs, scores = bm25TopK(query_dict, payload['k'], postings, stats)
+    with timer.stage('titles'):
+      titles = titlesOf(docs)
+    return jsonify({'docs': docs.tolist(), 'scores': scores.tolist(), 'titles': titles})
 
 
 if __name__ == '__main__':
-    # run the Flask RESTful API, make the server publicly available (host='0.0.0.0') on port 8080
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    # run the Flask RESTful API, make the server publicly available (host='0.0.0.0') on port 8080.
+    # This is the development server; serve production traffic with
+    # gunicorn -c gunicorn.conf.py search_frontend:app
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)),
+            debug=os.environ.get('FLASK_DEBUG') == '1', threaded=True)
@@ -0,0 +1,609 @@
+import os
+import json
+import math
+import time
+import fcntl
+import pickle
+import shutil
+import argparse
+import threading
+from pathlib import Path
+from collections import Counter
+from contextlib import closing
+import numpy as np
+from inverted_index_gcp import InvertedIndex, MultiFileWriter, PostingList, encode_posting_list, \
+    release_posting_reader, POSTING_FORMAT
+from columnar_store import NumberColumn
+from retrieval import BM25_K1, BM25_B
+
+# A segment directory holds a manifest (the list of live segments, rewritten
+# atomically on every change) and one directory per segment:
+#   seg_NNNNNN/postings_NNN.bin  posting files
+#   seg_NNNNNN/index.pkl         InvertedIndex with posting_locs, df and max_scores
+#   seg_NNNNNN/nf.*.npy          document lengths (a NumberColumn)
+#   seg_NNNNNN/titles.pkl        doc_id -> title of the segment's documents
+#   seg_NNNNNN/deletes_G.npy     deletion bitmap as of manifest generation G
+# Segments are never modified once written; deleting a document only writes a
+# new bitmap, and merging writes a new segment that replaces the merged ones.
+MANIFEST = 'manifest.json'
+# Seconds between checks for a new manifest generation by SegmentedIndex.
+SEGMENTS_REFRESH = float(os.environ.get('SEGMENTS_REFRESH', 5))
+# Seconds that files no longer in the manifest are kept for readers of an
+# older generation before they are removed.
+SEGMENTS_GRACE = float(os.environ.get('SEGMENTS_GRACE', 60))
+
+
+class DeletionBitmap:
+    """ Set of deleted doc ids stored as one bit per doc id. """
+    def __init__(self, bits=None):
+        self.bits = np.zeros(0, dtype=np.uint8) if bits is None else bits
+
+    def add(self, doc_ids):
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        if len(doc_ids) == 0:
+            return
+        size = int(doc_ids.max()) // 8 + 1
+        if size > len(self.bits):
+            self.bits = np.concatenate([self.bits, np.zeros(size - len(self.bits), dtype=np.uint8)])
+        np.bitwise_or.at(self.bits, doc_ids >> 3, (1 << (doc_ids & 7)).astype(np.uint8))
+
+    def contains(self, doc_ids):
+        """ Returns a mask of the deleted doc ids in an array of doc ids. """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        found = np.zeros(len(doc_ids), dtype=bool)
+        inside = (doc_ids >> 3) < len(self.bits)
+        found[inside] = (self.bits[doc_ids[inside] >> 3] >> (doc_ids[inside] & 7)) & 1 == 1
+        return found
+
+    def doc_ids(self):
+        return np.flatnonzero(np.unpackbits(self.bits, bitorder='little'))
+
+    def __len__(self):
+        return int(np.unpackbits(self.bits).sum())
+
+    def copy(self):
+        return DeletionBitmap(self.bits.copy())
+
+    def write(self, path):
+        np.save(path, self.bits)
+
+    @classmethod
+    def open(cls, path):
+        return cls(np.load(path))
+
+
+def _write_json(path, obj):
+    tmp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    tmp.write_text(json.dumps(obj, indent=1))
+    os.replace(tmp, path)
+
+
+def _read_manifest(directory):
+    path = Path(directory) / MANIFEST
+    if not path.exists():
+        return {'generation': 0, 'next_segment': 0, 'base_deletes': None, 'segments': []}
+    return json.loads(path.read_text())
+
+
+class Segment:
+    """ An immutable segment opened for reading. """
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / 'index.pkl', 'rb') as f:
+            self.index = pickle.load(f)
+        self.nf = NumberColumn.open(self.path, 'nf')
+        with open(self.path / 'titles.pkl', 'rb') as f:
+            self.titles = pickle.load(f)
+
+    @staticmethod
+    def write(path, postings, nf, titles, version=POSTING_FORMAT):
+        """ Writes a segment to the new directory `path`.
+        Parameters:
+        -----------
+          postings: iterable of (term, posting list), each list a PostingList
+                    or [(doc_id, tf), ...] sorted by doc_id.
+          nf: dict mapping doc_id to document length.
+          titles: dict mapping doc_id to title.
+        """
+        path = Path(path)
+        path.mkdir(parents=True)
+        index = InvertedIndex()
+        with closing(MultiFileWriter(path, 'postings', version=version)) as writer:
+            for w, pl in postings:
+                index.df[w] = len(pl)
+                # file names relative to the segment, so segments can be moved.
+                index.posting_locs[w].extend((Path(f_name).name, offset)
+                                             for f_name, offset in writer.write(encode_posting_list(pl, version)))
+        # Bounds for an empty document hold whatever the corpus average becomes.
+        index.compute_upper_bounds(path, lambda doc_ids: np.zeros(len(doc_ids)), 1, BM25_K1, BM25_B)
+        index.write_index(path, 'index')
+        NumberColumn.build(nf, np.int32).write(path, 'nf')
+        with open(path / 'titles.pkl', 'wb') as f:
+            pickle.dump(titles, f)
+
+    def read_a_posting_array(self, w, deletes=None, stats=None):
+        """ Returns the postings of `w` in this segment that are not in `deletes`. """
+        post = self.index.read_a_posting_array(self.path, w, stats=stats)
+        if deletes is None or len(post) == 0:
+            return post
+        live = ~deletes.contains(post.doc_ids)
+        return PostingList(post.doc_ids[live], post.tfs[live])
+
+
+def merge_posting_lists(posts):
+    """ Merges posting lists of distinct documents into one sorted by doc_id. """
+    posts = [post for post in posts if len(post) > 0]
+    if len(posts) == 0:
+        return PostingList.empty()
+    if len(posts) == 1:
+        return posts[0]
+    doc_ids = np.concatenate([post.doc_ids for post in posts])
+    order = np.argsort(doc_ids, kind='stable')
+    return PostingList(doc_ids[order], np.concatenate([post.tfs for post in posts])[order])
+
+
+class TieredMergePolicy:
+    """ Picks segments to merge. Segments fall in tiers by live document count
+        (a factor of `segments_per_tier` apart, starting at `floor_docs`), and
+        once a tier holds `segments_per_tier` segments they are merged into one
+        of the next tier. A segment with more than `max_deleted` of its
+        documents deleted is merged on its own to reclaim them. Merges never
+        produce segments above `max_merged_docs`.
+    """
+    def __init__(self, segments_per_tier=10, floor_docs=1000, max_merged_docs=5_000_000, max_deleted=0.3):
+        self.segments_per_tier = segments_per_tier
+        self.floor_docs = floor_docs
+        self.max_merged_docs = max_merged_docs
+        self.max_deleted = max_deleted
+
+    def tier(self, docs):
+        return int(math.log(max(docs, self.floor_docs) / self.floor_docs, self.segments_per_tier))
+
+    def find_merges(self, segments):
+        """ Returns lists of segment names to merge, given the manifest entries. """
+        live = {seg['name']: seg['docs'] - seg['deleted'] for seg in segments}
+        merges, merging = [], set()
+        tiers = {}
+        for seg in segments:
+            tiers.setdefault(self.tier(live[seg['name']]), []).append(seg['name'])
+        for tier in sorted(tiers):
+            names = sorted(tiers[tier], key=lambda name: live[name])[:self.segments_per_tier]
+            if len(names) == self.segments_per_tier and sum(live[name] for name in names) <= self.max_merged_docs:
+                merges.append(names)
+                merging.update(names)
+        for seg in segments:
+            if seg['name'] not in merging and seg['docs'] > 0 \
+                    and seg['deleted'] > self.max_deleted * seg['docs']:
+                merges.append([seg['name']])
+        return merges
+
+
+class SegmentWriter:
+    """ Adds, deletes and merges segments of the directory `directory`. Only one
+        writer may have a directory open at a time; readers (SegmentedIndex) in
+        any number of processes follow the manifest.
+    """
+    def __init__(self, directory, merge_policy=None, version=POSTING_FORMAT):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.merge_policy = TieredMergePolicy() if merge_policy is None else merge_policy
+        self.version = version
+        self._lock_file = open(self.directory / 'write.lock', 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            raise RuntimeError(f'{self.directory} is open by another SegmentWriter')
+        self._manifest = _read_manifest(self.directory)
+        self._segments = {}      # opened segments by name
+        self._deletes = {}       # bitmap per segment name ('' for the base index)
+        self._dirty = set()      # bitmaps changed since the last commit
+        self._garbage = []       # (time, path) no longer in the manifest
+        self._lock = threading.Lock()
+        self._merge_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _bitmap(self, name):
+        """ Returns the deletion bitmap of segment `name` ('' for the base index). """
+        if name not in self._deletes:
+            if name == '':
+                f_name = self._manifest['base_deletes']
+                path = None if f_name is None else self.directory / f_name
+            else:
+                entry = self._entry(name)
+                path = None if entry['deletes'] is None else self.directory / name / entry['deletes']
+            self._deletes[name] = DeletionBitmap() if path is None else DeletionBitmap.open(path)
+        return self._deletes[name]
+
+    def _segment(self, name):
+        if name not in self._segments:
+            self._segments[name] = Segment(self.directory / name)
+        return self._segments[name]
+
+    def _entry(self, name):
+        return next(seg for seg in self._manifest['segments'] if seg['name'] == name)
+
+    def _delete(self, doc_ids):
+        """ Marks doc_ids deleted in the base index and in every segment that
+            holds them. Called with the lock held.
+        """
+        doc_ids = np.asarray(sorted(doc_ids), dtype=np.int64)
+        for name in [''] + [seg['name'] for seg in self._manifest['segments']]:
+            bitmap = self._bitmap(name)
+            new = doc_ids[~bitmap.contains(doc_ids)]
+            if name != '' and len(new) > 0:
+                new = new[self._segment(name).nf.lookup(new, -1) >= 0]
+            if len(new) > 0:
+                bitmap.add(new)
+                self._dirty.add(name)
+                if name != '':
+                    self._entry(name)['deleted'] += len(new)
+
+    def _commit(self):
+        """ Writes the changed bitmaps and a new manifest generation. Called with
+            the lock held.
+        """
+        manifest = self._manifest
+        manifest['generation'] += 1
+        generation = manifest['generation']
+        for name in self._dirty:
+            f_name = f'deletes_{generation}.npy'
+            if name == '':
+                f_name = f'base_{f_name}'
+                old, manifest['base_deletes'] = manifest['base_deletes'], f_name
+                self._bitmap(name).write(self.directory / f_name)
+                old_path = None if old is None else self.directory / old
+            else:
+                entry = self._entry(name)
+                old, entry['deletes'] = entry['deletes'], f_name
+                self._bitmap(name).write(self.directory / name / f_name)
+                old_path = None if old is None else self.directory / name / old
+            if old_path is not None:
+                self._garbage.append((time.monotonic(), old_path))
+        self._dirty.clear()
+        _write_json(self.directory / MANIFEST, manifest)
+
+    def _new_segment_name(self):
+        name = f"seg_{self._manifest['next_segment']:06}"
+        self._manifest['next_segment'] += 1
+        return name
+
+    def add_documents(self, docs, titles=None):
+        """ Adds (or replaces) documents as one new segment.
+        Parameters:
+        -----------
+          docs: dict mapping doc_id to its list of tokens.
+          titles: dict mapping doc_id to title, optional.
+        """
+        if len(docs) == 0:
+            return None
+        index = InvertedIndex()
+        for doc_id in sorted(docs):
+            index.add_doc(doc_id, docs[doc_id])
+        nf = {doc_id: len(tokens) for doc_id, tokens in docs.items()}
+        with self._lock:
+            name = self._new_segment_name()
+        Segment.write(self.directory / name, sorted(index._posting_list.items()), nf,
+                      dict(titles or {}), self.version)
+        with self._lock:
+            # Older versions of the documents are deleted in the same commit
+            # that makes the new segment visible.
+            self._delete(docs.keys())
+            self._manifest['segments'].append({'name': name, 'docs': len(nf), 'deleted': 0, 'deletes': None})
+            self._commit()
+        return name
+
+    def delete_documents(self, doc_ids):
+        with self._lock:
+            self._delete(doc_ids)
+            self._commit()
+
+    def maybe_merge(self):
+        """ Runs the merges the merge policy asks for, until it asks for none
+            (a merge can fill up the next tier). Returns the number of merges.
+        """
+        n_merges = 0
+        with self._merge_lock:
+            while True:
+                with self._lock:
+                    merges = self.merge_policy.find_merges(self._manifest['segments'])
+                if not merges:
+                    break
+                for names in merges:
+                    self._merge(names)
+                n_merges += len(merges)
+            self._collect_garbage()
+        return n_merges
+
+    def _merge(self, names):
+        with self._lock:
+            name = self._new_segment_name()
+            snapshot = {n: self._bitmap(n).copy() for n in names}
+            segments = [self._segment(n) for n in names]
+        terms = sorted(set().union(*(seg.index.posting_locs for seg in segments)))
+        postings = ((w, merge_posting_lists(seg.read_a_posting_array(w, snapshot[seg.path.name])
+                                            for seg in segments))
+                    for w in terms)
+        nf, titles = {}, {}
+        for seg in segments:
+            live = ~snapshot[seg.path.name].contains(seg.nf.ids)
+            nf.update(zip(seg.nf.ids[live].tolist(), seg.nf.values[live].tolist()))
+            titles.update((doc_id, title) for doc_id, title in seg.titles.items() if doc_id in nf)
+        # Merging segments whose documents were all deleted just drops them.
+        if nf:
+            Segment.write(self.directory / name, postings, nf, titles, self.version)
+
+        with self._lock:
+            # Documents deleted while the merge ran are deleted in its result.
+            deleted = [doc_id for n in names
+                       for doc_id in np.setdiff1d(self._bitmap(n).doc_ids(), snapshot[n].doc_ids()).tolist()
+                       if doc_id in nf]
+            segs = self._manifest['segments']
+            position = min(i for i, seg in enumerate(segs) if seg['name'] in names)
+            segs[:] = [seg for seg in segs if seg['name'] not in names]
+            if nf:
+                segs.insert(position, {'name': name, 'docs': len(nf), 'deleted': 0, 'deletes': None})
+            for n in names:
+                self._segments.pop(n, None)
+                self._deletes.pop(n, None)
+                self._dirty.discard(n)
+                self._garbage.append((time.monotonic(), self.directory / n))
+            if deleted:
+                self._bitmap(name).add(deleted)
+                self._entry(name)['deleted'] = len(deleted)
+                self._dirty.add(name)
+            self._commit()
+
+    def _collect_garbage(self, grace=SEGMENTS_GRACE):
+        now = time.monotonic()
+        with self._lock:
+            expired = [path for t, path in self._garbage if now - t >= grace]
+            self._garbage = [(t, path) for t, path in self._garbage if now - t < grace]
+        for path in expired:
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            elif path.exists():
+                path.unlink()
+
+    def start(self, interval=30):
+        """ Runs maybe_merge() every `interval` seconds on a background thread. """
+        def loop():
+            while not self._stop.wait(interval):
+                self.maybe_merge()
+        self._thread = threading.Thread(target=loop, name='segment-merge', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._lock_file.close()
+
+
+class _Snapshot:
+    """ The segments of one manifest generation. """
+    def __init__(self, generation, base_deletes, segments):
+        self.generation = generation
+        self.base_deletes = base_deletes
+        self.segments = segments      # list of (Segment, DeletionBitmap or None), oldest first
+        self.df = Counter()
+        self.max_scores = {}
+        for seg, _ in segments:
+            self.df.update(seg.index.df)
+            for w, bound in seg.index.max_scores.items():
+                self.max_scores[w] = max(self.max_scores.get(w, 0.0), bound)
+        self.stats = None
+
+
+class _MergedDf:
+    """ df of the base index plus the segments (deleted documents still count
+        until their segment is merged, as is usual for segment based indexes).
+    """
+    def __init__(self, base_df, df):
+        self._base_df = base_df
+        self._df = df
+
+    def __contains__(self, w):
+        return w in self._df or w in self._base_df
+
+    def __getitem__(self, w):
+        return self._base_df.get(w, 0) + self._df.get(w, 0)
+
+    def get(self, w, default=None):
+        return self[w] if w in self else default
+
+
+class _MergedBounds:
+    """ max_scores of the base index, scaled to stay upper bounds under the
+        current average length, combined with the segments' bounds.
+    """
+    def __init__(self, base_scores, scores, scale):
+        self._base_scores = base_scores
+        self._scores = scores
+        self._scale = scale
+
+    def __contains__(self, w):
+        return w in self._base_scores
+
+    def __getitem__(self, w):
+        return max(self._base_scores[w] * self._scale, self._scores.get(w, 0.0))
+
+    def get(self, w, default=None):
+        return self[w] if w in self else default
+
+
+class SegmentedIndex:
+    """ A base index with the segments of `directory` layered over it. Posting
+        lists are read from the base index and every segment, without deleted
+        documents, and merged by doc_id; df, the document lengths and the corpus
+        statistics account for the segments too. Other attributes are those of
+        the base index. The manifest is checked for a new generation at most
+        every `refresh` seconds, and `on_refresh()` is called when one is
+        picked up.
+    Parameters:
+    -----------
+      base_stats: function returning (N, avg_length) of the base index.
+      base_lengths: function mapping an array of doc ids to their lengths in the
+                    base index (0 if unknown).
+    """
+    def __init__(self, directory, base, base_stats, base_lengths, refresh=SEGMENTS_REFRESH, on_refresh=None):
+        self._directory = Path(directory)
+        self._base = base
+        self._base_stats = base_stats
+        self._base_lengths = base_lengths
+        self._refresh = refresh
+        self._on_refresh = on_refresh
+        self._opened = {}
+        self._snapshot = None
+        self._checked = -math.inf
+        self._lock = threading.Lock()
+
+    def _load(self, manifest):
+        deletes = lambda path: None if path is None else DeletionBitmap.open(path)
+        segments = []
+        for entry in manifest['segments']:
+            if entry['name'] not in self._opened:
+                self._opened[entry['name']] = Segment(self._directory / entry['name'])
+            seg = self._opened[entry['name']]
+            segments.append((seg, deletes(entry['deletes'] and seg.path / entry['deletes'])))
+        live = {entry['name'] for entry in manifest['segments']}
+        for name, seg in list(self._opened.items()):
+            if name not in live:
+                release_posting_reader(seg.path)
+                del self._opened[name]
+        base_deletes = deletes(manifest['base_deletes'] and self._directory / manifest['base_deletes'])
+        return _Snapshot(manifest['generation'], base_deletes, segments)
+
+    def current(self):
+        """ Returns the snapshot of the latest manifest generation. """
+        if time.monotonic() - self._checked < self._refresh and self._snapshot is not None:
+            return self._snapshot
+        with self._lock:
+            if time.monotonic() - self._checked >= self._refresh or self._snapshot is None:
+                manifest = _read_manifest(self._directory)
+                changed = self._snapshot is not None and self._snapshot.generation != manifest['generation']
+                if self._snapshot is None or changed:
+                    self._snapshot = self._load(manifest)
+                self._checked = time.monotonic()
+                if changed and self._on_refresh is not None:
+                    self._on_refresh()
+        return self._snapshot
+
+    @property
+    def generation(self):
+        return self.current().generation
+
+    @property
+    def base(self):
+        """ The index the segments are layered over. """
+        return self._base
+
+    def __getattr__(self, attr):
+        return getattr(self._base, attr)
+
+    def read_a_posting_array(self, base_dir, w, bucket_name=None, doc_ids=None, stats=None):
+        """ Reads the posting list of `w` from the base index (under `base_dir`)
+            and every segment, without deleted documents.
+        """
+        snap = self.current()
+        post = self._base.read_a_posting_array(base_dir, w, bucket_name, doc_ids, stats)
+        if snap.base_deletes is not None and len(post) > 0:
+            live = ~snap.base_deletes.contains(post.doc_ids)
+            post = PostingList(post.doc_ids[live], post.tfs[live])
+        return merge_posting_lists([post] + [seg.read_a_posting_array(w, deletes, stats)
+                                             for seg, deletes in snap.segments])
+
+    @property
+    def df(self):
+        return _MergedDf(self._base.df, self.current().df)
+
+    def _stats(self):
+        """ Returns (N, avg_length, bound scale) of the current snapshot. """
+        snap = self.current()
+        if snap.stats is None:
+            N, avg_length = self._base_stats()
+            total = N * avg_length
+            if snap.base_deletes is not None:
+                lengths = self._base_lengths(snap.base_deletes.doc_ids())
+                N -= int(np.count_nonzero(lengths))
+                total -= float(lengths.sum())
+            for seg, deletes in snap.segments:
+                live = np.ones(len(seg.nf.ids), dtype=bool) if deletes is None else ~deletes.contains(seg.nf.ids)
+                N += int(live.sum())
+                total += float(seg.nf.values[live].sum())
+            new_avg = total / N if N > 0 else avg_length
+            # A tf weight bound for average length avg stays one for a larger
+            # average new_avg once multiplied by new_avg / avg.
+            snap.stats = (N, new_avg, max(1.0, new_avg / avg_length) if avg_length > 0 else 1.0)
+        return snap.stats
+
+    @property
+    def N(self):
+        return self._stats()[0]
+
+    @property
+    def avg_length(self):
+        return self._stats()[1]
+
+    @property
+    def max_scores(self):
+        return _MergedBounds(getattr(self._base, 'max_scores', {}), self.current().max_scores, self._stats()[2])
+
+    def doc_lengths(self, doc_ids):
+        """ Returns the length of each doc in an array of doc ids, taking the
+            newest live version of each (0 if unknown or deleted).
+        """
+        snap = self.current()
+        lengths = np.asarray(self._base_lengths(doc_ids))
+        if snap.base_deletes is not None:
+            lengths = np.where(snap.base_deletes.contains(doc_ids), 0, lengths)
+        for seg, deletes in snap.segments:
+            seg_lengths = seg.nf.lookup(doc_ids, -1)
+            found = seg_lengths >= 0
+            if deletes is not None:
+                found &= ~deletes.contains(doc_ids)
+            lengths = np.where(found, seg_lengths, lengths)
+        return lengths
+
+    def title(self, doc_id):
+        """ Returns the title of a document added in a segment, or None. """
+        for seg, deletes in reversed(self.current().segments):
+            if doc_id in seg.titles and (deletes is None or not deletes.contains([doc_id])[0]):
+                return seg.titles[doc_id]
+        return None
+
+
+def main():
+    import pyarrow.parquet as pq
+    from index_builder import tokenize
+    parser = argparse.ArgumentParser(description='Add, delete and merge segments of a segment directory.')
+    parser.add_argument('directory')
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help='add (or replace) the documents of parquet files')
+    add.add_argument('parquet', nargs='+')
+    add.add_argument('--batch-size', type=int, default=10000, help='documents per segment')
+    delete = commands.add_parser('delete', help='delete documents')
+    delete.add_argument('doc_ids', nargs='+', type=int)
+    commands.add_parser('merge', help='run the merges the merge policy asks for')
+    args = parser.parse_args()
+
+    writer = SegmentWriter(args.directory)
+    try:
+        if args.command == 'add':
+            for path in args.parquet:
+                for batch in pq.ParquetFile(path).iter_batches(args.batch_size, columns=['id', 'title', 'text']):
+                    rows = [row for row in batch.to_pylist() if row['text'] is not None]
+                    writer.add_documents({row['id']: tokenize(row['text']) for row in rows},
+                                         {row['id']: row['title'] for row in rows})
+            writer.maybe_merge()
+        elif args.command == 'delete':
+            writer.delete_documents(args.doc_ids)
+        else:
+            writer.maybe_merge()
+    finally:
+        writer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,398 @@
+import os
+import sys
+import json
+import time
+import pickle
+import signal
+import argparse
+import subprocess
+import urllib.request
+from pathlib import Path
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from analyzer import Analyzer
+from index_builder import token2bucket_id
+from inverted_index_gcp import InvertedIndex, MultiFileWriter, PostingList, encode_posting_list, POSTING_FORMAT
+from columnar_store import ColumnStore, COLUMNS_DIR, N_EXTRA
+from retrieval import rank_candidates, scaled_scores, add_bm25_scores, BM25_K1, BM25_B
+
+# The indexes a shard holds postings of: (index pickle, posting directory).
+SHARDED_INDEXES = {
+    'body': (f'{COLUMNS_DIR}/indexBody.pkl', 'bucketBody'),
+    'anchor': ('bucketAnchorText/indexAnchorText.pkl', 'bucketAnchorText'),
+}
+
+# Seconds the coordinator waits for a shard to answer.
+SHARD_TIMEOUT = float(os.environ.get('SHARD_TIMEOUT', 10))
+
+
+def shard_bounds(doc_ids, n_shards):
+    """ Splits the doc id space into `n_shards` ranges holding about as many of
+        `doc_ids` (sorted) each.
+    Returns:
+    --------
+      list of n_shards + 1 bounds; shard i holds the doc ids in [bounds[i], bounds[i + 1]).
+    """
+    cuts = [int(doc_ids[len(doc_ids) * i // n_shards]) for i in range(1, n_shards)] if len(doc_ids) else []
+    return [0] + cuts + [2 ** 63 - 1]
+
+
+def shard_dir(out_dir, i):
+    return Path(out_dir) / f'shard_{i:03}'
+
+
+def split_bucket(source_dir, posting_dir, bucket_id, terms, bounds, shard_dirs, version):
+    """ Splits the posting lists of one bucket by doc id range and writes each
+        part into the same bucket of its shard as soon as it is read, with the
+        posting files named relative to the shard directory.
+    Parameters:
+    -----------
+      terms: list of (term, posting_locs, df) of the bucket in the source index.
+    Returns:
+    --------
+      list of (df, posting_locs) per shard.
+    """
+    index = InvertedIndex()
+    writers = [None] * len(shard_dirs)
+    results = [({}, defaultdict(list)) for _ in shard_dirs]
+    try:
+        for w, locs, df in sorted(terms):
+            index.posting_locs[w], index.df[w] = locs, df
+            post = index.read_a_posting_array(source_dir, w)
+            cuts = np.searchsorted(post.doc_ids, bounds)
+            for i, (out, start, end) in enumerate(zip(shard_dirs, cuts[:-1], cuts[1:])):
+                if end <= start:
+                    continue
+                if writers[i] is None:
+                    writers[i] = MultiFileWriter(Path(out) / posting_dir, bucket_id, version=version)
+                b = encode_posting_list(PostingList(post.doc_ids[start:end], post.tfs[start:end]), version)
+                shard_df, posting_locs = results[i]
+                shard_df[w] = int(end - start)
+                posting_locs[w].extend((os.path.relpath(f_name, out), offset) for f_name, offset in writers[i].write(b))
+    finally:
+        for writer in writers:
+            if writer is not None:
+                writer.close()
+
+    for (_, posting_locs), out, writer in zip(results, shard_dirs, writers):
+        if writer is not None:
+            with open(Path(out) / posting_dir / f'{bucket_id}_posting_locs.pickle', 'wb') as f:
+                pickle.dump(dict(posting_locs), f)
+    return [(shard_df, dict(posting_locs)) for shard_df, posting_locs in results]
+
+
+def split(source_dir, out_dir, n_shards, workers=os.cpu_count(), version=POSTING_FORMAT,
+          impact_prefix=0, impact_min_df=None):
+    """ Partitions the index in `source_dir` (laid out like the bucket, with a
+        column store) into `n_shards` doc id ranges of about as many body
+        documents each. Shard i is written to `out_dir`/shard_i in the same
+        layout, so search_frontend.py serves it with INDEX_BASE_DIR pointing
+        there: its body and anchor postings, body lengths, page views,
+        PageRank, titles and title postings are those of its documents, and
+        its meta.json has its own N (counted like the source's, see N_EXTRA)
+        and average length. With `impact_prefix`,
+        the shards' long body and anchor lists get impact-ordered prefixes
+        (see InvertedIndex.write_impact_prefixes).
+    Returns:
+    --------
+      list of the shard directories.
+    """
+    source_dir, out_dir = Path(source_dir).resolve(), Path(out_dir).resolve()
+    store = ColumnStore.open(source_dir / COLUMNS_DIR)
+    bounds = shard_bounds(np.asarray(store.body_nf.ids), n_shards)
+    shard_dirs = [shard_dir(out_dir, i) for i in range(n_shards)]
+
+    for name, (index_path, posting_dir) in SHARDED_INDEXES.items():
+        source = InvertedIndex.read_index(source_dir / Path(index_path).parent, Path(index_path).stem)
+        buckets = defaultdict(list)
+        for w, locs in source.posting_locs.items():
+            buckets[token2bucket_id(w)].append((w, locs, source.df[w]))
+        for out in shard_dirs:
+            (out / posting_dir).mkdir(parents=True, exist_ok=True)
+
+        shards = [InvertedIndex() for _ in shard_dirs]
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(split_bucket, str(source_dir), posting_dir, bucket_id, terms,
+                                   bounds, [str(out) for out in shard_dirs], version)
+                       for bucket_id, terms in buckets.items()]
+            for future in futures:
+                for shard, (df, posting_locs) in zip(shards, future.result()):
+                    shard.df.update(df)
+                    for w, locs in posting_locs.items():
+                        shard.posting_locs[w].extend(locs)
+
+        for shard, out in zip(shards, shard_dirs):
+            if hasattr(source, 'max_scores'):
+                # Bounds over all the documents still bound a shard's.
+                shard.max_scores = {w: source.max_scores[w] for w in shard.df if w in source.max_scores}
+                shard.max_scores_params = source.max_scores_params
+            if impact_prefix and name == 'body':
+                # BM25 impacts under the average length of all the shards,
+                # which the coordinator scores with.
+                shard.write_impact_prefixes(str(out), impact_prefix, impact_min_df, store.body_nf.lookup,
+                                            store.meta['avg'], BM25_K1, BM25_B)
+            elif impact_prefix:
+                shard.write_impact_prefixes(str(out), impact_prefix, impact_min_df)
+            (out / index_path).parent.mkdir(parents=True, exist_ok=True)
+            shard.write_index(str((out / index_path).parent), Path(index_path).stem)
+
+    for i, out in enumerate(shard_dirs):
+        lo, hi = bounds[i], bounds[i + 1]
+        body_nf = store.body_nf.restrict(lo, hi)
+        lengths = np.asarray(body_nf.values)
+        meta = {'N': len(lengths) + N_EXTRA, 'avg': float(lengths.mean()) if len(lengths) else 0.0,
+                'shard': i, 'shards': n_shards, 'doc_ids': [lo, hi]}
+        ColumnStore(body_nf, store.views.restrict(lo, hi), store.pagerank.restrict(lo, hi),
+                    store.titles.restrict(lo, hi), store.title_postings.restrict(lo, hi),
+                    meta).write(out / COLUMNS_DIR)
+    return shard_dirs
+
+
+class Coordinator:
+    """ Answers queries over an index split into doc id range shards, each
+        served by search_frontend.py (see its /shard endpoints). Every stage
+        of /search is fanned out to all shards in parallel and the per-shard
+        top-k lists are merged in the order the unsharded engine ranks in
+        (score, then first query term hit, then doc id), so the merge is exact.
+        BM25 is scored by the shards with the corpus statistics of all of them:
+        the documents and the body length total are summed, as is the df of
+        each term, and N is counted from them like a single index counts it.
+    """
+    def __init__(self, shard_urls, analyzer=None, timeout=SHARD_TIMEOUT):
+        self.shard_urls = [url.rstrip('/') for url in shard_urls]
+        self.analyzer = Analyzer() if analyzer is None else analyzer
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(4 * len(self.shard_urls), thread_name_prefix='shard')
+
+    def _post(self, url, path, payload):
+        request = urllib.request.Request(url + path, data=json.dumps(payload).encode('utf-8'),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.load(response)
+
+    def fan_out(self, path, payload):
+        """ POSTs `payload` to `path` of every shard at once.
+        Returns:
+        --------
+          list of the JSON answers, in shard order.
+        """
+        futures = [self._pool.submit(self._post, url, path, payload) for url in self.shard_urls]
+        return [future.result() for future in futures]
+
+    def ready(self):
+        """ Returns True once every shard answers its /ready probe with 200. """
+        try:
+            for url in self.shard_urls:
+                with urllib.request.urlopen(url + '/ready', timeout=self.timeout):
+                    pass
+            return True
+        except OSError:
+            return False
+
+    def wait_ready(self, timeout=600, interval=0.5):
+        deadline = time.monotonic() + timeout
+        while not self.ready():
+            if time.monotonic() > deadline:
+                raise TimeoutError('shards not ready')
+            time.sleep(interval)
+
+    @staticmethod
+    def global_stats(answers, query_dict):
+        """ Returns the (N, avg, df) of all the shards together, N counted like
+            the meta['N'] of a single index (see N_EXTRA).
+        """
+        docs = [answer['N'] - N_EXTRA for answer in answers]
+        # Lengths are whole numbers of terms, so each shard's total is exact.
+        total = sum(round(n * answer['avg']) for n, answer in zip(docs, answers))
+        df = {term: sum(answer['df'][term] for answer in answers) for term in query_dict}
+        n_docs = sum(docs)
+        return n_docs + N_EXTRA, total / n_docs if n_docs else 0.0, {term: n for term, n in df.items() if n}
+
+    @staticmethod
+    def merge_top(lists, k):
+        """ Merges per-shard (doc_ids, scores, firstTerm) lists into the best `k`.
+        Returns:
+        --------
+          (doc_ids, scores, firstTerm) arrays, from best to worst.
+        """
+        docs = np.concatenate([np.asarray(l[0], dtype=np.int64) for l in lists])
+        scores = np.concatenate([np.asarray(l[1], dtype=np.float64) for l in lists])
+        first = np.concatenate([np.asarray(l[2], dtype=np.int64) for l in lists])
+        top = rank_candidates(docs, scores, first)[:k]
+        return docs[top], scores[top], first[top]
+
+    def _payload(self, query_dict, **fields):
+        fields['query'] = [[term, weight] for term, weight in query_dict.items()]
+        return fields
+
+    def _stats_payload(self, query_dict, stats, **fields):
+        N, avg, df = stats
+        return self._payload(query_dict, N=N, avg=avg, df=df, **fields)
+
+    def search(self, query, full_body_bm25=False):
+        """ Ranks `query` like search_frontend's /search.
+        Returns:
+        --------
+          list of up to 100 (wiki_id, title) tuples, from best to worst.
+        """
+        # Terms in the order search_frontend.orderedQuery ranks them in.
+        query_dict = dict(sorted(self.analyzer.query(query).items()))
+        if not query_dict:
+            return []
+        single = len(query_dict) == 1
+        answers = self.fan_out('/shard/candidates', self._payload(
+            query_dict, anchor=0 if single else 140, title=50 if single else 110,
+            bm25=not single and not full_body_bm25))
+        titles = {}
+        for answer in answers:
+            titles.update(answer['titles'])
+
+        if single:
+            docs, sums, _ = self.merge_top([answer['title'] for answer in answers], 50)
+            simDoc = scaled_scores(docs, sums, 1)
+        else:
+            docs, counts, _ = self.merge_top([answer['anchor'] for answer in answers], 140)
+            simDocByAnchorText = scaled_scores(docs, counts, 0.25)
+            docs, sums, _ = self.merge_top([answer['title'] for answer in answers], 110)
+            simDocByTitle = scaled_scores(docs, sums, 0.15)
+            stats = self.global_stats(answers, query_dict)
+            if full_body_bm25:
+                docs, scores, bodyTitles = self.top_bm25(query_dict, 100, stats)
+                titles.update(bodyTitles)
+                simDoc = scaled_scores(docs, scores, 0.6) + simDocByAnchorText + simDocByTitle
+            else:
+                simDoc = self.bm25(query_dict, simDocByAnchorText + simDocByTitle, 0.6, stats)
+        return [(str(doc_id), titles.get(str(doc_id), '')) for doc_id, _ in simDoc.most_common(100)]
+
+    def bm25(self, query_dict, simDocTop, alpha, stats):
+        """ Adds the BM25 scores of the candidates in `simDocTop`, scored by the
+            shard holding each, like search_frontend's calculateBM25.
+        """
+        if len(simDocTop) == 0:
+            return Counter()
+        cand = np.sort(np.fromiter(simDocTop.keys(), dtype=np.int64, count=len(simDocTop)))
+        scores = np.zeros(len(cand))
+        firstTerm = np.full(len(cand), len(query_dict))
+        for docs, docScores, docFirst in self.fan_out('/shard/bm25', self._stats_payload(
+                query_dict, stats, docs=cand.tolist())):
+            pos = np.searchsorted(cand, docs)
+            scores[pos] = docScores
+            firstTerm[pos] = docFirst
+        return add_bm25_scores(cand, scores, firstTerm, len(query_dict), simDocTop, alpha)
+
+    def top_bm25(self, query_dict, k, stats):
+        """ Returns the best `k` (doc_ids, scores, titles) of all the shards by
+            BM25 over the body, by descending score, ties by ascending doc id.
+        """
+        answers = self.fan_out('/shard/top_bm25', self._stats_payload(query_dict, stats, k=k))
+        docs, scores, _ = self.merge_top(
+            [(answer['docs'], answer['scores'], np.zeros(len(answer['docs']))) for answer in answers], k)
+        titles = {str(doc_id): title for answer in answers for doc_id, title in zip(answer['docs'], answer['titles'])}
+        return docs, scores, titles
+
+    def search_body(self, query):
+        """ Ranks `query` like search_frontend's /search_body. """
+        query_dict = self.analyzer.query(query)
+        if not query_dict:
+            return []
+        stats = self.global_stats(self.fan_out('/shard/candidates', self._payload(query_dict)), query_dict)
+        docs, _, titles = self.top_bm25(query_dict, 100, stats)
+        return [(str(doc_id), titles[str(doc_id)]) for doc_id in docs.tolist()]
+
+
+def create_app(coordinator, full_body_bm25=None):
+    """ The coordinator's Flask app: /search and /search_body over the shards,
+        and /ready once every shard is.
+    """
+    from flask import Flask, request, jsonify
+    if full_body_bm25 is None:
+        full_body_bm25 = os.environ.get('FULL_BODY_BM25') == '1'
+    app = Flask(__name__)
+
+    def answer(search):
+        query = request.args.get('query', '')
+        if len(query) == 0:
+            return jsonify([])
+        try:
+            return jsonify(search(query))
+        except OSError as e:
+            return jsonify({'error': f'shard unavailable: {e}'}), 503
+
+    @app.route("/search")
+    def search():
+        return answer(lambda query: coordinator.search(query, full_body_bm25))
+
+    @app.route("/search_body")
+    def search_body():
+        return answer(coordinator.search_body)
+
+    @app.route("/ready")
+    def ready():
+        return ('', 200) if coordinator.ready() else ('', 503)
+
+    return app
+
+
+def run_local(shards_dir, port=8080, shard_port=None):
+    """ Serves every shard under `shards_dir` from its own search_frontend.py
+        process on localhost (on the ports after `port`), and the coordinator on
+        `port`. The shard processes are stopped with the coordinator.
+    """
+    dirs = sorted(Path(shards_dir).resolve().glob('shard_*'))
+    if not dirs:
+        raise FileNotFoundError(f'no shards in {shards_dir}')
+    shard_port = port + 1 if shard_port is None else shard_port
+    frontend = Path(__file__).resolve().with_name('search_frontend.py')
+    processes, urls = [], []
+    # Stopping the coordinator stops the shards too.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for i, directory in enumerate(dirs):
+            env = dict(os.environ, BUCKET_NAME='', INDEX_BASE_DIR=str(directory),
+                       PORT=str(shard_port + i), INDEX_WARMUP='sync')
+            processes.append(subprocess.Popen([sys.executable, str(frontend)], env=env))
+            urls.append(f'http://127.0.0.1:{shard_port + i}')
+        coordinator = Coordinator(urls)
+        coordinator.wait_ready()
+        create_app(coordinator).run(host='0.0.0.0', port=port, threaded=True)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split an index into doc id range shards and serve them.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('split', help='partition an index laid out like the bucket into shards')
+    p.add_argument('source', help='directory of the index, with its column store')
+    p.add_argument('out', help='directory to write shard_000, shard_001, ... into')
+    p.add_argument('--shards', type=int, required=True)
+    p.add_argument('--workers', type=int, default=os.cpu_count())
+    p.add_argument('--format', type=int, default=POSTING_FORMAT, help='posting file format version')
+    p.add_argument('--impact-prefix', type=int, default=0,
+                   help='documents in the impact-ordered prefix of each long list (0: none)')
+    p.add_argument('--impact-min-df', type=int, help='lists of more postings than this get a prefix')
+    p = commands.add_parser('serve', help='run the coordinator over running shards')
+    p.add_argument('--shards', required=True, help='comma separated shard URLs')
+    p.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8080)))
+    p = commands.add_parser('local', help='run every shard as a local process, and the coordinator')
+    p.add_argument('shards_dir')
+    p.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8080)))
+    p.add_argument('--shard-port', type=int, help='port of the first shard (default: --port + 1)')
+    args = parser.parse_args()
+
+    if args.command == 'split':
+        for directory in split(args.source, args.out, args.shards, args.workers, args.format,
+                               args.impact_prefix, args.impact_min_df):
+            print(directory)
+    elif args.command == 'serve':
+        create_app(Coordinator(args.shards.split(','))).run(host='0.0.0.0', port=args.port, threaded=True)
+    else:
+        run_local(args.shards_dir, args.port, args.shard_port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+from collections import defaultdict
+import numpy as np
+import pytest
+import index_builder
+from analyzer import Analyzer
+from columnar_store import NumberColumn
+from index_builder import KINDS, build
+from inverted_index_gcp import InvertedIndex, close_posting_readers
+from retrieval import bm25_tf_weight, BM25_K1, BM25_B
+
+WORDS = ['python', 'pythons', 'music', 'musical', 'film', 'films', 'war', 'wars', 'science',
+         'scientific', 'engine', 'engineering', 'history', 'river', 'rivers', 'city', 'the', 'of']
+
+
+@pytest.fixture(autouse=True)
+def fresh_readers():
+    yield
+    close_posting_readers()
+
+
+def make_pages(seed, n=300):
+    """ Pages with distinct ids in no particular order, some without any text. """
+    rng = np.random.default_rng(seed)
+    ids = rng.choice(10 * n, size=n, replace=False).tolist()
+
+    def text(size):
+        return ' '.join(rng.choice(WORDS, size=size).tolist())
+    return [{'id': id,
+             'text': text(int(rng.integers(0, 40))) if rng.random() > 0.05 else None,
+             'title': text(int(rng.integers(1, 4))),
+             'anchor_text': [{'id': int(rng.choice(ids)), 'text': text(int(rng.integers(1, 4)))}
+                             for _ in range(int(rng.integers(0, 4)))]}
+            for id in ids]
+
+
+def expected_index(kind, pages):
+    """ The postings of each term and the body lengths, built directly from
+        Analyzer.tokens: (postings, lengths).
+    """
+    analyzer = Analyzer()
+    column = KINDS[kind]['column']
+    if kind == 'anchor':
+        pairs = {(w, page['id'], anchor['id']) for page in pages for anchor in page['anchor_text']
+                 for w in analyzer.tokens(anchor['text'])}
+        postings = defaultdict(list)
+        for w, doc_id, dest_id in sorted(pairs):
+            postings[w].append((doc_id, dest_id))
+        return dict(postings), {}
+    index = InvertedIndex()
+    lengths = {}
+    for page in sorted(pages, key=lambda page: page['id']):
+        if page[column] is None:
+            continue
+        tokens = analyzer.tokens(page[column])
+        if tokens:
+            index.add_doc(page['id'], tokens)
+            lengths[page['id']] = len(tokens)
+    return {w: sorted(pl) for w, pl in index._posting_list.items()}, lengths
+
+
+def check_build(kind, pages, out, inverted, min_df, impact_prefix):
+    postings, lengths = expected_index(kind, pages)
+    postings = {w: pl for w, pl in postings.items() if len(pl) > min_df}
+    assert dict(inverted.df) == {w: len(pl) for w, pl in postings.items()}
+    for w, pl in postings.items():
+        assert inverted.read_a_posting_array(str(out), w).to_list() == pl, w
+
+    if kind != 'body':
+        return
+    nf = NumberColumn.open(out / KINDS['body']['base_dir'], 'nf')
+    assert dict(zip(nf.ids.tolist(), nf.values.tolist())) == lengths
+    avg = sum(lengths.values()) / len(lengths)
+    assert inverted.nf == {'avg': pytest.approx(avg)}
+    for w, pl in postings.items():
+        doc_ids, tfs = np.array(pl).T
+        B = 1 - BM25_B + BM25_B * (np.array([lengths[d] for d in doc_ids]) / avg)
+        weights = bm25_tf_weight(tfs.astype(np.float64), B, BM25_K1)
+        assert inverted.max_scores[w] == pytest.approx(weights.max())
+        if impact_prefix and len(pl) > impact_prefix:
+            order = np.lexsort((doc_ids, -weights))[:impact_prefix]
+            prefix = inverted.read_impact_prefix(str(out), w)
+            assert prefix.doc_ids.tolist() == doc_ids[order].tolist(), w
+            assert prefix.tfs.tolist() == tfs[order].tolist(), w
+
+
+def run_build(kind, paths, out, min_df, impact_prefix):
+    # Small batches and runs, so the build spills many runs and merges them.
+    return build(kind, paths, out, workers=2, batch_size=23, spill_postings=150, min_df=min_df,
+                 impact_prefix=impact_prefix, impact_min_df=impact_prefix)
+
+
+@pytest.mark.parametrize('kind', sorted(KINDS))
+def test_build_from_parquet(tmp_path, kind):
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+    pages = make_pages(seed=1)
+    paths = []
+    for i, start in enumerate(range(0, len(pages), 110)):
+        part = pages[start:start + 110]
+        paths.append(str(tmp_path / f'part_{i}.parquet'))
+        pq.write_table(pa.Table.from_pylist(part), paths[-1])
+    out = tmp_path / 'out'
+    inverted = run_build(kind, paths, out, min_df=2, impact_prefix=8 if kind == 'body' else 0)
+    check_build(kind, pages, out, inverted, 2, 8 if kind == 'body' else 0)
+
+
+@pytest.mark.parametrize('kind', sorted(KINDS))
+@pytest.mark.parametrize('seed', range(3))
+def test_build_matches_direct_index(tmp_path, monkeypatch, kind, seed):
+    """ The same checks without pyarrow: the batches come straight from the pages. """
+    pages = make_pages(seed)
+
+    def read_batches(paths, column, batch_size):
+        for path in paths:
+            for start in range(0, len(pages), batch_size):
+                batch = pages[start:start + batch_size]
+                yield [page[column] for page in batch], [page['id'] for page in batch]
+    monkeypatch.setattr(index_builder, 'read_batches', read_batches)
+    out = tmp_path / 'out'
+    impact_prefix = 8 if kind == 'body' else 0
+    inverted = run_build(kind, ['pages'], out, min_df=seed, impact_prefix=impact_prefix)
+    check_build(kind, pages, out, inverted, seed, impact_prefix)
@@ -0,0 +1,97 @@
+import threading
+import pytest
+from index_loader import IndexLoader
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, data, generation):
+        self.bucket, self.name, self.data, self.generation = bucket, name, data, generation
+
+    def download_to_filename(self, filename):
+        self.bucket.download(self)
+        with open(filename, 'wb') as f:
+            f.write(self.data)
+
+
+class FakeBucket:
+    """ The part of a storage bucket IndexLoader uses, in memory. Downloads
+        wait on `barrier`, if set, fail for the blob names in `failing` and
+        are counted by blob name.
+    """
+    def __init__(self):
+        self.blobs = {}
+        self.downloads = []
+        self.barrier = None
+        self.failing = set()
+        self.client = self
+
+    def put(self, name, data):
+        old = self.blobs.get(name)
+        self.blobs[name] = FakeBlob(self, name, data, 1 if old is None else old.generation + 1)
+
+    def download(self, blob):
+        if self.barrier is not None:
+            self.barrier.wait()
+        if blob.name in self.failing:
+            raise OSError(f'{blob.name} failed')
+        self.downloads.append(blob.name)
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+    def list_blobs(self, bucket_name, prefix):
+        return [blob for name, blob in sorted(self.blobs.items()) if name.startswith(prefix)]
+
+
+@pytest.fixture
+def loader(tmp_path):
+    bucket = FakeBucket()
+    loader = IndexLoader('bucket', tmp_path / 'cache', max_workers=4)
+    loader._bucket = bucket
+    return loader, bucket
+
+
+def test_fetch_dir_downloads_in_parallel(loader):
+    loader, bucket = loader
+    for i in range(4):
+        bucket.put(f'columns/c{i}.npy', bytes([i]))
+    # Every download waits for the other three, so serial downloads time out.
+    bucket.barrier = threading.Barrier(4, timeout=10)
+    local_dir = loader.fetch_dir('columns')
+    assert sorted(bucket.downloads) == [f'columns/c{i}.npy' for i in range(4)]
+    assert [(local_dir / f'c{i}.npy').read_bytes() for i in range(4)] == [bytes([i]) for i in range(4)]
+
+
+def test_fetch_dir_keeps_the_cache_current(loader):
+    loader, bucket = loader
+    for name in ('a.npy', 'b.npy', 'c.npy', 'notes.txt'):
+        bucket.put(f'columns/{name}', name.encode())
+    local_dir = loader.fetch_dir('columns', suffixes=['.npy'])
+    assert sorted(p.name for p in local_dir.iterdir() if p.suffix == '.npy') == ['a.npy', 'b.npy', 'c.npy']
+
+    bucket.downloads.clear()
+    bucket.put('columns/b.npy', b'new b')
+    del bucket.blobs['columns/c.npy']
+    local_dir = loader.fetch_dir('columns', suffixes=['.npy'])
+    # Only the changed blob is downloaded again, and the removed one is dropped.
+    assert bucket.downloads == ['columns/b.npy']
+    assert (local_dir / 'b.npy').read_bytes() == b'new b'
+    assert (local_dir / 'b.npy.generation').read_text() == '2'
+    assert not (local_dir / 'c.npy').exists()
+    assert not (local_dir / 'c.npy.generation').exists()
+    assert (local_dir / 'a.npy').read_bytes() == b'a.npy'
+
+
+def test_fetch_dir_raises_a_failed_download(loader):
+    loader, bucket = loader
+    bucket.put('columns/a.npy', b'a')
+    bucket.put('columns/b.npy', b'b')
+    local_dir = loader.fetch_dir('columns')
+    bucket.put('columns/a.npy', b'new a')
+    bucket.failing.add('columns/a.npy')
+    del bucket.blobs['columns/b.npy']
+    with pytest.raises(OSError):
+        loader.fetch_dir('columns')
+    # Nothing is dropped after a failed fetch.
+    assert (local_dir / 'a.npy').read_bytes() == b'a'
+    assert (local_dir / 'b.npy').exists()
@@ -0,0 +1,108 @@
+import pickle
+import numpy as np
+import pytest
+import inverted_index_gcp
+from inverted_index_gcp import (InvertedIndex, PostingList, encode_varints, decode_varints,
+                                encode_posting_list, close_posting_readers, file_version,
+                                FORMAT_V2_MAGIC, POSTING_FORMAT_V1, POSTING_FORMAT_V2, SKIP_INTERVAL)
+
+
+@pytest.fixture(autouse=True)
+def fresh_readers():
+    yield
+    close_posting_readers()
+
+
+def random_postings(rng, n, max_tf=5):
+    doc_ids = np.sort(rng.choice(10 * n + 10, size=n, replace=False))
+    tfs = rng.integers(1, max_tf + 1, size=n)
+    return list(zip(doc_ids.tolist(), tfs.tolist()))
+
+
+def test_varints_round_trip():
+    values = [0, 1, 127, 128, 129, 16383, 16384, 2 ** 21, 2 ** 32 - 1, 2 ** 35 + 3]
+    data = encode_varints(values)
+    assert len(data) == 1 + 1 + 1 + 2 + 2 + 2 + 3 + 4 + 5 + 6
+    assert decode_varints(data).tolist() == values
+
+
+def test_varints_empty():
+    assert encode_varints([]) == b''
+    assert len(decode_varints(b'')) == 0
+
+
+@pytest.mark.parametrize('n', [0, 1, 2, 127, 128, 129, 255, 256, 257, 1000])
+def test_posting_list_round_trip(n):
+    pl = random_postings(np.random.default_rng(n), n)
+    b = encode_posting_list(pl, POSTING_FORMAT_V2)
+    post = PostingList.from_v2(b)
+    assert post.to_list() == pl
+    assert int.from_bytes(b[:4], 'big') == len(b)
+    assert int.from_bytes(b[8:12], 'big') == -(-n // SKIP_INTERVAL)
+
+
+def test_large_tfs_and_doc_ids():
+    pl = [(0, 1), (5, 65535), (6, 65536), (1000, 70000), (2 ** 31 + 1, 2 ** 20)]
+    assert PostingList.from_v2(encode_posting_list(pl, POSTING_FORMAT_V2)).to_list() == pl
+
+
+def test_skip_table_decodes_blocks_of_doc_ids():
+    pl = random_postings(np.random.default_rng(1), 3 * SKIP_INTERVAL + 5)
+    b = encode_posting_list(pl, POSTING_FORMAT_V2)
+    doc_ids = [pl[0][0], pl[2 * SKIP_INTERVAL + 1][0], pl[-1][0] + 1]
+    post = PostingList.from_v2(b, doc_ids)
+    # the first, third and last blocks.
+    expected = pl[:SKIP_INTERVAL] + pl[2 * SKIP_INTERVAL:]
+    assert post.to_list() == expected
+    assert len(PostingList.from_v2(b, [-1])) == 0
+
+
+def build(tmp_path, docs, version, name='0'):
+    """ Writes the postings of `docs` as one bucket and returns the index. """
+    index = InvertedIndex(docs)
+    lists = sorted(index._posting_list.items())
+    InvertedIndex.write_a_posting_list((name, lists), tmp_path, version=version)
+    with open(tmp_path / f'{name}_posting_locs.pickle', 'rb') as f:
+        index.posting_locs = pickle.load(f)
+    return index, dict(lists)
+
+
+def random_docs(rng, n_docs, n_terms):
+    return {doc_id: [f't{t}' for t in rng.integers(0, n_terms, size=int(rng.integers(1, 40)))]
+            for doc_id in range(0, 3 * n_docs, 3)}
+
+
+@pytest.mark.parametrize('version', [POSTING_FORMAT_V1, POSTING_FORMAT_V2])
+def test_lists_spanning_files(tmp_path, monkeypatch, version):
+    monkeypatch.setattr(inverted_index_gcp, 'BLOCK_SIZE', 40)
+    index, lists = build(tmp_path, random_docs(np.random.default_rng(2), 300, 20), version)
+    assert len(list(tmp_path.glob('0_*.bin'))) > 10
+    assert any(len(locs) > 2 for locs in index.posting_locs.values())
+    for w, pl in lists.items():
+        assert index.read_a_posting_list(tmp_path, w) == pl
+    assert dict(index.posting_lists_iter(tmp_path)) == lists
+
+
+def test_version_1_files_still_read(tmp_path):
+    docs = random_docs(np.random.default_rng(3), 200, 10)
+    old, old_lists = build(tmp_path, docs, POSTING_FORMAT_V1, 'old')
+    new, new_lists = build(tmp_path, docs, POSTING_FORMAT_V2, 'new')
+    with open(tmp_path / 'old_000.bin', 'rb') as f:
+        assert file_version(f.read(len(FORMAT_V2_MAGIC))) == POSTING_FORMAT_V1
+    with open(tmp_path / 'new_000.bin', 'rb') as f:
+        assert file_version(f.read(len(FORMAT_V2_MAGIC))) == POSTING_FORMAT_V2
+    assert old_lists == new_lists
+    for w, pl in old_lists.items():
+        assert old.read_a_posting_list(tmp_path, w) == pl
+        assert new.read_a_posting_list(tmp_path, w) == pl
+    # one index may hold lists of both formats.
+    mixed = {w: old.posting_locs[w] if i % 2 else new.posting_locs[w]
+             for i, w in enumerate(sorted(old_lists))}
+    old.posting_locs = mixed
+    for w, pl in old_lists.items():
+        assert old.read_a_posting_array(tmp_path, w).to_list() == pl
+
+
+def test_missing_term_is_empty(tmp_path):
+    index, _ = build(tmp_path, {1: ['a']}, POSTING_FORMAT_V2)
+    assert len(index.read_a_posting_array(tmp_path, 'b')) == 0
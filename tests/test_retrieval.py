@@ -0,0 +1,181 @@
+import numpy as np
+import pytest
+from inverted_index_gcp import PostingList
+from retrieval import bm25_tf_weight, max_score_top_k, impact_top_k, BM25_K1, BM25_B
+
+
+def random_lists(rng, n_docs, n_terms, max_df, max_tf):
+    """ Returns sorted, duplicate-free posting lists of random documents. """
+    lists = []
+    for _ in range(n_terms):
+        df = int(rng.integers(0, max_df + 1))
+        doc_ids = np.sort(rng.choice(n_docs, size=min(df, n_docs), replace=False)).astype(np.int64)
+        tfs = rng.integers(1, max_tf + 1, size=len(doc_ids)).astype(np.uint32)
+        lists.append(PostingList(doc_ids, tfs))
+    return lists
+
+
+def exhaustive_bm25(terms, lengths, avg_length, k, sizes=None):
+    """ Scores every document of every list, summing each document's score over
+        the lists from the shortest (by `sizes`) up, as max_score_top_k does.
+    """
+    sizes = [len(post) for post, _, _ in terms] if sizes is None else sizes
+    scores = np.zeros(len(lengths))
+    order = sorted(range(len(terms)), key=lambda i: sizes[i])
+    for i in order:
+        post, weight, _ = terms[i]
+        B = 1 - BM25_B + BM25_B * (lengths[post.doc_ids] / avg_length)
+        scores[post.doc_ids] += weight * bm25_tf_weight(post.tfs.astype(np.float64), B)
+    docs = np.unique(np.concatenate([post.doc_ids for post, _, _ in terms]))
+    top = np.lexsort((docs, -scores[docs]))[:k]
+    return docs[top], scores[docs[top]]
+
+
+def with_bounds(lists, weights, lengths, avg_length):
+    """ Pairs each list with its weight and its max tf weight, as
+        InvertedIndex.compute_upper_bounds stores it.
+    """
+    terms = []
+    for post, weight in zip(lists, weights):
+        B = 1 - BM25_B + BM25_B * (lengths[post.doc_ids] / avg_length)
+        max_score = float(np.max(bm25_tf_weight(post.tfs.astype(np.float64), B), initial=0.0))
+        terms.append((post, weight, max_score))
+    return terms
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_max_score_matches_exhaustive(seed):
+    rng = np.random.default_rng(seed)
+    n_docs = int(rng.integers(1, 300))
+    # few distinct lengths, tfs and weights, so that scores tie.
+    lengths = rng.choice([10, 20, 40], size=n_docs).astype(np.float64)
+    avg_length = float(lengths.mean())
+    lists = random_lists(rng, n_docs, int(rng.integers(1, 6)), int(rng.integers(0, 120)), 3)
+    weights = rng.choice([0.5, 1.0, 2.0], size=len(lists))
+    terms = with_bounds(lists, weights, lengths, avg_length)
+    k = int(rng.integers(1, 60))
+
+    docs, scores = max_score_top_k(terms, lambda ids: lengths[ids], avg_length, k)
+    expected_docs, expected_scores = exhaustive_bm25(terms, lengths, avg_length, k)
+    np.testing.assert_array_equal(docs, expected_docs)
+    np.testing.assert_array_equal(scores, expected_scores)
+
+
+def test_max_score_k_above_matches():
+    lengths = np.array([10.0, 20.0, 30.0, 40.0])
+    lists = [PostingList(np.array([0, 2]), np.array([1, 1], dtype=np.uint32)),
+             PostingList(np.array([2, 3]), np.array([2, 1], dtype=np.uint32))]
+    terms = with_bounds(lists, [1.0, 1.0], lengths, 25.0)
+    docs, scores = max_score_top_k(terms, lambda ids: lengths[ids], 25.0, 10)
+    assert docs.tolist() == [2, 0, 3]
+    assert np.all(np.diff(scores) <= 0)
+
+
+def test_max_score_ties_by_doc_id():
+    lengths = np.full(6, 10.0)
+    lists = [PostingList(np.arange(6), np.ones(6, dtype=np.uint32))]
+    terms = with_bounds(lists, [1.0], lengths, 10.0)
+    docs, scores = max_score_top_k(terms, lambda ids: lengths[ids], 10.0, 3)
+    assert docs.tolist() == [0, 1, 2]
+    assert len(set(scores.tolist())) == 1
+
+
+def test_max_score_empty():
+    docs, scores = max_score_top_k([(PostingList.empty(), 1.0, 0.0)], lambda ids: ids, 1.0, 5)
+    assert len(docs) == 0 and len(scores) == 0
+
+
+def test_max_score_shard_sizes_keep_order():
+    # A shard visits its lists by the df of the whole corpus.
+    rng = np.random.default_rng(7)
+    lengths = rng.choice([10, 20, 40], size=100).astype(np.float64)
+    lists = random_lists(rng, 100, 3, 80, 3)
+    terms = with_bounds(lists, [1.0, 1.5, 0.5], lengths, 20.0)
+    sizes = [len(post) for post in lists][::-1]
+    docs, scores = max_score_top_k(terms, lambda ids: lengths[ids], 20.0, 10, sizes=sizes)
+    expected_docs, expected_scores = exhaustive_bm25(terms, lengths, 20.0, 10, sizes)
+    np.testing.assert_array_equal(docs, expected_docs)
+    np.testing.assert_array_equal(scores, expected_scores)
+
+
+def random_impacts(rng, n_docs, n_terms, max_df, floats):
+    """ Returns (doc_ids, impacts) per term: distinct random documents, with
+        small integer impacts (which tie) or float ones.
+    """
+    lists = []
+    for _ in range(n_terms):
+        doc_ids = rng.choice(n_docs, size=int(rng.integers(0, min(max_df, n_docs) + 1)), replace=False)
+        impacts = rng.random(len(doc_ids)) * 3 if floats else rng.integers(1, 4, size=len(doc_ids))
+        lists.append((doc_ids.astype(np.int64), impacts))
+    return lists
+
+
+def exhaustive_impacts(lists, k, by_first_term):
+    """ Sums the impacts of every document over the full lists, in list order. """
+    docs = np.unique(np.concatenate([doc_ids for doc_ids, _ in lists]))
+    scores = np.zeros(len(docs), dtype=np.result_type(*(impacts.dtype for _, impacts in lists)))
+    first = np.full(len(docs), len(lists))
+    for t, (doc_ids, impacts) in enumerate(lists):
+        pos = np.searchsorted(docs, doc_ids)
+        scores[pos] += impacts
+        first[pos] = np.minimum(first[pos], t)
+    keys = (docs, first, -scores) if by_first_term else (docs, -scores)
+    top = np.lexsort(keys)[:k]
+    return docs[top], scores[top], first[top]
+
+
+def prefixes_of(lists, size):
+    """ Cuts each list to its `size` best postings by impact, as
+        InvertedIndex.write_impact_prefixes does.
+    """
+    prefixes = []
+    for doc_ids, impacts in lists:
+        order = np.lexsort((doc_ids, -impacts))
+        floor = impacts[order[size]] if len(order) > size else 0
+        prefixes.append((doc_ids[order[:size]], impacts[order[:size]], floor))
+    return prefixes
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_impact_top_k_is_exact_or_none(seed):
+    rng = np.random.default_rng(seed)
+    floats = seed % 2 == 1
+    lists = random_impacts(rng, int(rng.integers(1, 200)), int(rng.integers(1, 4)), 150, floats)
+    k = int(rng.integers(1, 40))
+    by_first_term = seed % 3 == 0
+    expected = exhaustive_impacts(lists, k, by_first_term)
+
+    # Whole lists as prefixes always settle.
+    top = impact_top_k(prefixes_of(lists, 10 ** 6), k, by_first_term)
+    for got, want in zip(top, expected):
+        np.testing.assert_array_equal(got, want)
+
+    top = impact_top_k(prefixes_of(lists, int(rng.integers(1, 60))), k, by_first_term)
+    if top is not None:
+        for got, want in zip(top, expected):
+            np.testing.assert_array_equal(got, want)
+
+
+def test_impact_top_k_settles_single_terms():
+    # One term: the first k + 1 postings decide the top k.
+    rng = np.random.default_rng(0)
+    lists = random_impacts(rng, 1000, 1, 1000, True)
+    top = impact_top_k(prefixes_of(lists, 100), 10, False)
+    assert top is not None
+    np.testing.assert_array_equal(top[0], exhaustive_impacts(lists, 10, False)[0])
+
+
+def test_impact_top_k_k_above_matches():
+    lists = [(np.array([5, 3]), np.array([2, 1])), (np.array([3, 9]), np.array([1, 1]))]
+    docs, scores, first = impact_top_k(prefixes_of(lists, 10), 10, True)
+    assert docs.tolist() == [3, 5, 9]
+    assert scores.tolist() == [2, 2, 1]
+    assert first.tolist() == [0, 0, 1]
+
+
+def test_impact_top_k_unsettled():
+    # Documents left out of the prefixes could still reach the top.
+    lists = [(np.arange(10), np.full(10, 3)), (np.arange(10, 20), np.full(10, 3))]
+    assert impact_top_k(prefixes_of(lists, 2), 3, False) is None
+    # Fewer known documents than k while postings are left out.
+    assert impact_top_k(prefixes_of(lists, 1), 5, False) is None
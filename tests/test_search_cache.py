@@ -0,0 +1,51 @@
+import json
+import urllib.request
+import pytest
+import benchmark
+from sharding import Coordinator
+from test_sharding import serve, get
+
+
+def post(url, path, payload):
+    request = urllib.request.Request(f'{url}{path}', data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return [[tuple(row) for row in rows] for rows in json.load(response)]
+
+
+@pytest.fixture(scope='module')
+def engines(tmp_path_factory):
+    """ One synthetic corpus served with the result cache and without it. """
+    corpus = tmp_path_factory.mktemp('corpus')
+    _, words = benchmark.build_corpus(corpus, n_docs=1500, vocabulary=300, seed=5)
+    servers = [serve(corpus, RESULT_CACHE_MB='16'), serve(corpus)]
+    try:
+        for _, url in servers:
+            Coordinator([url]).wait_ready(timeout=120)
+        queries = [query for query in benchmark.make_queries(words, 80, seed=5) if len(query.split()) > 1]
+        yield servers[0][1], servers[1][1], queries
+    finally:
+        for process, _ in servers:
+            process.terminate()
+        for process, _ in servers:
+            process.wait()
+
+
+def permuted(query):
+    return ' '.join(reversed(query.split()))
+
+
+def test_cached_search_equals_fresh_for_permuted_query(engines):
+    cached, fresh, queries = engines
+    for query in queries:
+        assert get(cached, '/search', query) == get(fresh, '/search', query), query
+        assert get(cached, '/search', permuted(query)) == get(fresh, '/search', permuted(query)), query
+        assert get(fresh, '/search', permuted(query)) == get(fresh, '/search', query), query
+
+
+def test_cached_search_batch_equals_fresh_for_permuted_query(engines):
+    cached, fresh, queries = engines
+    batch = [query for query in queries for query in (query, permuted(query))]
+    expected = [get(fresh, '/search', query) for query in batch]
+    assert post(fresh, '/search_batch', batch) == expected
+    assert post(cached, '/search_batch', list(reversed(batch))) == list(reversed(expected))
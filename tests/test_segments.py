@@ -0,0 +1,208 @@
+import pickle
+import numpy as np
+import pytest
+from inverted_index_gcp import InvertedIndex, close_posting_readers
+from segments import Segment, SegmentWriter, SegmentedIndex, TieredMergePolicy
+
+VOCABULARY = [f't{i}' for i in range(12)]
+
+
+@pytest.fixture(autouse=True)
+def fresh_readers():
+    yield
+    close_posting_readers()
+
+
+class MergeAll:
+    """ Merges every segment into one whenever there are deletions or more
+        than one segment.
+    """
+    def find_merges(self, segments):
+        if len(segments) > 1 or any(seg['deleted'] for seg in segments):
+            return [[seg['name'] for seg in segments]]
+        return []
+
+
+def random_doc(rng):
+    return [str(w) for w in rng.choice(VOCABULARY, size=int(rng.integers(1, 15)))]
+
+
+def write_base(path, docs):
+    """ Writes `docs` as a base index under `path` and returns it. """
+    path.mkdir()
+    index = InvertedIndex(docs)
+    InvertedIndex.write_a_posting_list(('0', sorted(index._posting_list.items())), path)
+    with open(path / '0_posting_locs.pickle', 'rb') as f:
+        index.posting_locs = pickle.load(f)
+    return index
+
+
+def layered(path, base, base_docs):
+    lengths = {doc_id: len(tokens) for doc_id, tokens in base_docs.items()}
+    avg = sum(lengths.values()) / len(lengths)
+    return SegmentedIndex(path, base, lambda: (len(lengths), avg),
+                          lambda doc_ids: np.array([lengths.get(int(d), 0) for d in doc_ids]),
+                          refresh=0)
+
+
+def expected_postings(docs, w):
+    return [(doc_id, tokens.count(w)) for doc_id, tokens in sorted(docs.items()) if w in tokens]
+
+
+def check(index, base_dir, live):
+    for w in VOCABULARY:
+        post = index.read_a_posting_array(base_dir, w)
+        assert np.all(np.diff(post.doc_ids) > 0), 'postings sorted and without duplicates'
+        assert post.to_list() == expected_postings(live, w)
+    doc_ids = np.arange(0, 60)
+    expected = [len(live[d]) if d in live else 0 for d in doc_ids.tolist()]
+    assert np.asarray(index.doc_lengths(doc_ids)).tolist() == expected
+    assert index.N == len(live)
+    assert index.avg_length == pytest.approx(sum(map(len, live.values())) / len(live))
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_random_updates(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    base_docs = {doc_id: random_doc(rng) for doc_id in range(0, 30, 2)}
+    base = write_base(tmp_path / 'base', base_docs)
+    policy = TieredMergePolicy(segments_per_tier=2, floor_docs=2, max_deleted=0.3)
+    writer = SegmentWriter(tmp_path / 'segments', policy)
+    index = layered(tmp_path / 'segments', base, base_docs)
+    live = dict(base_docs)
+    try:
+        for _ in range(25):
+            op = rng.integers(0, 3)
+            if op == 0:
+                # new documents and new versions of live or deleted ones.
+                added = {int(d): random_doc(rng) for d in rng.choice(50, size=int(rng.integers(1, 6)), replace=False)}
+                writer.add_documents(added)
+                live.update(added)
+            elif op == 1:
+                deleted = [int(d) for d in rng.choice(50, size=int(rng.integers(1, 4)), replace=False)]
+                writer.delete_documents(deleted)
+                for d in deleted:
+                    live.pop(d, None)
+            else:
+                writer.maybe_merge()
+            check(index, tmp_path / 'base', live)
+    finally:
+        writer.close()
+
+
+def test_merge_matches_fresh_build(tmp_path):
+    rng = np.random.default_rng(1)
+    base_docs = {doc_id: random_doc(rng) for doc_id in range(0, 20, 2)}
+    base = write_base(tmp_path / 'base', base_docs)
+    writer = SegmentWriter(tmp_path / 'segments', MergeAll())
+    index = layered(tmp_path / 'segments', base, base_docs)
+    added = {}
+    try:
+        for start in range(20, 50, 6):
+            docs = {doc_id: random_doc(rng) for doc_id in range(start, start + 6)}
+            writer.add_documents(docs)
+            added.update(docs)
+        # replace and delete documents of the segments only, so the base df stays exact.
+        replaced = {21: random_doc(rng), 33: random_doc(rng)}
+        writer.add_documents(replaced)
+        added.update(replaced)
+        writer.delete_documents([22, 40, 41])
+        for d in (22, 40, 41):
+            del added[d]
+        assert writer.maybe_merge() > 0
+        assert len(index.current().segments) == 1
+        assert index.current().segments[0][1] is None
+    finally:
+        writer.close()
+
+    live = {**base_docs, **added}
+    fresh = InvertedIndex(live)
+    check(index, tmp_path / 'base', live)
+    for w in VOCABULARY:
+        assert index.df.get(w, 0) == fresh.df.get(w, 0)
+    assert index.N == len(live)
+    assert index.avg_length == pytest.approx(sum(map(len, live.values())) / len(live))
+
+
+def segment_contents(segment):
+    """ The postings, df, upper bounds, lengths and titles of a segment. """
+    postings = {w: segment.read_a_posting_array(w).to_list() for w in sorted(segment.index.posting_locs)}
+    return (postings, dict(segment.index.df), segment.index.max_scores,
+            dict(zip(segment.nf.ids.tolist(), segment.nf.values.tolist())), segment.titles)
+
+
+def merged_segment(writer):
+    names = [seg['name'] for seg in writer._manifest['segments']]
+    assert len(names) == 1
+    return names[0], Segment(writer.directory / names[0])
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_merged_segment_matches_fresh_build(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    writer = SegmentWriter(tmp_path / 'segments', MergeAll())
+    live, titles = {}, {}
+    try:
+        for _ in range(5):
+            docs = {int(d): random_doc(rng) for d in rng.choice(40, size=int(rng.integers(1, 8)), replace=False)}
+            docs_titles = {doc_id: f'title {doc_id} {rng.integers(100)}' for doc_id in docs}
+            writer.add_documents(docs, docs_titles)
+            live.update(docs)
+            titles.update(docs_titles)
+            deleted = [int(d) for d in rng.choice(40, size=2, replace=False)]
+            writer.delete_documents(deleted)
+            for d in deleted:
+                live.pop(d, None)
+                titles.pop(d, None)
+        writer.maybe_merge()
+        name, merged = merged_segment(writer)
+        assert writer._entry(name)['deleted'] == 0
+    finally:
+        writer.close()
+
+    index = InvertedIndex()
+    for doc_id in sorted(live):
+        index.add_doc(doc_id, live[doc_id])
+    Segment.write(tmp_path / 'fresh', sorted(index._posting_list.items()),
+                  {doc_id: len(tokens) for doc_id, tokens in live.items()}, titles)
+    assert segment_contents(merged) == segment_contents(Segment(tmp_path / 'fresh'))
+
+
+def test_deletes_during_merge_carry_over(tmp_path, monkeypatch):
+    rng = np.random.default_rng(7)
+    base_docs = {doc_id: random_doc(rng) for doc_id in range(0, 20, 2)}
+    base = write_base(tmp_path / 'base', base_docs)
+    writer = SegmentWriter(tmp_path / 'segments', MergeAll())
+    index = layered(tmp_path / 'segments', base, base_docs)
+    live = dict(base_docs)
+    for start in (20, 30):
+        docs = {doc_id: random_doc(rng) for doc_id in range(start, start + 6)}
+        writer.add_documents(docs)
+        live.update(docs)
+    replaced = {31: random_doc(rng)}
+
+    write = Segment.write
+    def write_while_deleting(path, postings, nf, titles, version):
+        # The merge has read its snapshot of the deletions; these come after it.
+        monkeypatch.setattr(Segment, 'write', staticmethod(write))
+        writer.delete_documents([22, 33, 4])
+        writer.add_documents(replaced)
+        write(path, postings, nf, titles, version)
+    monkeypatch.setattr(Segment, 'write', staticmethod(write_while_deleting))
+    try:
+        writer._merge([seg['name'] for seg in writer._manifest['segments']])
+        for d in (22, 33, 4):
+            del live[d]
+        live.update(replaced)
+        names = [seg['name'] for seg in writer._manifest['segments']]
+        assert len(names) == 2
+        # 22, 33 and the old 31 were merged in but deleted while the merge ran.
+        assert writer._entry(names[0])['deleted'] == 3
+        assert writer._bitmap(names[0]).doc_ids().tolist() == [22, 31, 33]
+        check(index, tmp_path / 'base', live)
+        writer.maybe_merge()
+        _, merged = merged_segment(writer)
+        assert sorted(merged.nf.ids.tolist()) == sorted(d for d in live if d >= 20)
+        check(index, tmp_path / 'base', live)
+    finally:
+        writer.close()
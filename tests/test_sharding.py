@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import socket
+import subprocess
+import urllib.parse
+import urllib.request
+from pathlib import Path
+import pytest
+import benchmark
+from sharding import Coordinator, split
+
+FRONTEND = Path(__file__).resolve().parent.parent / 'search_frontend.py'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(index_dir, **env):
+    """ Starts search_frontend.py over `index_dir` and returns (process, url). """
+    port = free_port()
+    env = dict(os.environ, BUCKET_NAME='', INDEX_BASE_DIR=str(index_dir), INDEX_WARMUP='sync',
+               PORT=str(port), **{'RESULT_CACHE_MB': '0', **env})
+    process = subprocess.Popen([sys.executable, str(FRONTEND)], env=env, cwd=index_dir,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process, f'http://127.0.0.1:{port}'
+
+
+def get(url, path, query):
+    with urllib.request.urlopen(f'{url}{path}?{urllib.parse.urlencode({"query": query})}', timeout=30) as response:
+        return [tuple(row) for row in json.load(response)]
+
+
+@pytest.fixture(scope='module')
+def engines(tmp_path_factory):
+    """ One synthetic corpus served whole (with and without FULL_BODY_BM25)
+        and split into three shards behind a coordinator.
+    """
+    corpus = tmp_path_factory.mktemp('corpus')
+    _, words = benchmark.build_corpus(corpus, n_docs=1500, vocabulary=300, seed=3)
+    shards = split(corpus, tmp_path_factory.mktemp('shards'), 3, workers=2)
+    servers = [serve(corpus), serve(corpus, FULL_BODY_BM25='1')] + [serve(shard) for shard in shards]
+    try:
+        single, single_full = (url for _, url in servers[:2])
+        for url in (single, single_full):
+            Coordinator([url]).wait_ready(timeout=120)
+        coordinator = Coordinator([url for _, url in servers[2:]])
+        coordinator.wait_ready(timeout=120)
+        yield single, single_full, coordinator, benchmark.make_queries(words, 80, seed=3)
+    finally:
+        for process, _ in servers:
+            process.terminate()
+        for process, _ in servers:
+            process.wait()
+
+
+def test_search_matches_single_index(engines):
+    single, single_full, coordinator, queries = engines
+    for query in queries:
+        assert coordinator.search(query) == get(single, '/search', query), query
+        assert coordinator.search(query, full_body_bm25=True) == get(single_full, '/search', query), query
+
+
+def test_search_body_matches_single_index(engines):
+    single, _, coordinator, queries = engines
+    for query in queries:
+        assert coordinator.search_body(query) == get(single, '/search_body', query), query